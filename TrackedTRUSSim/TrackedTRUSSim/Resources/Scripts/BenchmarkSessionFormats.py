@@ -0,0 +1,23 @@
+'''
+Times saving and loading sessions of 10, 100 and 1000 cores as MRML scenes and as session files, on
+case 1, in a temporary directory. Setting up a case needs the slice views, so run it with the main window:
+
+  Slicer --python-script BenchmarkSessionFormats.py
+'''
+
+import tempfile
+
+import slicer
+import TrackedTRUSSim
+
+logic = TrackedTRUSSim.TrackedTRUSSimLogic()
+logic.setupParameterNode()
+logic.setupCase(1)
+with tempfile.TemporaryDirectory() as directory:
+  results = logic.benchmarkSessionFormats(directory)
+for cores, formats in results.items():
+  for sessionFormat, (saveTime, loadTime, size) in formats.items():
+    print("{:5d} cores, {:8s}: save {:8.1f} ms, load {:8.1f} ms, {:9d} bytes".format(
+      cores, sessionFormat, 1000 * saveTime, 1000 * loadTime, size))
+
+slicer.util.exit(0)
@@ -0,0 +1,25 @@
+'''
+Drives case 1 with the synthetic OpenIGTLink tracker at 30 to 1000 Hz, with the reconstruction running, and
+prints how many tracker updates and frames per second the simulator handles and the receive-to-frame latency.
+Stop the PLUS server first, the synthetic tracker uses its port:
+
+  Slicer --python-script BenchmarkTrackerRates.py
+'''
+
+import slicer
+import TrackedTRUSSim
+
+logic = TrackedTRUSSim.TrackedTRUSSimLogic()
+logic.setupParameterNode()
+logic.setupCase(1)
+logic.startReconstruction()
+results = logic.measureTrackerRates()
+logic.stopReconstruction()
+logic.stopSyntheticTracker()
+for rate, result in results.items():
+  print("{:5d} Hz: tracker {:6.1f}/s, received {:6.1f}/s, frames {:5.1f}/s, coalesced {:6d}, dropped {:4d}, "
+        "latency mean {:6.2f} ms, p95 {:6.2f} ms, max {:6.2f} ms".format(
+    rate, result["trackerRate"], result["receivedRate"], result["frameRate"], result["coalesced"], result["dropped"],
+    result["meanLatencyMs"], result["p95LatencyMs"], result["maxLatencyMs"]))
+
+slicer.util.exit(0)
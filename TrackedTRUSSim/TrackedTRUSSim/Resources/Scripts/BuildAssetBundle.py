@@ -0,0 +1,16 @@
+'''
+Packs the static transforms, models and US mask of the base scene into Resources/BaseScene.bundle.npz.
+Run it with Slicer whenever one of those files changes (the module falls back to the source files
+until then):
+
+  Slicer --no-main-window --python-script BuildAssetBundle.py
+'''
+
+import slicer
+import TrackedTRUSSim
+
+logic = TrackedTRUSSim.TrackedTRUSSimLogic()
+bundlePath = logic.buildAssetBundle()
+print("Wrote " + bundlePath)
+
+slicer.util.exit(0)
@@ -0,0 +1,32 @@
+'''
+Runs the headless benchmarks and the Slicer ones (setupCase of every case, the reconstruction stages,
+firing and redrawing cores, saveScene / loadScene), appends the run to Resources/Benchmarks/BenchmarkHistory.jsonl
+and exits with 1 if a benchmark got slower than its threshold (Resources/BenchmarkThresholds.json) allows.
+Setting up a case needs the slice views, so run it with the main window:
+
+  Slicer --python-script RunBenchmarks.py [patterns] [--threshold 0.25] [--label text] [--no-record]
+'''
+
+import os
+import shutil
+import sys
+
+import slicer
+import TrackedTRUSSim
+from TrackedTRUSSim import BenchmarkSuite
+
+arguments = BenchmarkSuite.parseArguments("Runs the simulator benchmarks and checks them against the history.", sys.argv[1:])
+currentUser = "Benchmark"
+
+logic = TrackedTRUSSim.TrackedTRUSSimLogic()
+logic.setupParameterNode()
+suite = BenchmarkSuite.headlessSuite()
+logic.addBenchmarks(suite, currentUser=currentUser)
+results = suite.run(arguments.patterns)
+suite.close()
+logic.stopReconstruction()
+shutil.rmtree(os.path.join(os.path.dirname(slicer.modules.trackedtrussim.path), "Resources", "UserData", currentUser),
+              ignore_errors=True)
+
+regressions = BenchmarkSuite.finishRun(results, arguments)
+slicer.util.exit(1 if regressions else 0)
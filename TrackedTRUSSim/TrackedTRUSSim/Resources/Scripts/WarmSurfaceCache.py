@@ -0,0 +1,17 @@
+'''
+Converts the zone segmentations of every case (registered_zones/Patient_*/Zones*.seg.nrrd) to closed
+surfaces and stores them in Resources/Cache/ZoneSurfaces, so that loading a case skips the conversion.
+Files already in the cache are only read back. Safe to run while the simulator is open:
+
+  Slicer --no-main-window --python-script WarmSurfaceCache.py
+'''
+
+import slicer
+import TrackedTRUSSim
+
+logic = TrackedTRUSSim.TrackedTRUSSimLogic()
+for zonePath in logic.warmSurfaceCache():
+  print("Cached " + zonePath)
+print("Surface cache: {} hits, {} converted".format(logic.surfaceCache.hits, logic.surfaceCache.misses))
+
+slicer.util.exit(0)
@@ -0,0 +1,48 @@
+'''
+Small numpy helpers shared by the volume caches.
+'''
+
+import os
+import tempfile
+
+import numpy as np
+
+
+def interpolateTrilinear(volume, ijk):
+    '''
+    Trilinear interpolation of volume [k, j, i] at the N x 3 voxel coordinates ijk, clamped to the grid.
+    The result is in the precision of the volume, at least float32.
+    '''
+    upper = np.array(volume.shape[::-1]) - 1
+    clamped = np.clip(ijk, 0, upper)
+    base = np.minimum(np.floor(clamped).astype(np.intp), np.maximum(upper - 1, 0))
+    fraction = (clamped - base).astype(np.result_type(volume.dtype, np.float32), copy=False)
+    i0, j0, k0 = base[:, 0], base[:, 1], base[:, 2]
+    i1 = np.minimum(i0 + 1, upper[0])
+    j1 = np.minimum(j0 + 1, upper[1])
+    k1 = np.minimum(k0 + 1, upper[2])
+    fi, fj, fk = fraction[:, 0], fraction[:, 1], fraction[:, 2]
+    c00 = volume[k0, j0, i0] * (1 - fi) + volume[k0, j0, i1] * fi
+    c10 = volume[k0, j1, i0] * (1 - fi) + volume[k0, j1, i1] * fi
+    c01 = volume[k1, j0, i0] * (1 - fi) + volume[k1, j0, i1] * fi
+    c11 = volume[k1, j1, i0] * (1 - fi) + volume[k1, j1, i1] * fi
+    return (c00 * (1 - fj) + c10 * fj) * (1 - fk) + (c01 * (1 - fj) + c11 * fj) * fk
+
+
+def atomicSaveNpz(path, **arrays):
+    '''
+    np.savez of arrays to path, written to a temporary file of its own next to path and renamed over it, so a
+    reader never sees a half written file and concurrent writers (threads or processes) never share a temporary.
+    '''
+    fileDescriptor, temporaryPath = tempfile.mkstemp(prefix=os.path.basename(path) + ".", suffix=".tmp",
+                                                     dir=os.path.dirname(os.path.abspath(path)))
+    try:
+        with os.fdopen(fileDescriptor, "wb") as f:
+            np.savez(f, **arrays)
+        os.replace(temporaryPath, path)
+    except BaseException:
+        try:
+            os.remove(temporaryPath)
+        except OSError:
+            pass
+        raise
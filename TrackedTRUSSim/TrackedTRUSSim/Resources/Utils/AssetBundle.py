@@ -0,0 +1,136 @@
+'''
+Single-file bundle of the static base scene: transform matrices, model polydata and the US mask image.
+
+Reading one uncompressed .npz is much faster than parsing every .h5 / .vtk / .stl / .png through the
+Slicer loaders. The bundle records the size, modification time and sha256 of every source file; if a
+source changed, validateBundle reports it and the module falls back to the source files.
+'''
+
+import hashlib
+import json
+import os
+
+import numpy as np
+import vtk
+
+from .ArrayUtils import atomicSaveNpz
+
+BUNDLE_VERSION = 1
+
+
+def fileHash(path, blockSize=1 << 20):
+    sha = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(blockSize), b""):
+            sha.update(block)
+    return sha.hexdigest()
+
+
+def sourceFingerprint(path):
+    stat = os.stat(path)
+    return {"size": stat.st_size, "mtime": stat.st_mtime, "sha256": fileHash(path)}
+
+
+def polyDataToBytes(polyData):
+    writer = vtk.vtkXMLPolyDataWriter()
+    writer.SetInputData(polyData)
+    writer.SetDataModeToBinary()
+    writer.SetCompressorTypeToNone()
+    writer.WriteToOutputStringOn()
+    writer.Write()
+    return np.frombuffer(writer.GetOutputString().encode("latin-1"), dtype=np.uint8)
+
+
+def polyDataFromBytes(data):
+    reader = vtk.vtkXMLPolyDataReader()
+    reader.ReadFromInputStringOn()
+    reader.SetInputString(data.tobytes().decode("latin-1"))
+    reader.Update()
+    return reader.GetOutput()
+
+
+def writeBundle(bundlePath, resourceDir, transforms, models, volumes, sources):
+    '''
+    transforms: name -> 4x4 matrix to parent
+    models: name -> vtkPolyData
+    volumes: name -> (numpy array [k, j, i], 4x4 IJKToRAS matrix)
+    sources: name -> source file path, used to validate the bundle later
+    '''
+    manifest = {
+        "version": BUNDLE_VERSION,
+        "transforms": sorted(transforms),
+        "models": sorted(models),
+        "volumes": sorted(volumes),
+        "sources": {name: dict(sourceFingerprint(path), path=os.path.relpath(path, resourceDir))
+                    for name, path in sources.items()},
+    }
+
+    arrays = {"manifest": np.frombuffer(json.dumps(manifest).encode("utf-8"), dtype=np.uint8)}
+    for name, matrix in transforms.items():
+        arrays["transform_" + name] = np.asarray(matrix, dtype=float)
+    for name, polyData in models.items():
+        arrays["model_" + name] = polyDataToBytes(polyData)
+    for name, (array, ijkToRAS) in volumes.items():
+        arrays["volume_" + name] = array
+        arrays["volumeIJKToRAS_" + name] = np.asarray(ijkToRAS, dtype=float)
+
+    #A half written bundle is never picked up
+    atomicSaveNpz(bundlePath, **arrays)
+    return manifest
+
+
+def readManifest(bundle):
+    return json.loads(bundle["manifest"].tobytes().decode("utf-8"))
+
+
+def validateBundle(bundlePath, resourceDir):
+    '''
+    Returns (valid, reason). A source whose size and mtime match is trusted; otherwise its hash is compared,
+    so touching a file without changing it does not invalidate the bundle.
+    '''
+    if not os.path.exists(bundlePath):
+        return False, "no bundle"
+    try:
+        with np.load(bundlePath) as bundle:
+            manifest = readManifest(bundle)
+    except (OSError, ValueError, KeyError) as e:
+        return False, "unreadable bundle: {}".format(e)
+
+    if manifest.get("version") != BUNDLE_VERSION:
+        return False, "bundle version {} != {}".format(manifest.get("version"), BUNDLE_VERSION)
+
+    for name, source in manifest["sources"].items():
+        path = os.path.join(resourceDir, source["path"])
+        if not os.path.exists(path):
+            return False, "missing source " + source["path"]
+        stat = os.stat(path)
+        if stat.st_size == source["size"] and stat.st_mtime == source["mtime"]:
+            continue
+        if stat.st_size != source["size"] or fileHash(path) != source["sha256"]:
+            return False, "changed source " + source["path"]
+    return True, ""
+
+
+def readBundleTransforms(bundlePath):
+    '''
+    Only the transform matrices of a bundle, without parsing its models and volumes.
+    '''
+    with np.load(bundlePath) as bundle:
+        manifest = readManifest(bundle)
+        return {name: bundle["transform_" + name] for name in manifest["transforms"]}
+
+
+def readBundle(bundlePath):
+    '''
+    Returns the transforms, models and volumes of a bundle in the form writeBundle takes them.
+    '''
+    transforms, models, volumes = {}, {}, {}
+    with np.load(bundlePath) as bundle:
+        manifest = readManifest(bundle)
+        for name in manifest["transforms"]:
+            transforms[name] = bundle["transform_" + name]
+        for name in manifest["models"]:
+            models[name] = polyDataFromBytes(bundle["model_" + name])
+        for name in manifest["volumes"]:
+            volumes[name] = (bundle["volume_" + name], bundle["volumeIJKToRAS_" + name])
+    return transforms, models, volumes
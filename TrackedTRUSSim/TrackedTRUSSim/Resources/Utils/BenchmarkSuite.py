@@ -0,0 +1,383 @@
+'''
+Benchmark suite of the simulator's hot paths. Each benchmark is timed over several calls and summarized
+(median, min, mean, p95, max in ms); a run is appended as one JSON line to a history file together with the
+machine and the git revision, and compared against the median of the previous runs on the same machine.
+A benchmark whose median is slower than that baseline by more than its threshold is a regression.
+
+headlessSuite covers the paths that run without Slicer on synthetic data (and the registered zones when
+present); TrackedTRUSSimLogic.addBenchmarks adds the Slicer ones. Scripts/RunBenchmarks.py runs both, and
+this module's __main__ the headless ones only.
+'''
+
+import fnmatch
+import glob
+import json
+import os
+import platform
+import subprocess
+import tempfile
+import time
+
+import numpy as np
+
+HISTORY_VERSION = 1
+DEFAULT_THRESHOLD = 0.25
+DEFAULT_BASELINE_RUNS = 5
+#Differences below this are timer noise, whatever the relative slowdown
+MINIMUM_REGRESSION_MS = 0.05
+
+
+def timeCall(function, repeats=10, warmup=1, setup=None):
+    '''
+    Calls function warmup times untimed, then repeats times timed. setup(), if given, runs untimed before
+    every call. Returns the summary of the timed calls in ms.
+    '''
+    for index in range(warmup):
+        if setup is not None:
+            setup()
+        function()
+    times = []
+    for index in range(repeats):
+        if setup is not None:
+            setup()
+        startTime = time.perf_counter()
+        function()
+        times.append(time.perf_counter() - startTime)
+    times = 1000 * np.array(times)
+    return {"repeats": repeats, "medianMs": float(np.median(times)), "minMs": float(times.min()),
+            "meanMs": float(times.mean()), "p95Ms": float(np.percentile(times, 95)), "maxMs": float(times.max())}
+
+
+class BenchmarkSuite:
+    '''
+    Named benchmarks, run in the order they were added. Files written by the benchmarks go to a temporary
+    directory owned by the suite (see temporaryPath), which close() removes.
+    '''
+
+    def __init__(self):
+        self.benchmarks = {}
+        self.temporaryDirectory = None
+
+    def temporaryPath(self, name):
+        if self.temporaryDirectory is None:
+            self.temporaryDirectory = tempfile.TemporaryDirectory(prefix="TRUSBenchmarks.")
+        return os.path.join(self.temporaryDirectory.name, name)
+
+    def close(self):
+        if self.temporaryDirectory is not None:
+            self.temporaryDirectory.cleanup()
+            self.temporaryDirectory = None
+
+    def add(self, name, function, repeats=10, warmup=1, setup=None):
+        self.benchmarks[name] = (function, repeats, warmup, setup)
+
+    def run(self, patterns=None, log=print, repeats=None):
+        '''
+        Runs the benchmarks whose names match one of the fnmatch patterns (all when None). repeats, if given,
+        replaces the repeats of every benchmark and skips the warmup (eg. 1 for a smoke test). A benchmark that
+        raises is reported with its error instead of stopping the suite. Returns {name: summary}.
+        '''
+        results = {}
+        for name, (function, benchmarkRepeats, warmup, setup) in self.benchmarks.items():
+            if patterns and not any(fnmatch.fnmatch(name, pattern) for pattern in patterns):
+                continue
+            if repeats is not None:
+                benchmarkRepeats, warmup = repeats, 0
+            try:
+                results[name] = timeCall(function, benchmarkRepeats, warmup, setup)
+            except Exception as error:
+                results[name] = {"error": "{}: {}".format(type(error).__name__, error)}
+            if log is not None:
+                result = results[name]
+                log("{:48s} {}".format(name, result["error"] if "error" in result else
+                                       "median {medianMs:9.3f} ms, p95 {p95Ms:9.3f} ms".format(**result)))
+        return results
+
+
+def machineInfo():
+    return {"node": platform.node(), "machine": platform.machine(), "processor": platform.processor(),
+            "system": platform.system(), "python": platform.python_version(), "cpus": os.cpu_count()}
+
+
+def gitRevision(directory):
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=directory, capture_output=True, text=True,
+                              timeout=10).stdout.strip() or None
+    except (OSError, subprocess.SubprocessError):
+        return None
+
+
+def makeRecord(results, directory=None, label=None):
+    '''
+    One history entry: the results with the time, machine, git revision of directory and an optional label.
+    '''
+    return {"version": HISTORY_VERSION, "time": time.time(), "label": label, "machine": machineInfo(),
+            "revision": gitRevision(directory or os.path.dirname(os.path.abspath(__file__))), "results": results}
+
+
+def appendHistory(path, record):
+    directory = os.path.dirname(path)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+    with open(path, "a") as f:
+        f.write(json.dumps(record) + "\n")
+
+
+def readHistory(path):
+    '''
+    The entries of a history file, oldest first; unreadable lines (eg. a run killed while writing) are skipped.
+    '''
+    if not os.path.exists(path):
+        return []
+    history = []
+    with open(path) as f:
+        for line in f:
+            try:
+                record = json.loads(line)
+            except ValueError:
+                continue
+            if record.get("version") == HISTORY_VERSION:
+                history.append(record)
+    return history
+
+
+def readThresholds(path):
+    '''
+    {fnmatch pattern of benchmark names: allowed relative slowdown} from a JSON file; "default" sets the rest.
+    '''
+    with open(path) as f:
+        return json.load(f)
+
+
+def thresholdFor(name, thresholds, default=DEFAULT_THRESHOLD):
+    '''
+    The threshold of the most specific (longest) pattern that matches name.
+    '''
+    matches = [pattern for pattern in thresholds if pattern != "default" and fnmatch.fnmatch(name, pattern)]
+    if matches:
+        return thresholds[max(matches, key=len)]
+    return thresholds.get("default", default)
+
+
+def findRegressions(results, history, thresholds=None, baselineRuns=DEFAULT_BASELINE_RUNS, minimumMs=MINIMUM_REGRESSION_MS,
+                    node=None):
+    '''
+    [(name, median ms, baseline ms, threshold)] of the benchmarks slower than the median of their medians in
+    the last baselineRuns history entries of this machine (node) by more than their threshold. Benchmarks
+    without history have no baseline and pass.
+    '''
+    thresholds = thresholds or {}
+    node = platform.node() if node is None else node
+    history = [record for record in history if record["machine"].get("node") == node]
+    regressions = []
+    for name, result in results.items():
+        if "medianMs" not in result:
+            continue
+        previous = [record["results"][name]["medianMs"] for record in history
+                    if "medianMs" in record["results"].get(name, {})][-baselineRuns:]
+        if not previous:
+            continue
+        baseline = float(np.median(previous))
+        threshold = thresholdFor(name, thresholds)
+        if result["medianMs"] > baseline * (1 + threshold) and result["medianMs"] - baseline > minimumMs:
+            regressions.append((name, result["medianMs"], baseline, threshold))
+    return regressions
+
+
+def headlessSuite(coreCounts=(0, 100, 1000), resourceDir=None, suite=None):
+    '''
+    Adds the benchmarks that run without Slicer to suite (a new one by default) and returns it: fan mask and
+    needle guide generation at the simulated image size, the reconstruction stages (reslice, frame copy,
+    compounding), firing and redrawing at coreCounts existing cores, session save and load, and the needle
+    zone lookup of each registered patient.
+    '''
+    import vtk
+    from vtk.util import numpy_support
+    from . import GenerateFanMask
+    from .CylindricalResampling import CylindricalVolume
+    from .BiopsyLedger import InstancedPolyData
+    from .FrameBuffer import GrayscaleFrameBuffer
+    from .ImageFormation import UltrasoundImageFormation
+    from .SessionFile import SESSION_EXTENSION, loadSession, randomSession, saveSession
+    from .SliceGenerator import UltrasoundSliceGenerator, syntheticVolume
+    from .TrackingRecording import sweepPose
+    from .VolumeReconstruction import VolumeCompounder
+    from .ZoneIndex import ZoneSamplingIndex
+
+    suite = BenchmarkSuite() if suite is None else suite
+    if resourceDir is None:
+        resourceDir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+    #Fan mask and needle guide at the size of the simulated US volume, geometry scaled as in benchmarkFanMask
+    imageHeight, imageWidth = 717, 601
+    fanArgs = GenerateFanMask.scaledProbeGeometry(imageHeight, imageWidth)
+    innerRadius, center = fanArgs[1], fanArgs[5]
+    sizeName = "{}x{}".format(imageWidth, imageHeight)
+    suite.add("generateFanMask[{}]".format(sizeName), lambda: GenerateFanMask.generateFanMask(*fanArgs))
+    engine = GenerateFanMask.FanMaskEngine()
+    suite.add("fanMaskEngine.getMask[{}]".format(sizeName), lambda: engine.getMask(*fanArgs), repeats=100)
+    mask = GenerateFanMask.generateFanMask(*fanArgs).astype(np.uint8)
+    maskCopy = mask.copy()
+    suite.add("addNeedleTrajectory[{}]".format(sizeName), lambda: GenerateFanMask.addNeedleTrajectory(maskCopy, center, innerRadius),
+              repeats=100, setup=lambda: np.copyto(maskCopy, mask))
+
+    #Reconstruction stages, for a probe sweeping through a synthetic volume
+    generator = UltrasoundSliceGenerator(maskIJKToMask=np.diag([0.25, 0.25, 1.0, 1.0]))
+    volumeImage = syntheticVolume((200, 200, 200))
+    generator.setVolume(volumeImage, np.eye(4))
+    pose = {"index": 0}
+
+    def nextPose():
+        pose["index"] += 1
+        maskToWorld = sweepPose(pose["index"] / 30.0)
+        maskToWorld[:3, 3] = [50.0, 100.0, 100.0]
+        pose["maskToWorld"] = maskToWorld
+    nextPose()
+    frame = generator.generate(pose["maskToWorld"])
+    suite.add("reconstruction.reslice", lambda: generator.generate(pose["maskToWorld"], out=frame), repeats=50, setup=nextPose)
+
+    #The same volume resampled about its z axis, for a probe rotating about that axis (resampled on first use)
+    cylindricalGenerator = UltrasoundSliceGenerator(maskIJKToMask=generator.maskIJKToMask)
+    cylindricalGenerator.setVolume(volumeImage, np.eye(4))
+
+    def nextAxialPose():
+        if cylindricalGenerator.cylindricalVolume is None:
+            volume = numpy_support.vtk_to_numpy(volumeImage.GetPointData().GetScalars()).reshape(200, 200, 200)
+            axisToVolumeIJK = np.eye(4)
+            axisToVolumeIJK[:3, 3] = 100.0
+            cylindricalGenerator.setCylindricalVolume(CylindricalVolume.fromVolume(volume, axisToVolumeIJK))
+        pose["index"] += 1
+        angle = np.radians(pose["index"] * 0.5)
+        maskToWorld = np.eye(4)
+        maskToWorld[:3, 0] = [0.0, 0.0, 1.0]
+        maskToWorld[:3, 1] = [np.cos(angle), np.sin(angle), 0.0]
+        maskToWorld[:3, 2] = np.cross(maskToWorld[:3, 0], maskToWorld[:3, 1])
+        maskToWorld[:3, 3] = [100.0, 100.0, 50.0]
+        pose["axialMaskToWorld"] = maskToWorld
+    suite.add("reconstruction.resliceCylindrical", lambda: cylindricalGenerator.generate(pose["axialMaskToWorld"], out=frame),
+              repeats=50, setup=nextAxialPose)
+
+    rng = np.random.default_rng(0)
+    bgra = rng.integers(0, 256, size=(imageHeight, imageWidth, 4), dtype=np.uint8)
+    frameBuffer = GrayscaleFrameBuffer()
+    suite.add("reconstruction.grabCopy[{}]".format(sizeName), lambda: frameBuffer.updateFromBGRA(bgra), repeats=50)
+
+    imageFormation = UltrasoundImageFormation(*fanArgs)
+    fanImage = bgra[:, :, 0] * GenerateFanMask.generateFanMask(*fanArgs)
+    formedImage = np.zeros_like(fanImage)
+    suite.add("reconstruction.imageFormation[{}]".format(sizeName), lambda: imageFormation.apply(fanImage, formedImage), repeats=50)
+
+    compounder = VolumeCompounder.fromBounds([0, 200, 0, 200, 0, 200], 0.5)
+    suite.add("reconstruction.compound[0.5mm]",
+              lambda: compounder.insertFrame(frame, pose["maskToWorld"] @ generator.maskIJKToMask, generator.fanMask),
+              repeats=50, setup=nextPose)
+
+    #Firing and redrawing cores with coreCounts cores already fired
+    cylinder = vtk.vtkCylinderSource()
+    cylinder.SetRadius(0.5)
+    cylinder.SetHeight(12)
+    cylinder.SetResolution(24)
+    cylinder.Update()
+    corePose = np.eye(4)
+    for cores in coreCounts:
+        session = randomSession(cores)
+        state = {}
+
+        def resetCores(session=session, state=state):
+            state["ledger"] = randomSession(len(session.ledger)).ledger
+            state["instances"] = InstancedPolyData(cylinder.GetOutput())
+            state["instances"].setInstances(state["ledger"].poses)
+
+        def fire(state=state):
+            state["ledger"].append(corePose, depth=10.0)
+            state["instances"].appendInstance(corePose)
+
+        suite.add("fireBiopsy[{} cores]".format(cores), fire, repeats=20, setup=resetCores)
+        instances = InstancedPolyData(cylinder.GetOutput())
+        suite.add("visualizeBiopsies[{} cores]".format(cores), lambda instances=instances, session=session:
+                  instances.setInstances(session.ledger.poses), repeats=20)
+
+        sessionPath = suite.temporaryPath("Benchmark_{}{}".format(cores, SESSION_EXTENSION))
+        suite.add("saveSession[{} cores]".format(cores), lambda path=sessionPath, session=session: saveSession(path, session))
+        #Written in the setup of every load, so a load never reads a file of another run or benchmark
+        suite.add("loadSession[{} cores]".format(cores), lambda path=sessionPath: loadSession(path),
+                  setup=lambda path=sessionPath, session=session: saveSession(path, session))
+
+    #Needle zone lookup of each registered case
+    for zonePath in sorted(glob.glob(os.path.join(resourceDir, "registered_zones", "Patient_*", "Zones.seg.nrrd"))):
+        patient = os.path.basename(os.path.dirname(zonePath))
+        indexState = {}
+
+        def zoneComposition(zonePath=zonePath, indexState=indexState):
+            if "index" not in indexState:
+                #A core through the middle of the zones
+                index = ZoneSamplingIndex.fromSegmentationFile(zonePath)
+                coreToZones = np.eye(4)
+                coreToZones[:3, 3] = (index.labelsIJKToZones @ np.append(np.array(index.zones.shape[::-1]) / 2.0, 1.0))[:3]
+                indexState["index"], indexState["coreToZones"] = index, coreToZones
+            indexState["index"].segmentComposition((0, 0, -6), (0, 0, 6), indexState["coreToZones"])
+        suite.add("zoneComposition[{}]".format(patient), zoneComposition, repeats=100)
+    return suite
+
+
+def reportRegressions(regressions, log=print):
+    for name, median, baseline, threshold in regressions:
+        log("REGRESSION {}: {:.3f} ms, baseline {:.3f} ms (+{:.0f}%, allowed +{:.0f}%)".format(
+            name, median, baseline, 100 * (median / baseline - 1), 100 * threshold))
+
+
+def defaultHistoryPath():
+    resourceDir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    return os.path.join(resourceDir, "Benchmarks", "BenchmarkHistory.jsonl")
+
+
+def defaultThresholdsPath():
+    resourceDir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    return os.path.join(resourceDir, "BenchmarkThresholds.json")
+
+
+def parseArguments(description, arguments=None):
+    '''
+    The command line options shared by this module's __main__ and Scripts/RunBenchmarks.py.
+    '''
+    import argparse
+    parser = argparse.ArgumentParser(description=description)
+    parser.add_argument("patterns", nargs="*", help="fnmatch patterns of the benchmarks to run (default: all)")
+    parser.add_argument("--history", default=defaultHistoryPath(), help="JSON lines file the run is appended to")
+    parser.add_argument("--thresholds", default=defaultThresholdsPath(), help="JSON file of thresholds per pattern")
+    parser.add_argument("--threshold", type=float, default=None, help="allowed relative slowdown of every benchmark")
+    parser.add_argument("--baseline-runs", type=int, default=DEFAULT_BASELINE_RUNS, dest="baselineRuns")
+    parser.add_argument("--label", help="label stored with the run")
+    parser.add_argument("--no-record", action="store_true", dest="noRecord", help="compare only, do not append the run")
+    parser.add_argument("--output", help="also write the run as JSON to this file")
+    return parser.parse_args(arguments)
+
+
+def finishRun(results, arguments, log=print):
+    '''
+    Compares results with the history, records them and returns the regressions.
+    '''
+    thresholds = readThresholds(arguments.thresholds) if os.path.exists(arguments.thresholds) else {}
+    if arguments.threshold is not None:
+        thresholds = {"default": arguments.threshold}
+    regressions = findRegressions(results, readHistory(arguments.history), thresholds, arguments.baselineRuns)
+    record = makeRecord(results, label=arguments.label)
+    record["regressions"] = [name for name, median, baseline, threshold in regressions]
+    if not arguments.noRecord:
+        appendHistory(arguments.history, record)
+    if arguments.output:
+        with open(arguments.output, "w") as f:
+            json.dump(record, f, indent=1)
+    reportRegressions(regressions, log)
+    return regressions
+
+
+if __name__ == "__main__":
+    import sys
+    arguments = parseArguments("Runs the headless benchmarks, records them in the history and exits with 1 on a regression.")
+    suite = headlessSuite()
+    try:
+        results = suite.run(arguments.patterns)
+    finally:
+        suite.close()
+    sys.exit(1 if finishRun(results, arguments) else 0)
@@ -0,0 +1,245 @@
+import base64
+import json
+import time
+
+import numpy as np
+import vtk
+from vtk.util import numpy_support
+
+from .ZoneIndex import ZONES
+
+LEDGER_VERSION = 2
+
+
+class BiopsyLedger:
+    '''
+    Every fired core as one row of a few growing arrays: the BiopsyModelToReference pose (4x4),
+    the time it was fired, the needle depth and the fraction of the core in each of the ZONES
+    (NaN when unknown). Appending is amortized O(1); the arrays double their capacity when full.
+    '''
+
+    def __init__(self, capacity=64):
+        self.count = 0
+        self.allocate(capacity)
+
+    def allocate(self, capacity):
+        poses = np.zeros((capacity, 4, 4))
+        timestamps = np.zeros(capacity)
+        depths = np.zeros(capacity)
+        zoneFractions = np.full((capacity, len(ZONES)), np.nan)
+        if self.count:
+            poses[:self.count] = self._poses[:self.count]
+            timestamps[:self.count] = self._timestamps[:self.count]
+            depths[:self.count] = self._depths[:self.count]
+            zoneFractions[:self.count] = self._zoneFractions[:self.count]
+        self._poses, self._timestamps, self._depths, self._zoneFractions = poses, timestamps, depths, zoneFractions
+
+    def __len__(self):
+        return self.count
+
+    @property
+    def poses(self):
+        return self._poses[:self.count]
+
+    @property
+    def timestamps(self):
+        return self._timestamps[:self.count]
+
+    @property
+    def depths(self):
+        return self._depths[:self.count]
+
+    @property
+    def zoneFractions(self):
+        return self._zoneFractions[:self.count]
+
+    def append(self, pose, timestamp=None, depth=np.nan, zoneFractions=None):
+        if self.count == len(self._poses):
+            self.allocate(2 * len(self._poses))
+        index = self.count
+        self._poses[index] = pose
+        self._timestamps[index] = time.time() if timestamp is None else timestamp
+        self._depths[index] = depth
+        self._zoneFractions[index] = np.nan if zoneFractions is None else zoneFractions
+        self.count += 1
+        return index
+
+    def clear(self):
+        self.count = 0
+
+    def toString(self):
+        '''
+        One JSON string with the arrays as base64 of their little endian bytes, for a MRML parameter.
+        '''
+        def encode(array):
+            return base64.b64encode(np.ascontiguousarray(array, dtype="<f8").tobytes()).decode("ascii")
+        return json.dumps({"version": LEDGER_VERSION, "count": self.count, "poses": encode(self.poses),
+                           "timestamps": encode(self.timestamps), "depths": encode(self.depths),
+                           "zones": list(ZONES), "zoneFractions": encode(self.zoneFractions)})
+
+    @classmethod
+    def fromString(cls, text):
+        blob = json.loads(text)
+        if blob.get("version") not in (1, LEDGER_VERSION):
+            raise ValueError("biopsy ledger version {} != {}".format(blob.get("version"), LEDGER_VERSION))
+
+        def decode(name, shape):
+            return np.frombuffer(base64.b64decode(blob[name]), dtype="<f8").reshape(shape)
+        count = blob["count"]
+        #Version 1 had no zones
+        zoneFractions, zones = None, ()
+        if "zoneFractions" in blob:
+            zoneFractions, zones = decode("zoneFractions", (count, len(blob["zones"]))), blob["zones"]
+        return cls.fromArrays(decode("poses", (count, 4, 4)), decode("timestamps", (count,)), decode("depths", (count,)),
+                              zoneFractions, zones)
+
+    @classmethod
+    def fromArrays(cls, poses, timestamps, depths, zoneFractions=None, zones=ZONES):
+        '''
+        A ledger holding copies of the arrays. The columns of zoneFractions are named by zones and matched to
+        ZONES by name, so the list of ZONES can grow.
+        '''
+        count = len(poses)
+        ledger = cls(max(count, 64))
+        ledger._poses[:count] = poses
+        ledger._timestamps[:count] = timestamps
+        ledger._depths[:count] = depths
+        if zoneFractions is not None:
+            for storedIndex, zone in enumerate(zones):
+                if zone in ZONES:
+                    ledger._zoneFractions[:count, ZONES.index(zone)] = zoneFractions[:, storedIndex]
+        ledger.count = count
+        return ledger
+
+
+class InstancedPolyData:
+    '''
+    A single polydata holding one copy of a template surface per pose, so that any number of cores is
+    one model node. Instance points and normals are written into preallocated arrays that the polydata
+    wraps without copying; appending an instance only transforms the template once.
+    '''
+
+    def __init__(self, template, capacity=64):
+        template = self.triangulate(template)
+        self.templatePoints = numpy_support.vtk_to_numpy(template.GetPoints().GetData()).astype(np.float32)
+        normals = template.GetPointData().GetNormals()
+        self.templateNormals = None if normals is None else numpy_support.vtk_to_numpy(normals).astype(np.float32)
+        self.templateTriangles = numpy_support.vtk_to_numpy(template.GetPolys().GetConnectivityArray()).astype(np.int64)
+
+        self.count = 0
+        self.polyData = vtk.vtkPolyData()
+        self.allocate(capacity)
+
+    @staticmethod
+    def triangulate(polyData):
+        triangles = vtk.vtkTriangleFilter()
+        triangles.SetInputData(polyData)
+        triangles.PassVertsOff()
+        triangles.PassLinesOff()
+        triangles.Update()
+        return triangles.GetOutput()
+
+    def allocate(self, capacity):
+        pointCount = len(self.templatePoints)
+        points = np.zeros((capacity * pointCount, 3), dtype=np.float32)
+        normals = np.zeros_like(points) if self.templateNormals is not None else None
+        used = self.count * pointCount
+        if self.count:
+            points[:used] = self.points[:used]
+            if normals is not None:
+                normals[:used] = self.normals[:used]
+        self.points, self.normals = points, normals
+
+        #Connectivity of every instance is the template's, shifted by the instance's first point
+        offsets = np.arange(capacity, dtype=np.int64)[:, None] * pointCount
+        self.connectivity = (self.templateTriangles[None, :] + offsets).reshape(-1)
+        self.capacity = capacity
+        self.updatePolyData()
+
+    def transformInstances(self, poses, start):
+        poses = np.asarray(poses, dtype=float).reshape(-1, 4, 4)
+        pointCount = len(self.templatePoints)
+        rotations = poses[:, :3, :3].astype(np.float32)
+        translations = poses[:, :3, 3].astype(np.float32)
+        span = slice(start * pointCount, (start + len(poses)) * pointCount)
+        self.points[span] = (np.einsum("nij,pj->npi", rotations, self.templatePoints) + translations[:, None, :]).reshape(-1, 3)
+        if self.normals is not None:
+            #Poses are rigid, so normals only need the rotation
+            self.normals[span] = np.einsum("nij,pj->npi", rotations, self.templateNormals).reshape(-1, 3)
+
+    def setInstances(self, poses):
+        '''
+        Rebuilds all instances from an N x 4 x 4 pose array in one pass.
+        '''
+        poses = np.asarray(poses, dtype=float).reshape(-1, 4, 4)
+        if len(poses) > self.capacity:
+            self.count = 0
+            self.allocate(max(len(poses), 2 * self.capacity))
+        self.count = len(poses)
+        if self.count:
+            self.transformInstances(poses, 0)
+        self.updatePolyData()
+
+    def appendInstance(self, pose):
+        if self.count == self.capacity:
+            self.allocate(2 * self.capacity)
+        self.transformInstances(pose, self.count)
+        self.count += 1
+        self.updatePolyData()
+
+    def updatePolyData(self):
+        pointCount = self.count * len(self.templatePoints)
+        triangleCount = self.count * (len(self.templateTriangles) // 3)
+
+        vtkPoints = vtk.vtkPoints()
+        vtkPoints.SetData(numpy_support.numpy_to_vtk(self.points[:pointCount], deep=False))
+        triangles = vtk.vtkCellArray()
+        triangles.SetData(3, numpy_support.numpy_to_vtk(self.connectivity[:3 * triangleCount], deep=False,
+                                                        array_type=vtk.VTK_ID_TYPE))
+        self.polyData.SetPoints(vtkPoints)
+        self.polyData.SetPolys(triangles)
+        if self.normals is not None:
+            normals = numpy_support.numpy_to_vtk(self.normals[:pointCount], deep=False)
+            normals.SetName("Normals")
+            self.polyData.GetPointData().SetNormals(normals)
+        self.polyData.Modified()
+
+
+def benchmarkFiring(cores=500, template=None):
+    '''
+    Fires cores one at a time into a ledger and an instanced polydata. Returns the fire latency in ms of each
+    core and the ledger.
+    '''
+    if template is None:
+        cylinder = vtk.vtkCylinderSource()
+        cylinder.SetRadius(0.5)
+        cylinder.SetHeight(12)
+        cylinder.SetResolution(24)
+        cylinder.Update()
+        template = cylinder.GetOutput()
+
+    ledger = BiopsyLedger()
+    instances = InstancedPolyData(template)
+    rng = np.random.default_rng(0)
+    latencies = []
+    for index in range(cores):
+        pose = np.eye(4)
+        pose[:3, :3] = np.linalg.qr(rng.normal(size=(3, 3)))[0]
+        pose[:3, 3] = rng.uniform(-20, 20, size=3)
+        startTime = time.perf_counter()
+        ledger.append(pose, depth=rng.uniform(0, 20))
+        instances.appendInstance(pose)
+        latencies.append(1000 * (time.perf_counter() - startTime))
+    return np.array(latencies), ledger
+
+
+if __name__ == "__main__":
+    latencies, ledger = benchmarkFiring()
+    for start in range(0, len(latencies), 100):
+        block = latencies[start:start + 100]
+        print("cores {:3d}-{:3d}: mean {:.3f} ms, max {:.3f} ms".format(start, start + len(block) - 1, block.mean(), block.max()))
+    startTime = time.perf_counter()
+    text = ledger.toString()
+    BiopsyLedger.fromString(text)
+    print("ledger of {} cores: {} characters, round trip {:.3f} ms".format(len(ledger), len(text),
+                                                                         1000 * (time.perf_counter() - startTime)))
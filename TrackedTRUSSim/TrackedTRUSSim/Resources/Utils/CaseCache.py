@@ -0,0 +1,124 @@
+from collections import OrderedDict
+
+
+def dataObjectBytes(dataObject, seen=None):
+    '''
+    Memory used by a VTK data object, counting objects already in seen (by id) only once.
+    '''
+    if dataObject is None:
+        return 0
+    if seen is not None:
+        if id(dataObject) in seen:
+            return 0
+        seen.add(id(dataObject))
+    return dataObject.GetActualMemorySize() * 1024
+
+
+def segmentationBytes(segmentation, seen=None):
+    '''
+    Memory used by all representations of all segments of a vtkSegmentation. Segments that
+    share a labelmap are only counted once.
+    '''
+    if segmentation is None:
+        return 0
+    if seen is None:
+        seen = set()
+    total = 0
+    for index in range(segmentation.GetNumberOfSegments()):
+        segment = segmentation.GetNthSegment(index)
+        names = []
+        segment.GetContainedRepresentationNames(names)
+        for name in names:
+            total += dataObjectBytes(segment.GetRepresentation(name), seen)
+    return total
+
+
+class PreparedCase:
+    '''
+    Everything setupCase needs to show a case, already decoded: the TRUSToCylinder matrix, the TRUS
+    image data with its geometry and window / level, the zone segmentation with its closed surfaces,
+    and the zone sampling index and distance fields (None if the zone file could not be indexed).
+    '''
+
+    def __init__(self, caseNumber, trusToCylinder, trusImageData, trusIJKToRAS, window, level, segmentation, sources,
+                 zoneIndex=None, zoneDistances=None):
+        self.caseNumber = caseNumber
+        self.trusToCylinder = trusToCylinder
+        self.trusImageData = trusImageData
+        self.trusIJKToRAS = trusIJKToRAS
+        self.window = window
+        self.level = level
+        self.segmentation = segmentation
+        self.sources = sources
+        self.zoneIndex = zoneIndex
+        self.zoneDistances = zoneDistances
+
+    def sizeBytes(self):
+        seen = set()
+        zoneBytes = sum(zoneData.nbytes for zoneData in (self.zoneIndex, self.zoneDistances) if zoneData is not None)
+        return dataObjectBytes(self.trusImageData, seen) + segmentationBytes(self.segmentation, seen) + zoneBytes
+
+
+class LRUCache:
+    '''
+    Least recently used cache with a memory budget. sizeOf(value) gives the size of an entry in bytes;
+    the least recently used entries are evicted until the total fits maxBytes. The most recent entry is
+    always kept, even if it is larger than the budget on its own.
+    '''
+
+    def __init__(self, maxBytes, sizeOf=lambda value: value.sizeBytes()):
+        self.maxBytes = maxBytes
+        self.sizeOf = sizeOf
+        self.entries = OrderedDict()
+        self.sizes = {}
+        self.totalBytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __contains__(self, key):
+        return key in self.entries
+
+    def __len__(self):
+        return len(self.entries)
+
+    def get(self, key):
+        value = self.entries.get(key)
+        if value is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self.entries.move_to_end(key)
+        return value
+
+    def put(self, key, value):
+        if key in self.entries:
+            self.remove(key)
+        size = self.sizeOf(value)
+        self.entries[key] = value
+        self.sizes[key] = size
+        self.totalBytes += size
+        self.evict()
+
+    def remove(self, key):
+        self.entries.pop(key)
+        self.totalBytes -= self.sizes.pop(key)
+
+    def setMaxBytes(self, maxBytes):
+        self.maxBytes = maxBytes
+        self.evict()
+
+    def evict(self):
+        while self.totalBytes > self.maxBytes and len(self.entries) > 1:
+            oldestKey = next(iter(self.entries))
+            self.remove(oldestKey)
+            self.evictions += 1
+
+    def clear(self):
+        self.entries.clear()
+        self.sizes.clear()
+        self.totalBytes = 0
+
+    def getStats(self):
+        return {"entries": len(self.entries), "bytes": self.totalBytes, "maxBytes": self.maxBytes,
+                "hits": self.hits, "misses": self.misses, "evictions": self.evictions}
@@ -0,0 +1,180 @@
+'''
+Decodes cases on worker threads before the user selects them.
+
+The workers only read files into numpy arrays and polydata (NRRD decompression and the surface cache read
+release the GIL for most of their time), so the main thread is left with the short step of wrapping the
+arrays in nodes. Threads rather than processes, so that the decoded arrays are handed over without copying.
+'''
+
+import logging
+import os
+import threading
+from collections import Counter, OrderedDict
+from concurrent.futures import CancelledError, ThreadPoolExecutor
+
+from . import NrrdIO
+from .SurfaceCache import surfaceCacheKey
+from .ZoneDistance import loadOrComputeZoneDistances
+from .ZoneIndex import ZoneSamplingIndex, labelNamesFromMetadata
+
+
+class PrefetchCancelled(Exception):
+    pass
+
+
+class DecodedCase:
+    '''
+    Arrays of a case as read from disk. trusArray is None when the case has no TRUS volume.
+    surfaces holds the closed surfaces from the surface cache for surfacesKey, or None.
+    '''
+
+    def __init__(self, caseNumber, trusArray, trusIJKToRAS, zoneArray, zoneIJKToRAS, zonePath, surfacesKey=None, surfaces=None,
+                 zoneIndex=None, zoneDistances=None):
+        self.caseNumber = caseNumber
+        self.trusArray = trusArray
+        self.trusIJKToRAS = trusIJKToRAS
+        self.zoneArray = zoneArray
+        self.zoneIJKToRAS = zoneIJKToRAS
+        self.zonePath = zonePath
+        self.surfacesKey = surfacesKey
+        self.surfaces = surfaces
+        self.zoneIndex = zoneIndex
+        self.zoneDistances = zoneDistances
+
+
+def decodeCase(caseNumber, caseDirectory, surfaceCache=None, conversionParameters=None, cancelled=None):
+    '''
+    Reads TRUS.nrrd, Zones.seg.nrrd and (if a surface cache is given) the cached zone surfaces of a case,
+    and builds the zone sampling index and distance fields (read from their cache when it is up to date).
+    cancelled is a threading.Event that is checked between files.
+    '''
+    def checkCancelled():
+        if cancelled is not None and cancelled.is_set():
+            raise PrefetchCancelled(caseNumber)
+
+    trusArray, trusIJKToRAS = None, None
+    trusPath = os.path.join(caseDirectory, "TRUS.nrrd")
+    if os.path.exists(trusPath):
+        trusArray, trusIJKToRAS, _ = NrrdIO.readNrrd(trusPath)
+    checkCancelled()
+
+    zonePath = os.path.join(caseDirectory, "Zones.seg.nrrd")
+    zoneArray, zoneIJKToRAS, zoneMetadata = NrrdIO.readNrrd(zonePath)
+    zoneIndex = ZoneSamplingIndex(zoneArray, zoneIJKToRAS, labelNamesFromMetadata(zoneMetadata))
+    checkCancelled()
+    zoneDistances = loadOrComputeZoneDistances(zonePath, zoneIndex)
+    checkCancelled()
+
+    surfacesKey, surfaces = None, None
+    if surfaceCache is not None and conversionParameters is not None:
+        surfacesKey = surfaceCacheKey(zonePath, conversionParameters)
+        surfaces = surfaceCache.read(surfacesKey)
+    return DecodedCase(caseNumber, trusArray, trusIJKToRAS, zoneArray, zoneIJKToRAS, zonePath, surfacesKey, surfaces,
+                       zoneIndex, zoneDistances)
+
+
+class CasePrefetcher:
+    '''
+    Keeps decode(caseNumber, cancelled) running on a thread pool for the cases that are likely to be opened next.
+
+    take() hands over a prefetched case: a hit if it was already decoded, a late hit if it was still being
+    decoded (the caller waits for the rest), a miss if it was never requested or failed.
+    '''
+
+    def __init__(self, decode, maxWorkers=2):
+        self.decode = decode
+        self.maxWorkers = maxWorkers
+        self.executor = None
+        self.pending = OrderedDict()
+        self.touchCounts = Counter()
+        self.resetCounts()
+
+    def resetCounts(self):
+        self.hits = 0
+        self.lateHits = 0
+        self.misses = 0
+        self.cancelledCount = 0
+        self.failedCount = 0
+
+    def getStats(self):
+        requests = self.hits + self.lateHits + self.misses
+        return {"hits": self.hits, "lateHits": self.lateHits, "misses": self.misses,
+                "cancelled": self.cancelledCount, "failed": self.failedCount,
+                "hitRate": (self.hits + self.lateHits) / requests if requests else 0.0}
+
+    def touch(self, caseNumber):
+        self.touchCounts[caseNumber] += 1
+
+    def candidates(self, upcomingCases, limit, exclude=()):
+        '''
+        The next upcoming cases first, then the most often opened ones, without duplicates or excluded cases.
+        '''
+        ranked = []
+        for caseNumber in list(upcomingCases) + [caseNumber for caseNumber, _ in self.touchCounts.most_common()]:
+            if caseNumber not in ranked and caseNumber not in exclude:
+                ranked.append(caseNumber)
+        return ranked[:limit]
+
+    def prefetch(self, caseNumbers):
+        '''
+        Starts decoding caseNumbers and cancels pending work for any other case.
+        '''
+        for caseNumber in list(self.pending):
+            if caseNumber not in caseNumbers:
+                self.cancel(caseNumber)
+        for caseNumber in caseNumbers:
+            if caseNumber not in self.pending:
+                cancelled = threading.Event()
+                self.pending[caseNumber] = (self.submit(self.decode, caseNumber, cancelled), cancelled)
+
+    def submit(self, function, *args):
+        '''
+        Runs function(*args) on the prefetch threads, for other background work of a case. Returns its Future.
+        '''
+        if self.executor is None:
+            self.executor = ThreadPoolExecutor(self.maxWorkers, thread_name_prefix="CasePrefetch")
+        return self.executor.submit(function, *args)
+
+    def cancel(self, caseNumber=None):
+        caseNumbers = list(self.pending) if caseNumber is None else [caseNumber]
+        for caseNumber in caseNumbers:
+            entry = self.pending.pop(caseNumber, None)
+            if entry is None:
+                continue
+            future, cancelled = entry
+            cancelled.set()
+            future.cancel()
+            self.cancelledCount += 1
+
+    def take(self, caseNumber):
+        '''
+        Returns the decoded case, or None if it has to be loaded the slow way (also when decoding it failed).
+        '''
+        entry = self.pending.pop(caseNumber, None)
+        if entry is None:
+            self.misses += 1
+            return None
+        future, _ = entry
+        wasDone = future.done()
+        try:
+            decoded = future.result()
+        except (CancelledError, PrefetchCancelled):
+            self.misses += 1
+            return None
+        except Exception:
+            #Any error of a worker (reading, indexing or the distance fields) only costs the prefetch
+            logging.exception("Prefetching case {} failed, loading it directly".format(caseNumber))
+            self.failedCount += 1
+            self.misses += 1
+            return None
+        if wasDone:
+            self.hits += 1
+        else:
+            self.lateHits += 1
+        return decoded
+
+    def shutdown(self):
+        self.cancel()
+        if self.executor is not None:
+            self.executor.shutdown(wait=False)
+            self.executor = None
@@ -0,0 +1,309 @@
+'''
+Cylindrical pre-resampling of a case's TRUS volume about the axis of the CylinderModel, which the probe mostly
+rotates about and slides along. The volume is resampled once into planes through the axis, one every
+angularStep, each a 2D (axial x signed radial) image. A US mask plane that contains the axis is then one of
+those planes: its frame is a 2D bilinear resample of a contiguous image instead of a trilinear oblique reslice
+of the whole volume. Poses whose plane is further than a tolerance from every precomputed plane return None,
+and UltrasoundSliceGenerator reslices them obliquely.
+
+The resampled planes are cached in an .npz beside the case, keyed by the sha256 of TRUS.nrrd, the
+TRUSToCylinder matrix it was resampled with and the grid parameters.
+'''
+
+import hashlib
+import math
+import os
+import time
+
+import numpy as np
+import vtk
+from vtk.util import numpy_support
+
+from .ArrayUtils import atomicSaveNpz, interpolateTrilinear
+from .AssetBundle import fileHash
+from .TransformUtils import updateVTKMatrixFromArray
+
+CYLINDRICAL_CACHE_VERSION = 1
+
+
+def cylinderAxisFromBounds(bounds):
+    '''
+    Axis frame of a cylinder model (axis to model coordinates): centred in its bounds, z along the longest side.
+    '''
+    extents = np.subtract(bounds[1::2], bounds[0::2])
+    longest = int(np.argmax(extents))
+    axisToModel = np.eye(4)
+    axisToModel[:3, :3] = np.roll(np.eye(3), longest - 2, axis=1)
+    axisToModel[:3, 3] = (np.asarray(bounds[0::2]) + np.asarray(bounds[1::2])) / 2.0
+    return axisToModel
+
+
+class CylindricalVolume:
+    '''
+    planes [angle, z, rho]: plane a contains the axis at angle a * angularStep in [0, pi) from the x axis of the
+    axis frame, with samples at rho = rhoOrigin + u * radialSpacing (signed, through the axis) and
+    z = zOrigin + v * axialSpacing. axisToVolumeIJK places the axis frame in the voxels of the source volume,
+    so the planes move with the volume. tolerance is the largest distance (mm) from a mask plane to the nearest
+    precomputed plane, over the corners of the mask, for which extractSlice uses the planes.
+    '''
+
+    def __init__(self, planes, axisToVolumeIJK, angularStep, rhoOrigin, radialSpacing, zOrigin, axialSpacing, tolerance=None):
+        self.planes = planes
+        self.axisToVolumeIJK = np.array(axisToVolumeIJK, dtype=float)
+        self.volumeIJKToAxis = np.linalg.inv(self.axisToVolumeIJK)
+        self.angularStep = float(angularStep)
+        self.rhoOrigin = float(rhoOrigin)
+        self.radialSpacing = float(radialSpacing)
+        self.zOrigin = float(zOrigin)
+        self.axialSpacing = float(axialSpacing)
+        self.tolerance = 0.5 * min(self.radialSpacing, self.axialSpacing) if tolerance is None else float(tolerance)
+
+        #2D reslice of one plane at a time; the input wraps the plane in place
+        self.planeIndex = None
+        self.planeImage = vtk.vtkImageData()
+        self.planeImage.SetDimensions(planes.shape[2], planes.shape[1], 1)
+        self.resliceAxes = vtk.vtkMatrix4x4()
+        self.reslice = vtk.vtkImageReslice()
+        self.reslice.SetInputData(self.planeImage)
+        self.reslice.SetResliceAxes(self.resliceAxes)
+        self.reslice.SetInterpolationModeToLinear()
+        self.reslice.SetOutputOrigin(0.0, 0.0, 0.0)
+        self.reslice.SetOutputSpacing(1.0, 1.0, 1.0)
+        self.reslice.SetOutputDimensionality(2)
+        self.reslice.SetBackgroundLevel(0.0)
+        self.outputSize = None
+
+        #OpenCV's 2D affine warp of the plane is about three times faster than the VTK reslice; VTK without it
+        try:
+            import cv2
+        except ImportError:
+            cv2 = None
+        warpTypes = (np.uint8, np.uint16, np.int16, np.float32, np.float64)
+        self.cv2 = cv2 if planes.dtype in warpTypes else None
+        self.slice = None
+
+    @classmethod
+    def fromVolume(cls, volume, axisToVolumeIJK, radialSpacing=None, axialSpacing=None, angularStep=None, volumeIJKToRAS=None):
+        '''
+        Resamples volume [k, j, i] into planes through the axis, over the extent of the volume. The spacings
+        default to the smallest voxel spacing of volumeIJKToRAS (1 mm without it), and angularStep to the angle
+        that moves the outermost samples by one radial spacing.
+        '''
+        axisToVolumeIJK = np.asarray(axisToVolumeIJK, dtype=float)
+        volumeIJKToAxis = np.linalg.inv(axisToVolumeIJK)
+        voxelSpacing = 1.0 if volumeIJKToRAS is None else float(np.linalg.norm(np.asarray(volumeIJKToRAS)[:3, :3], axis=0).min())
+        radialSpacing = radialSpacing or voxelSpacing
+        axialSpacing = axialSpacing or voxelSpacing
+
+        #Extent of the volume around the axis
+        dimensions = np.array(volume.shape[::-1]) - 1
+        corners = np.array([[i, j, k, 1.0] for i in (0, dimensions[0]) for j in (0, dimensions[1]) for k in (0, dimensions[2])])
+        cornersInAxis = corners @ volumeIJKToAxis.T
+        maxRadius = float(np.linalg.norm(cornersInAxis[:, :2], axis=1).max())
+        radialSamples = int(math.ceil(maxRadius / radialSpacing))
+        zOrigin = float(cornersInAxis[:, 2].min())
+        axialSamples = int(math.ceil((cornersInAxis[:, 2].max() - zOrigin) / axialSpacing)) + 1
+        if angularStep is None:
+            angularStep = radialSpacing / max(maxRadius, radialSpacing)
+        angleCount = int(math.ceil(math.pi / angularStep))
+        angularStep = math.pi / angleCount
+
+        rho = (np.arange(2 * radialSamples + 1) - radialSamples) * radialSpacing
+        z = zOrigin + np.arange(axialSamples) * axialSpacing
+        rhoGrid, zGrid = np.meshgrid(rho, z)
+        #Integer volumes are interpolated in float32, converted once for all the planes
+        samples = volume if np.issubdtype(volume.dtype, np.floating) else volume.astype(np.float32)
+        planes = np.empty((angleCount, axialSamples, len(rho)), dtype=volume.dtype)
+        for angleIndex in range(angleCount):
+            angle = angleIndex * angularStep
+            points = np.column_stack((rhoGrid.ravel() * math.cos(angle), rhoGrid.ravel() * math.sin(angle), zGrid.ravel()))
+            ijk = points @ axisToVolumeIJK[:3, :3].T + axisToVolumeIJK[:3, 3]
+            inside = np.all((ijk >= 0) & (ijk <= dimensions), axis=1)
+            values = np.where(inside, interpolateTrilinear(samples, ijk), 0.0).reshape(rhoGrid.shape)
+            if np.issubdtype(volume.dtype, np.integer):
+                values = np.rint(values)
+            planes[angleIndex] = values
+        return cls(planes, axisToVolumeIJK, angularStep, -radialSamples * radialSpacing, radialSpacing, zOrigin, axialSpacing)
+
+    @property
+    def nbytes(self):
+        return self.planes.nbytes
+
+    def nearestPlane(self, pixelToAxis, width, height):
+        '''
+        Index of the precomputed plane closest to the plane of the mask pixels (i, j, 0) and the largest distance
+        (mm) of the mask corners from it.
+        '''
+        normal = np.cross(pixelToAxis[:3, 0], pixelToAxis[:3, 1])
+        #A plane through the axis at angle theta has the normal (-sin theta, cos theta, 0)
+        angle = math.atan2(-normal[0], normal[1]) % math.pi
+        planeIndex = int(round(angle / self.angularStep)) % len(self.planes)
+        planeAngle = planeIndex * self.angularStep
+        planeNormal = np.array([-math.sin(planeAngle), math.cos(planeAngle), 0.0])
+        corners = np.array([[0, 0, 0, 1], [width - 1, 0, 0, 1], [0, height - 1, 0, 1], [width - 1, height - 1, 0, 1]], dtype=float)
+        distance = float(np.abs((corners @ pixelToAxis.T)[:, :3] @ planeNormal).max())
+        return planeIndex, distance
+
+    def extractSlice(self, maskIJKToVolumeIJK, width, height):
+        '''
+        The width x height slice for mask pixel (i, j, 0) to volume voxel maskIJKToVolumeIJK, resampled from
+        the nearest plane, or None if the mask plane is further than tolerance from it.
+        '''
+        pixelToAxis = self.volumeIJKToAxis @ maskIJKToVolumeIJK
+        planeIndex, distance = self.nearestPlane(pixelToAxis, width, height)
+        if distance > self.tolerance:
+            return None
+
+        #Axis frame to plane pixel (u, v): rho along the plane's direction, z along the axis
+        planeAngle = planeIndex * self.angularStep
+        axisToPlane = np.zeros((4, 4))
+        axisToPlane[0, :2] = np.array([math.cos(planeAngle), math.sin(planeAngle)]) / self.radialSpacing
+        axisToPlane[0, 3] = -self.rhoOrigin / self.radialSpacing
+        axisToPlane[1, 2] = 1.0 / self.axialSpacing
+        axisToPlane[1, 3] = -self.zOrigin / self.axialSpacing
+        axisToPlane[3, 3] = 1.0
+        pixelToPlane = axisToPlane @ pixelToAxis
+        plane = self.planes[planeIndex]
+
+        if self.cv2 is not None:
+            if self.slice is None or self.slice.shape != (height, width):
+                self.slice = np.empty((height, width), dtype=self.planes.dtype)
+            self.cv2.warpAffine(plane, pixelToPlane[:2, [0, 1, 3]], (width, height), dst=self.slice,
+                                flags=self.cv2.INTER_LINEAR | self.cv2.WARP_INVERSE_MAP, borderMode=self.cv2.BORDER_CONSTANT)
+            return self.slice
+
+        if planeIndex != self.planeIndex:
+            self.planeImage.GetPointData().SetScalars(numpy_support.numpy_to_vtk(plane.reshape(-1), deep=False))
+            self.planeIndex = planeIndex
+        if self.outputSize != (width, height):
+            self.reslice.SetOutputExtent(0, width - 1, 0, height - 1, 0, 0)
+            self.outputSize = (width, height)
+        #Output slice 0 reads input slice 0; vtkImageReslice does not handle singular axes
+        pixelToPlane[2] = (0.0, 0.0, 1.0, 0.0)
+        updateVTKMatrixFromArray(self.resliceAxes, pixelToPlane)
+        self.reslice.Update()
+        scalars = self.reslice.GetOutput().GetPointData().GetScalars()
+        return numpy_support.vtk_to_numpy(scalars).reshape(height, width)
+
+    def save(self, path, sourceKey):
+        atomicSaveNpz(path, version=CYLINDRICAL_CACHE_VERSION, sourceKey=sourceKey, planes=self.planes,
+                      axisToVolumeIJK=self.axisToVolumeIJK, grid=[self.angularStep, self.rhoOrigin, self.radialSpacing,
+                                                                 self.zOrigin, self.axialSpacing])
+
+    @classmethod
+    def load(cls, path, sourceKey):
+        '''
+        Returns the cached planes, or None if there are none for this source key.
+        '''
+        if not os.path.exists(path):
+            return None
+        try:
+            with np.load(path) as cached:
+                if int(cached["version"]) != CYLINDRICAL_CACHE_VERSION or str(cached["sourceKey"]) != sourceKey:
+                    return None
+                return cls(cached["planes"], cached["axisToVolumeIJK"], *cached["grid"])
+        except (OSError, ValueError, KeyError):
+            return None
+
+
+def cylindricalCachePath(trusPath):
+    return os.path.join(os.path.dirname(trusPath), "CylindricalTRUS.npz")
+
+
+def cylindricalSourceKey(trusPath, axisToVolumeIJK, parameters):
+    sha = hashlib.sha256(fileHash(trusPath).encode())
+    sha.update(np.round(np.asarray(axisToVolumeIJK, dtype=float), 6).tobytes())
+    sha.update(repr(parameters).encode())
+    return sha.hexdigest()
+
+
+def loadOrComputeCylindricalVolume(trusPath, volume, volumeIJKToRAS, trusToCylinder, axisToCylinder=None, **parameters):
+    '''
+    The cylindrical resampling of a case's TRUS volume [k, j, i] about the cylinder axis (axisToCylinder, by
+    default the z axis of the cylinder frame), from the cache beside TRUS.nrrd when it matches, otherwise
+    computed and cached. parameters are passed to CylindricalVolume.fromVolume.
+    '''
+    axisToCylinder = np.eye(4) if axisToCylinder is None else np.asarray(axisToCylinder, dtype=float)
+    axisToVolumeIJK = np.linalg.inv(np.asarray(volumeIJKToRAS, dtype=float)) @ np.linalg.inv(np.asarray(trusToCylinder, dtype=float)) @ axisToCylinder
+    sourceKey = cylindricalSourceKey(trusPath, axisToVolumeIJK, sorted(parameters.items()))
+    cachePath = cylindricalCachePath(trusPath)
+    cylindricalVolume = CylindricalVolume.load(cachePath, sourceKey)
+    if cylindricalVolume is not None:
+        return cylindricalVolume
+    cylindricalVolume = CylindricalVolume.fromVolume(volume, axisToVolumeIJK, volumeIJKToRAS=volumeIJKToRAS, **parameters)
+    try:
+        cylindricalVolume.save(cachePath, sourceKey)
+    except OSError:
+        pass #Read-only install; the planes are simply resampled again next time
+    return cylindricalVolume
+
+
+def benchmarkCylindricalSlices(frames=300, dimensions=(200, 200, 200), maskScale=0.25, obliqueTilt=5.0):
+    '''
+    Frames per second and accuracy of the cylindrical path against the oblique reslice, for a probe rotating
+    about the axis (the z axis through the centre of a synthetic volume) and, with obliqueTilt degrees of tilt,
+    for poses that fall back to the oblique path. Accuracy is the difference of the uint8 frames.
+    '''
+    from .SliceGenerator import UltrasoundSliceGenerator, syntheticVolume
+
+    imageData = syntheticVolume(dimensions)
+    volume = numpy_support.vtk_to_numpy(imageData.GetPointData().GetScalars()).reshape(dimensions[::-1])
+    axisToVolumeIJK = np.eye(4)
+    axisToVolumeIJK[:3, 3] = np.array(dimensions) / 2.0
+    startTime = time.perf_counter()
+    cylindricalVolume = CylindricalVolume.fromVolume(volume, axisToVolumeIJK)
+    resampleTime = time.perf_counter() - startTime
+
+    oblique = UltrasoundSliceGenerator(maskIJKToMask=np.diag([maskScale, maskScale, 1.0, 1.0]))
+    oblique.setVolume(imageData, np.eye(4))
+    cylindrical = UltrasoundSliceGenerator(maskIJKToMask=np.diag([maskScale, maskScale, 1.0, 1.0]))
+    cylindrical.setVolume(imageData, np.eye(4))
+    cylindrical.setCylindricalVolume(cylindricalVolume)
+
+    def pose(frame, tilt):
+        #Mask x along the axis, mask y radial, rotating about the axis; the fan apex sits on the axis
+        angle = np.radians(frame * 0.5)
+        radial = np.array([np.cos(angle), np.sin(angle), 0.0])
+        axial = np.array([0.0, 0.0, 1.0])
+        if tilt:
+            tangent = np.cross(axial, radial)
+            axial = axial * np.cos(np.radians(tilt)) + tangent * np.sin(np.radians(tilt))
+        maskToVolume = np.eye(4)
+        maskToVolume[:3, 0] = axial
+        maskToVolume[:3, 1] = radial
+        maskToVolume[:3, 2] = np.cross(axial, radial)
+        maskToVolume[:3, 3] = axisToVolumeIJK[:3, 3] - axial * oblique.width * maskScale / 2.0
+        return maskToVolume
+
+    results = {"resampleSeconds": resampleTime, "planes": len(cylindricalVolume.planes),
+               "cylindricalMegabytes": cylindricalVolume.nbytes / 1e6}
+    for name, tilt in (("onAxis", 0.0), ("tilted", obliqueTilt)):
+        poses = [pose(frame, tilt) for frame in range(frames)]
+        for generator in (oblique, cylindrical):
+            generator.cylindricalFrames = generator.obliqueFrames = 0
+        startTime = time.perf_counter()
+        for maskToWorld in poses:
+            oblique.generate(maskToWorld)
+        obliqueFps = frames / (time.perf_counter() - startTime)
+        startTime = time.perf_counter()
+        for maskToWorld in poses:
+            cylindrical.generate(maskToWorld)
+        cylindricalFps = frames / (time.perf_counter() - startTime)
+
+        errors = []
+        for maskToWorld in poses[::10]:
+            difference = cylindrical.generate(maskToWorld).astype(np.int16) - oblique.generate(maskToWorld).astype(np.int16)
+            errors.append(np.abs(difference[oblique.fanMask]))
+        errors = np.concatenate(errors)
+        results[name] = {"obliqueFps": obliqueFps, "cylindricalFps": cylindricalFps,
+                         "cylindricalFraction": cylindrical.cylindricalFrames / float(cylindrical.cylindricalFrames + cylindrical.obliqueFrames),
+                         "meanAbsError": float(errors.mean()), "p99AbsError": float(np.percentile(errors, 99))}
+    return results
+
+
+if __name__ == "__main__":
+    results = benchmarkCylindricalSlices()
+    print("resampled {planes} planes ({cylindricalMegabytes:.1f} MB) in {resampleSeconds:.2f} s".format(**results))
+    for name in ("onAxis", "tilted"):
+        print("{}: oblique {obliqueFps:.1f} fps, cylindrical {cylindricalFps:.1f} fps ({cylindricalFraction:.0%} of frames), "
+              "error mean {meanAbsError:.2f} p99 {p99AbsError:.1f} gray levels".format(name, **results[name]))
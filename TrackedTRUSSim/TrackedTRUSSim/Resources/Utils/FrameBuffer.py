@@ -0,0 +1,153 @@
+import time
+from collections import deque
+
+import numpy as np
+import vtk
+from vtk.util import numpy_support
+
+from .StageProfiler import NULL_PROFILER
+
+
+class FrameStats:
+    '''
+    Per-frame latency and buffer allocation counts of a frame path, so that the
+    legacy copy chain and the preallocated path can be compared on the same data.
+    '''
+
+    def __init__(self, maxSamples=1000):
+        self.latencies = deque(maxlen=maxSamples)
+        self.frameCount = 0
+        self.allocationCount = 0
+
+    def addFrame(self, latency, allocations):
+        self.latencies.append(latency)
+        self.frameCount += 1
+        self.allocationCount += allocations
+
+    def reset(self):
+        self.latencies.clear()
+        self.frameCount = 0
+        self.allocationCount = 0
+
+    def summary(self):
+        latencies = np.array(self.latencies) * 1000.0
+        return {
+            "frames": self.frameCount,
+            "allocations": self.allocationCount,
+            "allocationsPerFrame": self.allocationCount / float(max(self.frameCount, 1)),
+            "meanLatencyMs": float(latencies.mean()) if len(latencies) else 0.0,
+            "maxLatencyMs": float(latencies.max()) if len(latencies) else 0.0,
+        }
+
+
+class GrayscaleFrameBuffer:
+    '''
+    Grayscale frame that is allocated once per frame size and reused for every frame.
+    The vtkImageData scalars wrap the numpy array without copying, so writing into
+    array and calling markModified is all that is needed to publish a new frame.
+    '''
+
+    def __init__(self):
+        self.width = None
+        self.height = None
+        self.array = None
+        self.vtkArray = None
+        self.imageData = vtk.vtkImageData()
+        self.stats = FrameStats()
+
+    def resize(self, width, height, spacing=(1.0, 1.0, 1.0)):
+        '''
+        Reallocates the buffers if the frame size changed. Returns True if it did.
+        '''
+        if width == self.width and height == self.height:
+            return False
+
+        self.width = width
+        self.height = height
+        self.array = np.zeros((height, width), dtype=np.uint8)
+
+        #Shallow wrap; self.array must stay referenced for as long as vtkArray is in use
+        self.vtkArray = numpy_support.numpy_to_vtk(self.array.ravel(), deep=False, array_type=vtk.VTK_UNSIGNED_CHAR)
+        self.imageData.SetDimensions(width, height, 1)
+        self.imageData.SetOrigin(0.0, 0.0, 0.0)
+        self.imageData.SetSpacing(spacing)
+        self.imageData.GetPointData().SetScalars(self.vtkArray)
+        return True
+
+    def markModified(self):
+        self.vtkArray.Modified()
+        self.imageData.Modified()
+
+    def updateFromBGRA(self, bgra, profiler=NULL_PROFILER):
+        '''
+        Converts a height x width x 4 BGRA frame (eg. a view of a QImage) into the buffer in place.
+        Returns the number of buffer allocations made for this frame.
+        '''
+        import cv2 #Only the grab path converts colour; the rest of the simulation core does not need OpenCV
+        height, width = bgra.shape[:2]
+        allocations = 1 if self.resize(width, height, self.imageData.GetSpacing()) else 0
+        cv2.cvtColor(bgra, cv2.COLOR_BGRA2GRAY, dst=self.array)
+        profiler.mark("grayscale")
+        self.markModified()
+        profiler.mark("vtkModified")
+        return allocations
+
+
+def bgraViewFromBuffer(buffer, width, height, bytesPerLine=None):
+    '''
+    Returns a height x width x 4 uint8 view of a raw 32 bit image buffer (eg. QImage.constBits())
+    without copying. bytesPerLine accounts for any padding at the end of each scan line.
+    '''
+    if bytesPerLine is None:
+        bytesPerLine = width * 4
+    flat = np.frombuffer(buffer, dtype=np.uint8, count=height * bytesPerLine)
+    return flat.reshape(height, bytesPerLine)[:, :width * 4].reshape(height, width, 4)
+
+
+def copyFrameLegacy(bgraBuffer, width, height, spacing=(1.0, 1.0, 1.0)):
+    '''
+    The original reconstructionCallback conversion: copy the pixels into a new array, convert
+    to grayscale, deep copy into a vtk array and build a new vtkImageData. Returns the image data
+    and the number of full-frame buffers allocated (always 4).
+    '''
+    import cv2
+    img_np = np.array(bgraBuffer).reshape(height, width, 4)
+    grayscale = cv2.cvtColor(img_np, cv2.COLOR_BGR2GRAY)
+    vtkGrayscale = numpy_support.numpy_to_vtk(grayscale.ravel(), deep=True, array_type=vtk.VTK_UNSIGNED_CHAR)
+
+    sliceImageData = vtk.vtkImageData()
+    sliceImageData.SetDimensions(width, height, 1)
+    sliceImageData.SetOrigin(0.0, 0.0, 0.0)
+    sliceImageData.SetSpacing(spacing)
+    sliceImageData.GetPointData().SetScalars(vtkGrayscale)
+    return sliceImageData, 4
+
+
+def benchmarkFramePath(width=601, height=717, frames=200):
+    '''
+    Feeds the same synthetic BGRA frames through the legacy copy chain and the preallocated
+    buffer and returns the FrameStats summary of each.
+    '''
+    rng = np.random.default_rng(0)
+    bgra = rng.integers(0, 256, size=(height, width, 4), dtype=np.uint8)
+    raw = memoryview(bgra.tobytes())
+
+    legacyStats = FrameStats(frames)
+    for i in range(frames):
+        startTime = time.perf_counter()
+        imageData, allocations = copyFrameLegacy(raw, width, height)
+        legacyStats.addFrame(time.perf_counter() - startTime, allocations)
+
+    frameBuffer = GrayscaleFrameBuffer()
+    for i in range(frames):
+        startTime = time.perf_counter()
+        allocations = frameBuffer.updateFromBGRA(bgraViewFromBuffer(raw, width, height))
+        frameBuffer.stats.addFrame(time.perf_counter() - startTime, allocations)
+
+    return {"legacy": legacyStats.summary(), "preallocated": frameBuffer.stats.summary()}
+
+
+if __name__ == "__main__":
+    for path, summary in benchmarkFramePath().items():
+        print("{}: {frames} frames, {allocationsPerFrame:.3f} allocations/frame, "
+              "mean {meanLatencyMs:.3f} ms, max {maxLatencyMs:.3f} ms".format(path, **summary))
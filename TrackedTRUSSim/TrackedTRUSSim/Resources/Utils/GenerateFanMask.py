@@ -1,8 +1,63 @@
+import abc
 import numpy as np
-import cv2
 import math
+import os
+import time
+from collections import OrderedDict
+
+#Default probe geometry, matching the models/USMask.png resource
+DEFAULT_OUTER_RADIUS = 210
+DEFAULT_INNER_RADIUS = 40
+DEFAULT_FOV = 140
+DEFAULT_IMAGE_HEIGHT = 400
+DEFAULT_IMAGE_WIDTH = 400
+DEFAULT_CENTER = (200, 300)
+
+def resolveCenter(imageHeight, imageWidth, center=None):
+    if center is None:  # use the middle of the image
+        center = (int(imageWidth / 2), int(imageHeight / 2))
+    return (center[0], center[1])
+
+def polarGrid(imageHeight, imageWidth, center=None):
+    '''
+    Returns the distance from the center and the angle from the upward midline (in radians)
+    of every pixel in an image of the given size, computed with whole-array operations.
+    Pixels at the center have an angle of nan, like angle_between for a zero vector.
+    '''
+    center = resolveCenter(imageHeight, imageWidth, center)
+    Y, X = np.ogrid[:imageHeight, :imageWidth]
+    dX = X - center[0]
+    dY = Y - center[1]
+    distFromCenter = np.sqrt(dX ** 2 + dY ** 2)
+    #Same arithmetic as angle_between([dY, dX], [-1, 0]), for every pixel at once
+    with np.errstate(invalid='ignore', divide='ignore'):
+        radsFromMidline = np.arccos(np.clip(-dY / distFromCenter, -1.0, 1.0))
+    return distFromCenter, radsFromMidline
 
 def generateFanMask(outerRad, innerRad, FOV, imageHeight, imageWidth, center=None):
+    distFromCenter, radsFromMidline = polarGrid(imageHeight, imageWidth, center)
+    return fanMaskFromPolarGrid(distFromCenter, radsFromMidline, outerRad, innerRad, FOV)
+
+def fanMaskFromPolarGrid(distFromCenter, radsFromMidline, outerRad, innerRad, FOV):
+    #Generate a "donut" mask
+    mask = np.logical_and(distFromCenter < outerRad, distFromCenter > innerRad)
+    #Select a particular fraction of the "donut"
+    return np.logical_and(mask, radsFromMidline < math.radians(FOV/2))
+
+def scaledProbeGeometry(imageHeight, imageWidth):
+    '''
+    The default probe geometry scaled to an image size: (outerRad, innerRad, FOV, imageHeight, imageWidth, center),
+    the arguments of generateFanMask. The default image size gives the geometry of models/USMask.png.
+    '''
+    scale = min(imageHeight, imageWidth) / float(DEFAULT_IMAGE_HEIGHT)
+    center = (int(imageWidth / 2), int(imageHeight / 4) * 3)
+    return (DEFAULT_OUTER_RADIUS * scale, DEFAULT_INNER_RADIUS * scale, DEFAULT_FOV, imageHeight, imageWidth, center)
+
+def generateFanMaskPerPixel(outerRad, innerRad, FOV, imageHeight, imageWidth, center=None):
+    '''
+    Original per-pixel implementation of generateFanMask. Kept as the reference for
+    benchmarkFanMask and for checking that the vectorized version produces the same mask.
+    '''
     if center is None:  # use the middle of the image
         center = (int(imageWidth / 2), int(imageHeight / 2))
     #Generate a grid of pixels of the image size specified
@@ -20,6 +75,136 @@ def generateFanMask(outerRad, innerRad, FOV, imageHeight, imageWidth, center=Non
     #Return the resulting mask
     return mask_2
 
+class FanMaskEngine:
+    '''
+    Builds fan masks for batches of probe geometries and keeps them in a keyed cache, so that
+    repeated requests for the same geometry return the stored mask without recomputing it.
+    The polar grid of each (image size, center) is cached too, so geometries that only differ in
+    radius or FOV share the expensive distance / angle computation.
+    Returned masks are read-only; copy them before drawing on them.
+    '''
+
+    def __init__(self, maxMasks=32, maxGrids=4):
+        self.maxMasks = maxMasks
+        self.maxGrids = maxGrids
+        self.masks = OrderedDict()
+        self.grids = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def geometryKey(outerRad, innerRad, FOV, imageHeight, imageWidth, center=None):
+        center = resolveCenter(imageHeight, imageWidth, center)
+        return (float(outerRad), float(innerRad), float(FOV), int(imageHeight), int(imageWidth),
+                float(center[0]), float(center[1]))
+
+    def getPolarGrid(self, imageHeight, imageWidth, center=None):
+        center = resolveCenter(imageHeight, imageWidth, center)
+        gridKey = (int(imageHeight), int(imageWidth), float(center[0]), float(center[1]))
+        grid = self.grids.get(gridKey)
+        if grid is None:
+            grid = polarGrid(imageHeight, imageWidth, center)
+            self.grids[gridKey] = grid
+            if len(self.grids) > self.maxGrids:
+                self.grids.popitem(last=False)
+        else:
+            self.grids.move_to_end(gridKey)
+        return grid
+
+    def getMask(self, outerRad, innerRad, FOV, imageHeight, imageWidth, center=None):
+        key = self.geometryKey(outerRad, innerRad, FOV, imageHeight, imageWidth, center)
+        mask = self.masks.get(key)
+        if mask is not None:
+            self.hits += 1
+            self.masks.move_to_end(key)
+            return mask
+
+        self.misses += 1
+        distFromCenter, radsFromMidline = self.getPolarGrid(imageHeight, imageWidth, center)
+        mask = fanMaskFromPolarGrid(distFromCenter, radsFromMidline, outerRad, innerRad, FOV)
+        mask.flags.writeable = False
+        self.masks[key] = mask
+        if len(self.masks) > self.maxMasks:
+            self.masks.popitem(last=False)
+        return mask
+
+    def getMasks(self, geometries):
+        '''
+        Returns one mask per geometry. Each geometry is a dict with the keys outerRad, innerRad,
+        FOV, imageHeight, imageWidth and optionally center, or a tuple in that order.
+        '''
+        masks = []
+        for geometry in geometries:
+            if isinstance(geometry, dict):
+                masks.append(self.getMask(**geometry))
+            else:
+                masks.append(self.getMask(*geometry))
+        return masks
+
+    def clear(self):
+        self.masks.clear()
+        self.grids.clear()
+        self.hits = 0
+        self.misses = 0
+
+#Module-wide engine, shared by everything that needs a fan mask
+fanMaskEngine = FanMaskEngine()
+
+def writeFanMask(outputPath, outerRad=DEFAULT_OUTER_RADIUS, innerRad=DEFAULT_INNER_RADIUS, FOV=DEFAULT_FOV,
+                 imageHeight=DEFAULT_IMAGE_HEIGHT, imageWidth=DEFAULT_IMAGE_WIDTH, center=DEFAULT_CENTER):
+    '''
+    Writes the fan mask for the given geometry as an 8 bit png (0 outside, 255 inside the fan).
+    '''
+    import cv2 #Only needed to write the mask; the geometry itself is numpy only
+    mask = fanMaskEngine.getMask(outerRad, innerRad, FOV, imageHeight, imageWidth, center)
+    mask_int = mask.astype(np.uint8) * 255
+    if not cv2.imwrite(outputPath, mask_int):
+        raise IOError("Could not write fan mask to " + outputPath)
+    return mask_int
+
+def usMaskResourcePath():
+    '''
+    Location of the models/USMask.png resource that the module loads as the MaskVolume.
+    '''
+    return os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, "models", "USMask.png")
+
+def benchmarkFanMask(sizes=((100, 100), (200, 200), (400, 400), (601, 717)), repeats=3, includePerPixel=True):
+    '''
+    Times the per-pixel generateFanMask against the vectorized version and a cached engine lookup
+    at several image sizes. Returns one dict of timings (in seconds) per size.
+    '''
+    results = []
+    for imageHeight, imageWidth in sizes:
+        args = scaledProbeGeometry(imageHeight, imageWidth)
+
+        result = {"imageHeight": imageHeight, "imageWidth": imageWidth}
+
+        if includePerPixel:
+            startTime = time.perf_counter()
+            reference = generateFanMaskPerPixel(*args)
+            result["perPixel"] = time.perf_counter() - startTime
+
+        vectorizedTimes = []
+        for i in range(repeats):
+            startTime = time.perf_counter()
+            mask = generateFanMask(*args)
+            vectorizedTimes.append(time.perf_counter() - startTime)
+        result["vectorized"] = min(vectorizedTimes)
+
+        engine = FanMaskEngine()
+        startTime = time.perf_counter()
+        engine.getMask(*args)
+        result["engineFirst"] = time.perf_counter() - startTime
+        startTime = time.perf_counter()
+        engine.getMask(*args)
+        result["engineCached"] = time.perf_counter() - startTime
+
+        if includePerPixel:
+            result["identical"] = bool(np.array_equal(reference, mask))
+            result["speedup"] = result["perPixel"] / max(result["vectorized"], 1e-9)
+        results.append(result)
+    return results
+
 def unit_vector(vector):
     """ Returns the unit vector of the vector.  """
     return vector / np.linalg.norm(vector)
@@ -34,11 +219,36 @@ def angle_between(v1, v2):
     v2_u = unit_vector(v2)
     return np.arccos(np.clip(np.dot(v1_u, v2_u), -1.0, 1.0))
 
-def addNeedleTrajectory(oldMask, center, innerRadius):
+def needleGuideStencil(imageHeight, imageWidth, center, innerRadius, dashLen=10, dashThickness=1):
     '''
+    Returns a boolean image that is True on the dashes of the needle guide line.
     The ratio between the inner radius and the location of the needle trajectory is
     3:1 in the original probe (ie. it is a probe with a radius of 12mm and the needle is 3mm above that).
     '''
+    #Define the columns of interest once, since this does not change.
+    trajCol = int(center[0] + (innerRadius / 3) * 5)
+    cols = np.arange(trajCol-dashThickness, trajCol+dashThickness)
+
+    #Rows that go into dashLen an odd number of times form the dashes
+    rows = np.flatnonzero((np.arange(imageHeight) // dashLen) % 2)
+
+    stencil = np.zeros((imageHeight, imageWidth), dtype=bool)
+    stencil[np.ix_(rows, cols)] = True
+    return stencil
+
+def addNeedleTrajectory(oldMask, center, innerRadius):
+    '''
+    Cuts the dashed needle guide line into the fan mask, in place.
+    Pixels outside the fan are already 0, so the whole stencil can be cleared at once.
+    '''
+    stencil = needleGuideStencil(oldMask.shape[0], oldMask.shape[1], center, innerRadius)
+    oldMask[stencil] = 0
+    return oldMask
+
+def addNeedleTrajectoryPerPixel(oldMask, center, innerRadius):
+    '''
+    Original per-pixel implementation of addNeedleTrajectory, kept as the reference.
+    '''
 
     #Define how long the dashes should be
     dashLen = 10
@@ -64,6 +274,158 @@ def addNeedleTrajectory(oldMask, center, innerRadius):
 
     return oldMask
 
+def depthMarkerStencil(imageHeight, imageWidth, center, innerRad, outerRad, FOV, spacing=20, thickness=2, tickAngle=4):
+    '''
+    Returns a boolean image that is True on short arcs along both edges of the fan, every
+    spacing pixels of depth from the inner radius. tickAngle is the arc length of a tick in degrees.
+    '''
+    distFromCenter, radsFromMidline = fanMaskEngine.getPolarGrid(imageHeight, imageWidth, center)
+
+    #Distance of every pixel to the closest tick depth
+    depths = distFromCenter - innerRad
+    offTick = np.abs(depths - np.round(depths / spacing) * spacing)
+
+    halfFOV = math.radians(FOV / 2)
+    nearEdge = np.logical_and(radsFromMidline < halfFOV, radsFromMidline >= halfFOV - math.radians(tickAngle))
+    inRange = np.logical_and(distFromCenter > innerRad + spacing / 2, distFromCenter < outerRad)
+    return np.logical_and.reduce((offTick < thickness / 2, nearEdge, inRange))
+
+class MaskLayer(abc.ABC):
+    '''
+    One stencil of a MaskPipeline. Subclasses implement computeStencil; the stencil is cached and
+    only recomputed when the layer parameters or the image size change.
+    Where the stencil is True, the pipeline writes the layer value into the overlay.
+    '''
+
+    value = 0
+
+    def __init__(self, name, **parameters):
+        self.name = name
+        self.enabled = True
+        self.parameters = {}
+        self.stencil = None
+        self.stencilKey = None
+        self.computeCount = 0
+        self.setParameters(**parameters)
+
+    def setParameters(self, **parameters):
+        for key, value in parameters.items():
+            #Lists are not hashable; the parameters are part of the cache key
+            if isinstance(value, (list, np.ndarray)):
+                value = tuple(value)
+            self.parameters[key] = value
+
+    def key(self, imageHeight, imageWidth):
+        return (imageHeight, imageWidth) + tuple(sorted(self.parameters.items()))
+
+    def getStencil(self, imageHeight, imageWidth):
+        key = self.key(imageHeight, imageWidth)
+        if key != self.stencilKey:
+            self.stencil = self.computeStencil(imageHeight, imageWidth)
+            self.stencilKey = key
+            self.computeCount += 1
+        return self.stencil
+
+    @abc.abstractmethod
+    def computeStencil(self, imageHeight, imageWidth):
+        pass
+
+class FanLayer(MaskLayer):
+
+    value = 255
+
+    def computeStencil(self, imageHeight, imageWidth):
+        p = self.parameters
+        return fanMaskEngine.getMask(p["outerRad"], p["innerRad"], p["FOV"], imageHeight, imageWidth, p.get("center"))
+
+class NeedleGuideLayer(MaskLayer):
+
+    def computeStencil(self, imageHeight, imageWidth):
+        p = self.parameters
+        return needleGuideStencil(imageHeight, imageWidth, p["center"], p["innerRadius"],
+                                  p.get("dashLen", 10), p.get("dashThickness", 1))
+
+class DepthMarkerLayer(MaskLayer):
+
+    def computeStencil(self, imageHeight, imageWidth):
+        p = self.parameters
+        return depthMarkerStencil(imageHeight, imageWidth, p["center"], p["innerRad"], p["outerRad"], p["FOV"],
+                                  p.get("spacing", 20), p.get("thickness", 2), p.get("tickAngle", 4))
+
+class MaskPipeline:
+    '''
+    Combines mask layers, in order, into a single cached uint8 overlay. Changing the parameters of
+    one layer only recomputes that layer's stencil; the others are reused when the overlay is rebuilt.
+    '''
+
+    def __init__(self, imageHeight, imageWidth, layers=()):
+        self.imageHeight = imageHeight
+        self.imageWidth = imageWidth
+        self.layers = list(layers)
+        self.overlay = None
+        self.overlayKey = None
+
+    def addLayer(self, layer):
+        self.layers.append(layer)
+        return layer
+
+    def getLayer(self, name):
+        for layer in self.layers:
+            if layer.name == name:
+                return layer
+        raise KeyError(name)
+
+    def setLayerParameters(self, name, **parameters):
+        self.getLayer(name).setParameters(**parameters)
+
+    def setLayerEnabled(self, name, enabled):
+        self.getLayer(name).enabled = enabled
+
+    def setProbeGeometry(self, outerRad, innerRad, FOV, center):
+        '''
+        Updates every built-in layer that depends on the probe geometry.
+        '''
+        for layer in self.layers:
+            if isinstance(layer, FanLayer):
+                layer.setParameters(outerRad=outerRad, innerRad=innerRad, FOV=FOV, center=center)
+            elif isinstance(layer, NeedleGuideLayer):
+                layer.setParameters(center=center, innerRadius=innerRad)
+            elif isinstance(layer, DepthMarkerLayer):
+                layer.setParameters(outerRad=outerRad, innerRad=innerRad, FOV=FOV, center=center)
+
+    def getOverlay(self):
+        '''
+        Returns the combined overlay. It is shared with the cache, so treat it as read-only.
+        '''
+        activeLayers = [layer for layer in self.layers if layer.enabled]
+        key = tuple((layer.name, layer.value, layer.key(self.imageHeight, self.imageWidth)) for layer in activeLayers)
+        if key == self.overlayKey:
+            return self.overlay
+
+        overlay = np.zeros((self.imageHeight, self.imageWidth), dtype=np.uint8)
+        for layer in activeLayers:
+            overlay[layer.getStencil(self.imageHeight, self.imageWidth)] = layer.value
+        overlay.flags.writeable = False
+
+        self.overlay = overlay
+        self.overlayKey = key
+        return overlay
+
+def defaultMaskPipeline(outerRad=DEFAULT_OUTER_RADIUS, innerRad=DEFAULT_INNER_RADIUS, FOV=DEFAULT_FOV,
+                        imageHeight=DEFAULT_IMAGE_HEIGHT, imageWidth=DEFAULT_IMAGE_WIDTH, center=DEFAULT_CENTER,
+                        depthMarkers=False):
+    '''
+    Fan plus needle guide, which reproduces Utils/US_Mask.png for the default geometry.
+    Depth markers are added but disabled unless requested.
+    '''
+    pipeline = MaskPipeline(imageHeight, imageWidth)
+    pipeline.addLayer(FanLayer("fan", outerRad=outerRad, innerRad=innerRad, FOV=FOV, center=center))
+    pipeline.addLayer(NeedleGuideLayer("needleGuide", center=center, innerRadius=innerRad))
+    depthMarkerLayer = pipeline.addLayer(DepthMarkerLayer("depthMarkers", outerRad=outerRad, innerRad=innerRad,
+                                                          FOV=FOV, center=center))
+    depthMarkerLayer.enabled = depthMarkers
+    return pipeline
+
 # imageHeight = 400
 # imageWidth = 400
 # FOV = 140
@@ -88,4 +450,21 @@ def addNeedleTrajectory(oldMask, center, innerRadius):
 # #
 # cv2.imshow(outputFileName, mask_int)
 # cv2.imwrite(outputFileName, mask_int)
-# cv2.waitKey(0)
\ No newline at end of file
+# cv2.waitKey(0)
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Regenerate the US fan mask resource or benchmark fan mask generation.")
+    parser.add_argument("--benchmark", action="store_true", help="compare the per-pixel and vectorized fan masks")
+    parser.add_argument("--output", default=usMaskResourcePath(), help="where to write the fan mask png")
+    args = parser.parse_args()
+
+    if args.benchmark:
+        for result in benchmarkFanMask():
+            print("{imageHeight}x{imageWidth}: per-pixel {perPixel:.4f}s, vectorized {vectorized:.5f}s, "
+                  "engine first {engineFirst:.5f}s, engine cached {engineCached:.7f}s, "
+                  "speedup {speedup:.0f}x, identical {identical}".format(**result))
+    else:
+        writeFanMask(args.output)
+        print("Wrote " + os.path.normpath(args.output))
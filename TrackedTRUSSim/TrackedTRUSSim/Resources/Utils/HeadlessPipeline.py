@@ -0,0 +1,50 @@
+'''
+The per-pose work of the simulator without Slicer: a tracked probe pose goes through the transform chain to
+the US mask plane, the slice generator samples the TRUS volume there, and the frame is compounded into a
+volume. Driven by TrackingReplayer, it profiles and benchmarks the reconstruction path offline.
+'''
+
+import numpy as np
+
+from .SimulationCore import CHAINS, PROBE_TO_PHANTOM, SimulationCore
+
+
+class HeadlessPipeline:
+    '''
+    staticTransforms: {name: 4x4 matrix to parent} of the calibration transforms (eg. from the asset bundle);
+    missing ones are identity. sliceGenerator is an UltrasoundSliceGenerator with its volume set, and
+    volumeCompounder an optional VolumeCompounder.
+
+    setMatrixToParent(name, matrix, timestamp) has the signature of a TrackingReplayer sink; every new
+    ProbeToPhantom pose produces one frame. core is the SimulationCore, for the needle, the ledger and scoring.
+    '''
+
+    def __init__(self, staticTransforms, sliceGenerator, volumeCompounder=None):
+        self.matrices = {name: np.eye(4) for links in CHAINS.values() for name in links}
+        for name, matrix in staticTransforms.items():
+            self.matrices[name] = np.array(matrix, dtype=float)
+        self.core = SimulationCore(self.matrices.__getitem__)
+        self.core.setSliceGenerator(sliceGenerator, volumeCompounder)
+        self.transformChain = self.core.transformChain
+
+        self.sliceGenerator = sliceGenerator
+        self.volumeCompounder = volumeCompounder
+        self.frameCount = 0
+        self.lastTimestamp = None
+
+    def setMatrixToParent(self, name, matrix, timestamp=None):
+        self.matrices[name] = np.array(matrix, dtype=float)
+        self.lastTimestamp = timestamp
+        if name in self.core.transformChain.dynamicLinks:
+            if name == PROBE_TO_PHANTOM:
+                self.processFrame()
+        else:
+            self.core.invalidate(name)
+
+    def processFrame(self):
+        frame = self.core.generateFrame(compound=True)
+        self.frameCount += 1
+        return frame
+
+    def getPointerTipToWorld(self):
+        return self.core.getPointerTipToWorld()
@@ -0,0 +1,262 @@
+'''
+Ultrasound image formation after slice extraction. The windowed fan image of UltrasoundSliceGenerator is
+resampled onto a polar grid of the fan (rows along depth from the inner to the outer radius, columns along the
+field of view), where the artifacts of a real probe follow the beam lines:
+
+  - shadowing: samples brighter than a threshold reflect, and everything deeper on their beam line is dimmed
+    by the cumulative reflection above it
+  - attenuation and time gain compensation: one gain per depth, the round trip attenuation plus the TGC curve
+  - speckle: multiplicative Rayleigh noise, from a bank of patterns cycled as the probe moves (a still probe
+    keeps its pattern, as a real one does while the tissue is still)
+
+Each is a whole-array operation on the polar image. The polar image is then scan converted back to the fan.
+Both resamplings use remap tables computed once per geometry: cv2.remap with fixed point maps when OpenCV is
+available, otherwise precomputed bilinear gathers in numpy.
+'''
+
+import math
+import time
+
+import numpy as np
+
+from . import GenerateFanMask
+
+
+def loadOpenCV():
+    try:
+        import cv2
+    except ImportError:
+        return None
+    return cv2
+
+
+class RemapTable:
+    '''
+    Bilinear resampling of a 2D image at fixed source coordinates (mapX along columns, mapY along rows, in
+    pixels) into an image of the shape of the maps. Destination pixels where valid is False are 0.
+    '''
+
+    def __init__(self, mapX, mapY, sourceShape, valid=None, cv2=None):
+        self.shape = mapX.shape
+        self.cv2 = cv2
+        valid = np.ones(self.shape, dtype=bool) if valid is None else valid
+        sourceHeight, sourceWidth = sourceShape
+        mapX = np.clip(mapX, 0, sourceWidth - 1)
+        mapY = np.clip(mapY, 0, sourceHeight - 1)
+
+        if cv2 is not None:
+            #Every pixel samples inside the source (cv2.remap is much slower on border pixels), then the
+            #invalid ones are zeroed
+            self.map1, self.map2 = cv2.convertMaps(mapX.astype(np.float32), mapY.astype(np.float32), cv2.CV_16SC2)
+            self.validWeights = None if valid.all() else valid.astype(np.uint8)
+            return
+
+        #Four neighbours and weights of every valid pixel, gathered from the flattened source
+        self.validIndex = np.flatnonzero(valid)
+        x = mapX.ravel()[self.validIndex]
+        y = mapY.ravel()[self.validIndex]
+        x0 = np.minimum(np.floor(x).astype(np.intp), max(sourceWidth - 2, 0))
+        y0 = np.minimum(np.floor(y).astype(np.intp), max(sourceHeight - 2, 0))
+        fx = (x - x0).astype(np.float32)
+        fy = (y - y0).astype(np.float32)
+        corner = y0 * sourceWidth + x0
+        self.sourceIndex = np.stack((corner, corner + 1, corner + sourceWidth, corner + sourceWidth + 1))
+        self.weights = np.stack(((1 - fx) * (1 - fy), fx * (1 - fy), (1 - fx) * fy, fx * fy))
+        self.values = np.empty(len(self.validIndex), dtype=np.float32)
+
+    def apply(self, source, out):
+        if self.cv2 is not None:
+            self.cv2.remap(source, self.map1, self.map2, self.cv2.INTER_LINEAR, dst=out, borderMode=self.cv2.BORDER_REPLICATE)
+            if self.validWeights is not None:
+                np.multiply(out, self.validWeights, out=out)
+            return out
+
+        flat = source.ravel()
+        np.multiply(flat[self.sourceIndex[0]], self.weights[0], out=self.values)
+        for corner in range(1, 4):
+            self.values += flat[self.sourceIndex[corner]] * self.weights[corner]
+        if np.issubdtype(out.dtype, np.integer):
+            self.values += 0.5
+        out.fill(0)
+        out.ravel()[self.validIndex] = self.values
+        return out
+
+
+class ScanConversion:
+    '''
+    Remap tables between a fan image of generateFanMask geometry and its polar grid [depth, angle]. Row r of
+    the polar grid is at radius innerRad + r * radialStep, column c at angle -FOV / 2 + c * angularStep from
+    the upward midline (positive to the right, towards increasing x). By default the grid has one row per
+    pixel of depth and one column per pixel of arc at the outer radius, so no detail is lost.
+    '''
+
+    def __init__(self, outerRad, innerRad, FOV, imageHeight, imageWidth, center=None, depthSamples=None,
+                 angleSamples=None, useOpenCV=True):
+        center = GenerateFanMask.resolveCenter(imageHeight, imageWidth, center)
+        halfFOV = math.radians(FOV / 2.0)
+        depthSamples = depthSamples or int(math.ceil(outerRad - innerRad)) + 1
+        angleSamples = angleSamples or int(math.ceil(2 * halfFOV * outerRad)) + 1
+        self.polarShape = (depthSamples, angleSamples)
+        self.imageShape = (imageHeight, imageWidth)
+        self.radialStep = (outerRad - innerRad) / float(depthSamples - 1)
+        self.angularStep = 2 * halfFOV / float(angleSamples - 1)
+        cv2 = loadOpenCV() if useOpenCV else None
+        self.usesOpenCV = cv2 is not None
+
+        #Polar sample to image pixel
+        radius = innerRad + np.arange(depthSamples)[:, np.newaxis] * self.radialStep
+        angle = -halfFOV + np.arange(angleSamples)[np.newaxis, :] * self.angularStep
+        self.toPolar = RemapTable(center[0] + radius * np.sin(angle), center[1] - radius * np.cos(angle),
+                                  self.imageShape, cv2=cv2)
+
+        #Image pixel to polar sample, over the same fan as generateFanMask
+        distFromCenter, radsFromMidline = GenerateFanMask.polarGrid(imageHeight, imageWidth, center)
+        self.fanMask = GenerateFanMask.fanMaskFromPolarGrid(distFromCenter, radsFromMidline, outerRad, innerRad, FOV)
+        side = np.sign(np.arange(imageWidth) - center[0])[np.newaxis, :]
+        signedAngle = np.nan_to_num(radsFromMidline) * side
+        self.toCartesian = RemapTable((signedAngle + halfFOV) / self.angularStep, (distFromCenter - innerRad) / self.radialStep,
+                                      self.polarShape, valid=self.fanMask, cv2=cv2)
+
+    def imageToPolar(self, image, out):
+        return self.toPolar.apply(image, out)
+
+    def polarToImage(self, polar, out):
+        return self.toCartesian.apply(polar, out)
+
+
+class UltrasoundImageFormation:
+    '''
+    Adds shadowing, depth attenuation with time gain compensation, and speckle to uint8 fan images of the given
+    generateFanMask geometry (see the module docstring). Parameters, all changeable with setParameters:
+
+      attenuationDb: round trip attenuation at the outer radius, falling linearly to 0 dB at the inner radius
+      timeGainDb: TGC gains at evenly spaced depths from the inner to the outer radius, interpolated between
+      speckle: 0 (none) to 1 (fully developed) strength of the multiplicative speckle
+      shadowThreshold: intensity (0-255) above which a sample reflects
+      shadowStrength: attenuation (nepers) behind one sample of full intensity above the threshold
+    '''
+
+    def __init__(self, outerRad, innerRad, FOV, imageHeight, imageWidth, center=None, useOpenCV=True,
+                 speckleFrames=8, seed=0, **parameters):
+        self.scanConversion = ScanConversion(outerRad, innerRad, FOV, imageHeight, imageWidth, center, useOpenCV=useOpenCV)
+        self.polarShape = self.scanConversion.polarShape
+        self.speckleFrames = speckleFrames
+        self.rng = np.random.default_rng(seed)
+        self.attenuationDb = 12.0
+        self.timeGainDb = (0.0, 3.0, 6.0, 9.0)
+        self.speckle = 0.5
+        self.shadowThreshold = 200.0
+        self.shadowStrength = 0.15
+        self.setParameters(**parameters)
+
+        #Preallocated polar buffers
+        self.polarInput = np.zeros(self.polarShape, dtype=np.uint8)
+        self.polar = np.zeros(self.polarShape, dtype=np.float32)
+        self.excess = np.zeros(self.polarShape, dtype=np.float32)
+        self.shadow = np.zeros(self.polarShape, dtype=np.float32)
+        self.polarOutput = np.zeros(self.polarShape, dtype=np.uint8)
+        self.image = np.zeros(self.scanConversion.imageShape, dtype=np.uint8)
+        self.frameIndex = 0
+        self.lastPose = None
+
+    def setParameters(self, **parameters):
+        for name, value in parameters.items():
+            if name not in ("attenuationDb", "timeGainDb", "speckle", "shadowThreshold", "shadowStrength"):
+                raise ValueError("Unknown image formation parameter: {}".format(name))
+            setattr(self, name, value)
+
+        #Gain of each depth, as a column that broadcasts along the angles
+        depthFraction = np.linspace(0.0, 1.0, self.polarShape[0])
+        timeGainDb = np.interp(depthFraction, np.linspace(0.0, 1.0, len(self.timeGainDb)), self.timeGainDb)
+        self.depthGain = (10.0 ** ((timeGainDb - self.attenuationDb * depthFraction) / 20.0)).astype(np.float32)[:, np.newaxis]
+
+        #Rayleigh amplitudes with a mean of 1, mixed with 1 by the speckle strength
+        self.specklePatterns = None
+        if self.speckle > 0:
+            rayleigh = self.rng.rayleigh(math.sqrt(2.0 / math.pi), size=(self.speckleFrames,) + self.polarShape)
+            self.specklePatterns = (1.0 - self.speckle + self.speckle * rayleigh).astype(np.float32)
+
+    def apply(self, image, out=None, pose=None):
+        '''
+        Returns the formed image of the uint8 fan image (into out, which may be image itself, if given).
+        pose is the probe pose of the image; the speckle pattern only changes when it does. Without a pose
+        every call is taken to be a new view.
+        '''
+        if out is None:
+            out = self.image
+        self.scanConversion.imageToPolar(image, self.polarInput)
+        polar = self.polar
+        np.copyto(polar, self.polarInput)
+
+        if self.shadowStrength > 0:
+            #Cumulative reflection above each sample along its beam line
+            np.subtract(polar, self.shadowThreshold, out=self.excess)
+            np.maximum(self.excess, 0.0, out=self.excess)
+            #Nothing lies above row 0; it is reset as the exp below is taken in place
+            self.shadow[0] = 0.0
+            np.cumsum(self.excess[:-1], axis=0, out=self.shadow[1:])
+            np.multiply(self.shadow, -self.shadowStrength / max(255.0 - self.shadowThreshold, 1.0), out=self.shadow)
+            np.exp(self.shadow, out=self.shadow)
+            np.multiply(polar, self.shadow, out=polar)
+
+        np.multiply(polar, self.depthGain, out=polar)
+        if pose is None or self.lastPose is None or not np.array_equal(pose, self.lastPose):
+            self.frameIndex += 1
+            self.lastPose = None if pose is None else np.array(pose, copy=True)
+        if self.specklePatterns is not None:
+            np.multiply(polar, self.specklePatterns[self.frameIndex % len(self.specklePatterns)], out=polar)
+
+        np.clip(polar, 0.0, 255.0, out=polar)
+        np.copyto(self.polarOutput, polar, casting="unsafe")
+        return self.scanConversion.polarToImage(self.polarOutput, out)
+
+
+def imageFormationForMask(fanMask, minimumOverlap=0.95, **parameters):
+    '''
+    An UltrasoundImageFormation for the default probe geometry scaled to the size of fanMask (eg. the US mask
+    of the scene), or None if that geometry covers less than minimumOverlap of the mask (intersection over union).
+    '''
+    fanMask = np.asarray(fanMask, dtype=bool)
+    geometry = GenerateFanMask.scaledProbeGeometry(*fanMask.shape)
+    geometryMask = GenerateFanMask.fanMaskEngine.getMask(*geometry)
+    union = np.count_nonzero(fanMask | geometryMask)
+    if not union or np.count_nonzero(fanMask & geometryMask) < minimumOverlap * union:
+        return None
+    return UltrasoundImageFormation(*geometry, **parameters)
+
+
+def benchmarkImageFormation(frames=200, imageHeight=717, imageWidth=601):
+    '''
+    Frames per second of the image formation stage on slices of a synthetic volume at the simulated US size,
+    with and without OpenCV, and the polar grid size.
+    '''
+    from .SliceGenerator import UltrasoundSliceGenerator, syntheticVolume
+
+    geometry = GenerateFanMask.scaledProbeGeometry(imageHeight, imageWidth)
+    generator = UltrasoundSliceGenerator(GenerateFanMask.generateFanMask(*geometry), np.diag([0.25, 0.25, 1.0, 1.0]))
+    generator.setVolume(syntheticVolume((200, 200, 200)), np.eye(4))
+    maskToWorld = np.eye(4)
+    maskToWorld[:3, 3] = [50.0, 20.0, 100.0]
+    image = generator.generate(maskToWorld).copy()
+
+    results = {}
+    for name, useOpenCV in (("opencv", True), ("numpy", False)):
+        startTime = time.perf_counter()
+        formation = UltrasoundImageFormation(*geometry, useOpenCV=useOpenCV)
+        setupTime = time.perf_counter() - startTime
+        if useOpenCV and not formation.scanConversion.usesOpenCV:
+            continue
+        out = np.zeros_like(image)
+        startTime = time.perf_counter()
+        for frame in range(frames):
+            formation.apply(image, out)
+        elapsed = time.perf_counter() - startTime
+        results[name] = {"fps": frames / elapsed, "meanLatencyMs": 1000 * elapsed / frames, "setupSeconds": setupTime,
+                         "polarShape": formation.polarShape}
+    return results
+
+
+if __name__ == "__main__":
+    for name, result in benchmarkImageFormation().items():
+        print("{}: {fps:.1f} fps, mean {meanLatencyMs:.3f} ms, polar grid {polarShape}, tables in {setupSeconds:.3f} s".format(
+            name, **result))
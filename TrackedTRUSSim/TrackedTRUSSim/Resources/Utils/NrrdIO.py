@@ -0,0 +1,119 @@
+'''
+Minimal NRRD reader (attached header, raw or gzip encoding) that needs neither Slicer nor MRML, so case
+files can be decoded on worker threads. Returns arrays indexed [k, j, i] like VTK image data and the
+voxel (i, j, k) to RAS matrix.
+'''
+
+import gzip
+import re
+
+import numpy as np
+
+NRRD_TYPES = {
+    "signed char": "i1", "int8": "i1", "int8_t": "i1",
+    "uchar": "u1", "unsigned char": "u1", "uint8": "u1", "uint8_t": "u1",
+    "short": "i2", "short int": "i2", "signed short": "i2", "signed short int": "i2", "int16": "i2", "int16_t": "i2",
+    "ushort": "u2", "unsigned short": "u2", "unsigned short int": "u2", "uint16": "u2", "uint16_t": "u2",
+    "int": "i4", "signed int": "i4", "int32": "i4", "int32_t": "i4",
+    "uint": "u4", "unsigned int": "u4", "uint32": "u4", "uint32_t": "u4",
+    "longlong": "i8", "long long": "i8", "long long int": "i8", "int64": "i8", "int64_t": "i8",
+    "ulonglong": "u8", "unsigned long long": "u8", "unsigned long long int": "u8", "uint64": "u8", "uint64_t": "u8",
+    "float": "f4", "double": "f8",
+}
+
+#Anatomical spaces that differ from RAS by flipping the first axes
+SPACE_TO_RAS = {
+    "right-anterior-superior": np.diag([1.0, 1.0, 1.0, 1.0]),
+    "left-posterior-superior": np.diag([-1.0, -1.0, 1.0, 1.0]),
+    "left-anterior-superior": np.diag([-1.0, 1.0, 1.0, 1.0]),
+    "ras": np.diag([1.0, 1.0, 1.0, 1.0]),
+    "lps": np.diag([-1.0, -1.0, 1.0, 1.0]),
+    "las": np.diag([-1.0, 1.0, 1.0, 1.0]),
+}
+
+
+def readHeader(f):
+    '''
+    Reads the header lines of an open NRRD file. Returns (fields, keyValues); the file is left at the data.
+    '''
+    magic = f.readline().decode("ascii").strip()
+    if not magic.startswith("NRRD"):
+        raise ValueError("not a NRRD file")
+    fields, keyValues = {}, {}
+    for line in iter(f.readline, b""):
+        line = line.decode("utf-8").rstrip("\r\n")
+        if not line:
+            break
+        if line.startswith("#"):
+            continue
+        if ":=" in line:
+            key, value = line.split(":=", 1)
+            keyValues[key] = value
+        else:
+            key, value = line.split(":", 1)
+            fields[key.strip().lower()] = value.strip()
+    return fields, keyValues
+
+
+def parseVector(text):
+    return [float(value) for value in text.strip("()").split(",")]
+
+
+def ijkToRASFromHeader(fields):
+    '''
+    Voxel to RAS matrix from the space, space directions and space origin fields (identity if absent).
+    '''
+    ijkToSpace = np.eye(4)
+    if "space directions" in fields:
+        directions = [d for d in re.findall(r"\(([^)]*)\)|none", fields["space directions"])]
+        #'none' entries belong to non-spatial axes (eg. segmentation layers) and come out as empty strings
+        spatial = [d for d in directions if d]
+        for axis, direction in enumerate(spatial[:3]):
+            ijkToSpace[:3, axis] = parseVector(direction)
+    if "space origin" in fields:
+        ijkToSpace[:3, 3] = parseVector(fields["space origin"])
+    spaceToRAS = SPACE_TO_RAS.get(fields.get("space", "right-anterior-superior").lower())
+    if spaceToRAS is None:
+        raise ValueError("unsupported space " + fields["space"])
+    return spaceToRAS @ ijkToSpace
+
+
+def readInto(f, buffer):
+    view = memoryview(buffer).cast("B")
+    offset = 0
+    while offset < len(view):
+        count = f.readinto(view[offset:])
+        if not count:
+            raise ValueError("NRRD data is shorter than its header says")
+        offset += count
+
+
+def readNrrd(path):
+    '''
+    Returns (array [k, j, i], ijkToRAS, keyValues). Detached headers and encodings other than raw and gzip
+    raise ValueError, so callers can fall back to the Slicer loaders.
+    '''
+    with open(path, "rb") as f:
+        fields, keyValues = readHeader(f)
+        if "data file" in fields or "datafile" in fields:
+            raise ValueError("detached NRRD data is not supported")
+        typeName = fields["type"].lower()
+        if typeName not in NRRD_TYPES:
+            raise ValueError("unsupported NRRD type " + typeName)
+        dtype = np.dtype(NRRD_TYPES[typeName])
+        if dtype.itemsize > 1:
+            dtype = dtype.newbyteorder("<" if fields.get("endian", "little") == "little" else ">")
+
+        #NRRD lists the fastest axis first; read straight into the (writable) output array
+        sizes = [int(size) for size in fields["sizes"].split()]
+        array = np.empty(sizes[::-1], dtype=dtype)
+        encoding = fields.get("encoding", "raw").lower()
+        if encoding in ("gzip", "gz"):
+            with gzip.GzipFile(fileobj=f) as data:
+                readInto(data, array)
+        elif encoding == "raw":
+            readInto(f, array)
+        else:
+            raise ValueError("unsupported NRRD encoding " + encoding)
+
+    return array.astype(dtype.newbyteorder("="), copy=False), ijkToRASFromHeader(fields), keyValues
@@ -0,0 +1,341 @@
+'''
+Batch analytics over saved training sessions (the scenes and session files under UserData/<user>/),
+without Slicer.
+
+Each scene is streamed through an XML parser that keeps only the attributes of the nodes it needs: the
+case node, its linear transforms and their storage file names. Cores come from the biopsy ledger of the
+case node, or from the per-core BiopsyModelToReference transforms of older scenes. Sessions are analysed
+on a process pool; every worker loads the zone sampling index of a case once and reuses it.
+
+The result is one .npz of columns: "sessions.<column>" with one row per scene, and "users.<column>" and
+"cases.<column>" with the sessions aggregated per user and per case. From the Resources directory:
+
+  python -m Utils.SessionAnalytics UserData -o SessionAnalytics.npz
+'''
+
+import argparse
+import glob
+import json
+import os
+import re
+import time
+import xml.etree.ElementTree as ElementTree
+import zipfile
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+from .AssetBundle import readBundleTransforms
+from .BiopsyLedger import BiopsyLedger
+from .SessionFile import SESSION_EXTENSION, loadSession
+from .SimulationCore import DEFAULT_CORE_SEGMENT, TARGET_ZONE, coreSegmentFromBounds, scoreCores
+from .ZoneIndex import ZONES, ZoneSamplingIndex
+
+CASE_NODE_NAME = "TrackedTRUSSim_case"
+BIOPSY_LEDGER = "BiopsyLedger"
+BIOPSY_TRANSFORM_ROLES = "BiopsyTransformRoles"
+BIOPSY_TRANSFORM_PREFIX = "BiopsyModelToReference_"
+TRUS_TO_CYLINDER = "TRUSToCylinder"
+#TRUSToCylinder and its parents in the base scene, from the zones up to RAS
+ZONES_TO_RAS_CHAIN = (TRUS_TO_CYLINDER, "CylinderToBox", "BoxModelToReference", "ReferenceToRAS")
+
+SESSION_COLUMNS = ("path", "user", "case", "cores", "coresWithZones", "outsideCores") + \
+    tuple("hits" + zone for zone in ZONES[1:]) + ("spread", "nearestCore", "duration", "error")
+
+
+class SessionScene:
+    '''
+    What readSession keeps of a scene: the case number (0 if unknown), the core poses, fire times, depths and
+    zone fractions (NaN where not recorded), and the zones to RAS matrix (None if a parent transform is missing).
+    '''
+
+    def __init__(self, caseNumber, ledger, zonesToRAS):
+        self.caseNumber = caseNumber
+        self.ledger = ledger
+        self.zonesToRAS = zonesToRAS
+
+
+def parseMatrix(text):
+    return np.array(text.split(), dtype=float).reshape(4, 4)
+
+
+def parseReferences(text):
+    '''
+    {role: node ID} from a MRML references attribute ("role:ID;role:ID;").
+    '''
+    references = {}
+    for reference in text.split(";"):
+        if ":" in reference:
+            role, nodeID = reference.split(":", 1)
+            references.setdefault(role, nodeID)
+    return references
+
+
+def parseParameters(attributes):
+    '''
+    {name: value} from the parameter0, parameter1, ... attributes of a scripted module node.
+    '''
+    parameters = {}
+    for key, value in attributes.items():
+        if key.startswith("parameter"):
+            name, _, value = value.strip().partition(" ")
+            parameters[name] = value
+    return parameters
+
+
+def caseNumberFromPath(path):
+    match = re.search(r"Patient_(\d+)", path) or re.search(r"Case-?(\d+)", os.path.basename(path))
+    return int(match.group(1)) if match else 0
+
+
+def matrixToRAS(nodeID, transforms, staticTransforms, chain):
+    '''
+    Product of the transform nodeID and its parents. A parent that was not saved with the scene is taken by
+    name from staticTransforms, following chain; returns None if it is not there either.
+    '''
+    name, matrix, parentID = transforms[nodeID]
+    while parentID in transforms:
+        name, parentMatrix, parentID = transforms[parentID]
+        matrix = parentMatrix @ matrix
+    if not parentID:
+        return matrix
+    return staticMatrixToRAS(matrix, name, staticTransforms, chain)
+
+
+def staticMatrixToRAS(matrix, name, staticTransforms, chain):
+    '''
+    matrix (of the transform name) composed with the parents that follow name in chain, from staticTransforms.
+    '''
+    if name not in chain:
+        return None
+    for parentName in chain[chain.index(name) + 1:]:
+        if parentName not in staticTransforms:
+            return None
+        matrix = staticTransforms[parentName] @ matrix
+    return matrix
+
+
+def readSession(path, staticTransforms=None):
+    '''
+    Streams the scene at path into a SessionScene. staticTransforms ({name: matrix to parent}) stands in for
+    base scene transforms that were not saved with it.
+    '''
+    transforms = {}
+    storageIDs = {}
+    storageFileNames = {}
+    caseNodes = []
+    for _, element in ElementTree.iterparse(path):
+        attributes = element.attrib
+        if element.tag == "LinearTransform" and "matrixTransformToParent" in attributes:
+            references = parseReferences(attributes.get("references", ""))
+            transforms[attributes["id"]] = (attributes.get("name", ""), parseMatrix(attributes["matrixTransformToParent"]),
+                                            references.get("transform"))
+            storageIDs[attributes["id"]] = references.get("storage")
+        elif element.tag.endswith("Storage") and "fileName" in attributes:
+            storageFileNames[attributes["id"]] = attributes["fileName"]
+        elif element.tag == "ScriptedModule" and attributes.get("name") == CASE_NODE_NAME:
+            caseNodes.append((parseReferences(attributes.get("references", "")), parseParameters(attributes)))
+        element.clear()
+
+    #Scenes can hold several case nodes from reloading cases; the one with cores, otherwise the last with a case
+    caseNode = ({}, {})
+    for references, parameters in caseNodes:
+        if TRUS_TO_CYLINDER in references:
+            caseNode = (references, parameters)
+    for references, parameters in caseNodes:
+        if BIOPSY_LEDGER in parameters or any(role.startswith(BIOPSY_TRANSFORM_PREFIX) for role in references):
+            caseNode = (references, parameters)
+            break
+    references, parameters = caseNode
+
+    caseNumber = 0
+    zonesToRAS = None
+    trusToCylinderID = references.get(TRUS_TO_CYLINDER)
+    if trusToCylinderID in transforms:
+        caseNumber = caseNumberFromPath(storageFileNames.get(storageIDs[trusToCylinderID], ""))
+        zonesToRAS = matrixToRAS(trusToCylinderID, transforms, staticTransforms or {}, ZONES_TO_RAS_CHAIN)
+    if not caseNumber:
+        caseNumber = caseNumberFromPath(path)
+
+    if BIOPSY_LEDGER in parameters:
+        ledger = BiopsyLedger.fromString(parameters[BIOPSY_LEDGER])
+    else:
+        ledger = BiopsyLedger()
+        roles = json.loads(parameters[BIOPSY_TRANSFORM_ROLES]) if BIOPSY_TRANSFORM_ROLES in parameters else \
+            sorted((role for role in references if role.startswith(BIOPSY_TRANSFORM_PREFIX)),
+                   key=lambda role: int(role[len(BIOPSY_TRANSFORM_PREFIX):]))
+        for role in roles:
+            pose = matrixToRAS(references[role], transforms, {}, ()) if references.get(role) in transforms else None
+            if pose is not None:
+                ledger.append(pose, timestamp=np.nan)
+    return SessionScene(caseNumber, ledger, zonesToRAS)
+
+
+def readSessionFile(path, staticTransforms=None):
+    '''
+    A SessionScene from a compact session file, whose case pose is TRUSToCylinder alone.
+    '''
+    session = loadSession(path)
+    zonesToRAS = None
+    if session.trusToCylinder is not None:
+        zonesToRAS = staticMatrixToRAS(session.trusToCylinder, TRUS_TO_CYLINDER, staticTransforms or {}, ZONES_TO_RAS_CHAIN)
+    return SessionScene(session.caseNumber, session.ledger, zonesToRAS)
+
+
+def coreSegmentFromModel(modelPath):
+    '''
+    The two ends of the biopsy core (the axis of the biopsy model) in biopsy model coordinates.
+    '''
+    import vtk
+    reader = vtk.vtkPolyDataReader()
+    reader.SetFileName(modelPath)
+    reader.Update()
+    return coreSegmentFromBounds(reader.GetOutput().GetBounds())
+
+
+#Per worker process state, set by initializeWorker
+workerContext = {}
+
+
+def initializeWorker(registeredZonesDirectory, staticTransforms, coreSegment):
+    workerContext.clear()
+    workerContext.update(registeredZonesDirectory=registeredZonesDirectory, staticTransforms=staticTransforms,
+                         coreSegment=coreSegment, zoneIndexes={})
+
+
+def getZoneIndex(caseNumber):
+    zoneIndexes = workerContext["zoneIndexes"]
+    if caseNumber not in zoneIndexes:
+        zonePath = os.path.join(workerContext["registeredZonesDirectory"], "Patient_{}".format(caseNumber), "Zones.seg.nrrd")
+        zoneIndexes[caseNumber] = ZoneSamplingIndex.fromSegmentationFile(zonePath) if os.path.exists(zonePath) else None
+    return zoneIndexes[caseNumber]
+
+
+def analyzeSession(path, user):
+    '''
+    One row of the sessions table for the scene at path.
+    '''
+    row = dict.fromkeys(SESSION_COLUMNS, np.nan)
+    row.update(path=path, user=user, case=0, cores=0, coresWithZones=0, outsideCores=0, error="")
+    try:
+        readScene = readSessionFile if path.endswith(SESSION_EXTENSION) else readSession
+        session = readScene(path, workerContext["staticTransforms"])
+    except (ElementTree.ParseError, zipfile.BadZipFile, ValueError, KeyError, OSError) as e:
+        row["error"] = "{}: {}".format(type(e).__name__, e)
+        return row
+    ledger = session.ledger
+    row.update(case=session.caseNumber, cores=len(ledger))
+    if not len(ledger):
+        return row
+
+    #The case's zones are only loaded when some core was fired without its zones recorded
+    unknown = np.isnan(ledger.zoneFractions).any(axis=1)
+    zoneIndex = getZoneIndex(session.caseNumber) if unknown.any() and session.zonesToRAS is not None else None
+    if zoneIndex is not None:
+        zoneIndex.setZonesToWorld(session.zonesToRAS)
+    row.update(scoreCores(ledger, workerContext["coreSegment"], zoneIndex))
+    return row
+
+
+def analyzeSessionTask(task):
+    return analyzeSession(*task)
+
+
+def findSessions(userDataDirectory):
+    '''
+    (path, user) of every scene and session file under userDataDirectory; the user is the first directory below it.
+    '''
+    sessions = []
+    paths = []
+    for extension in (".mrml", SESSION_EXTENSION):
+        paths += glob.glob(os.path.join(userDataDirectory, "**", "*" + extension), recursive=True)
+    for path in sorted(paths):
+        relativeParts = os.path.relpath(path, userDataDirectory).split(os.sep)
+        sessions.append((path, relativeParts[0] if len(relativeParts) > 1 else ""))
+    return sessions
+
+
+def aggregateSessions(columns, key):
+    '''
+    One row per distinct value of columns[key]: session and core counts, hits in TARGET_ZONE per core with
+    known zones, and the mean spread of the sessions with cores.
+    '''
+    keys = columns[key]
+    groups = np.unique(keys)
+    table = {key: groups, "sessions": [], "cores": [], "coresPerSession": [], "targetHitRate": [], "meanSpread": []}
+    for group in groups:
+        rows = keys == group
+        cores = columns["cores"][rows].sum()
+        coresWithZones = columns["coresWithZones"][rows].sum()
+        spreads = columns["spread"][rows]
+        table["sessions"].append(int(rows.sum()))
+        table["cores"].append(int(cores))
+        table["coresPerSession"].append(cores / float(rows.sum()))
+        table["targetHitRate"].append(np.nansum(columns["hits" + TARGET_ZONE][rows]) / coresWithZones if coresWithZones else np.nan)
+        table["meanSpread"].append(float(spreads[np.isfinite(spreads)].mean()) if np.isfinite(spreads).any() else np.nan)
+    return {name: np.asarray(values) for name, values in table.items()}
+
+
+def analyzeSessions(sessions, registeredZonesDirectory, staticTransforms=None, coreSegment=DEFAULT_CORE_SEGMENT,
+                    maxWorkers=None):
+    '''
+    Runs analyzeSession over (path, user) pairs on a process pool and returns {table: {column: array}}
+    for the "sessions", "users" and "cases" tables.
+    '''
+    initializerArguments = (registeredZonesDirectory, staticTransforms or {}, coreSegment)
+    if maxWorkers == 1 or len(sessions) < 2:
+        initializeWorker(*initializerArguments)
+        rows = [analyzeSession(path, user) for path, user in sessions]
+    else:
+        workers = maxWorkers or os.cpu_count() or 1
+        #A few chunks per worker: large enough to amortize the transfers, small enough to balance the load
+        chunkSize = max(1, len(sessions) // (4 * workers))
+        with ProcessPoolExecutor(workers, initializer=initializeWorker, initargs=initializerArguments) as executor:
+            rows = list(executor.map(analyzeSessionTask, sessions, chunksize=chunkSize))
+
+    columns = {column: np.asarray([row[column] for row in rows]) for column in SESSION_COLUMNS}
+    return {"sessions": columns, "users": aggregateSessions(columns, "user"), "cases": aggregateSessions(columns, "case")}
+
+
+def writeTables(path, tables):
+    np.savez(path, **{"{}.{}".format(table, column): values
+                      for table, columns in tables.items() for column, values in columns.items()})
+
+
+def readTables(path):
+    tables = {}
+    with np.load(path) as stored:
+        for name in stored.files:
+            table, column = name.split(".", 1)
+            tables.setdefault(table, {})[column] = stored[name]
+    return tables
+
+
+if __name__ == "__main__":
+    resourceDir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    parser = argparse.ArgumentParser(description="Per session, user and case metrics of saved training sessions.")
+    parser.add_argument("userData", nargs="?", default=os.path.join(resourceDir, "UserData"))
+    parser.add_argument("-o", "--output", default="SessionAnalytics.npz")
+    parser.add_argument("-j", "--workers", type=int, default=None)
+    parser.add_argument("--repeat", type=int, default=1, help="analyse every session this many times, for timing")
+    arguments = parser.parse_args()
+
+    bundlePath = os.path.join(resourceDir, "BaseScene.bundle.npz")
+    staticTransforms = readBundleTransforms(bundlePath) if os.path.exists(bundlePath) else {}
+    coreSegment = coreSegmentFromModel(os.path.join(resourceDir, "models", "BiopsyModel.vtk"))
+    sessions = findSessions(arguments.userData) * arguments.repeat
+
+    startTime = time.perf_counter()
+    tables = analyzeSessions(sessions, os.path.join(resourceDir, "registered_zones"), staticTransforms, coreSegment,
+                             arguments.workers)
+    elapsed = time.perf_counter() - startTime
+    writeTables(arguments.output, tables)
+
+    sessionColumns = tables["sessions"]
+    for index in range(len(sessionColumns["path"]) // arguments.repeat):
+        print("{} case {}: {} cores, {} in {}, spread {:.1f} mm{}".format(
+            os.path.relpath(sessionColumns["path"][index], arguments.userData), sessionColumns["case"][index],
+            sessionColumns["cores"][index], sessionColumns["hits" + TARGET_ZONE][index], TARGET_ZONE,
+            sessionColumns["spread"][index], " ({})".format(sessionColumns["error"][index]) if sessionColumns["error"][index] else ""))
+    print("{} sessions in {:.2f} s ({:.0f} per second) -> {}".format(len(sessions), elapsed, len(sessions) / elapsed,
+                                                                     arguments.output))
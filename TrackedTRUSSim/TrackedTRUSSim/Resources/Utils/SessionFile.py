@@ -0,0 +1,111 @@
+'''
+Compact session files: who trained on which case, the biopsy ledger and optionally a pose track, in one
+small uncompressed .npz. The case itself (TRUS volume, zones) is not stored; loading a session sets the
+case up again, which the case cache and prefetcher usually serve without reading any volume.
+'''
+
+import json
+import os
+import time
+
+import numpy as np
+
+from .ArrayUtils import atomicSaveNpz
+from .BiopsyLedger import BiopsyLedger
+from .ZoneIndex import ZONES
+
+SESSION_VERSION = 1
+SESSION_EXTENSION = ".trussession"
+
+
+class Session:
+    '''
+    user and caseNumber identify the session, ledger holds the fired cores and trusToCylinder the case pose
+    (None to use the case's registration). poseTrack is {transform name: (timestamps N, poses N x 4 x 4)}.
+    '''
+
+    def __init__(self, user, caseNumber, ledger, trusToCylinder=None, poseTrack=None, created=None):
+        self.user = user
+        self.caseNumber = caseNumber
+        self.ledger = ledger
+        self.trusToCylinder = trusToCylinder
+        self.poseTrack = poseTrack or {}
+        self.created = time.time() if created is None else created
+
+
+def saveSession(path, session):
+    '''
+    Writes the session next to path first and moves it into place, so a session file is never half written.
+    '''
+    manifest = {"version": SESSION_VERSION, "user": session.user, "caseNumber": session.caseNumber,
+                "created": session.created, "zones": list(ZONES), "poseTrack": sorted(session.poseTrack)}
+    ledger = session.ledger
+    arrays = {"manifest": np.frombuffer(json.dumps(manifest).encode("utf-8"), dtype=np.uint8),
+              "poses": ledger.poses, "timestamps": ledger.timestamps, "depths": ledger.depths,
+              "zoneFractions": ledger.zoneFractions}
+    if session.trusToCylinder is not None:
+        arrays["trusToCylinder"] = np.asarray(session.trusToCylinder, dtype=float)
+    for name, (timestamps, poses) in session.poseTrack.items():
+        arrays["trackTimestamps_" + name] = np.asarray(timestamps, dtype=float)
+        arrays["trackPoses_" + name] = np.asarray(poses, dtype=float).reshape(-1, 4, 4)
+
+    atomicSaveNpz(path, **arrays)
+
+
+def loadSession(path):
+    with np.load(path) as stored:
+        manifest = json.loads(stored["manifest"].tobytes().decode("utf-8"))
+        if manifest.get("version") != SESSION_VERSION:
+            raise ValueError("session version {} != {}".format(manifest.get("version"), SESSION_VERSION))
+        ledger = BiopsyLedger.fromArrays(stored["poses"], stored["timestamps"], stored["depths"], stored["zoneFractions"],
+                                         manifest["zones"])
+        trusToCylinder = stored["trusToCylinder"] if "trusToCylinder" in stored.files else None
+        poseTrack = {name: (stored["trackTimestamps_" + name], stored["trackPoses_" + name])
+                     for name in manifest["poseTrack"]}
+    return Session(manifest["user"], manifest["caseNumber"], ledger, trusToCylinder, poseTrack, manifest["created"])
+
+
+def randomSession(cores, trackLength=0, seed=0):
+    '''
+    A session with random core poses, zones and (if trackLength) a ProbeToPhantom track, for benchmarks.
+    '''
+    rng = np.random.default_rng(seed)
+    ledger = BiopsyLedger()
+    for index in range(cores):
+        pose = np.eye(4)
+        pose[:3, :3] = np.linalg.qr(rng.normal(size=(3, 3)))[0]
+        pose[:3, 3] = rng.uniform(-20, 20, size=3)
+        ledger.append(pose, 1000.0 + index, rng.uniform(0, 20), rng.dirichlet(np.ones(len(ZONES))))
+    poseTrack = {}
+    if trackLength:
+        poses = np.tile(np.eye(4), (trackLength, 1, 1))
+        poses[:, :3, 3] = np.cumsum(rng.normal(size=(trackLength, 3)), axis=0)
+        poseTrack["ProbeToPhantom"] = (1000.0 + np.arange(trackLength) / 30.0, poses)
+    return Session("Benchmark", 1, ledger, np.eye(4), poseTrack)
+
+
+def benchmarkSessionFile(path, coreCounts=(10, 100, 1000), repeats=20):
+    '''
+    {cores: (save ms, load ms, file bytes)} for sessions of random cores written to path.
+    '''
+    results = {}
+    for cores in coreCounts:
+        session = randomSession(cores)
+        startTime = time.perf_counter()
+        for repeat in range(repeats):
+            saveSession(path, session)
+        saveTime = 1000 * (time.perf_counter() - startTime) / repeats
+        startTime = time.perf_counter()
+        for repeat in range(repeats):
+            loadSession(path)
+        loadTime = 1000 * (time.perf_counter() - startTime) / repeats
+        results[cores] = (saveTime, loadTime, os.path.getsize(path))
+    os.remove(path)
+    return results
+
+
+if __name__ == "__main__":
+    import tempfile
+    benchmarkPath = os.path.join(tempfile.gettempdir(), "Benchmark" + SESSION_EXTENSION)
+    for cores, (saveTime, loadTime, size) in benchmarkSessionFile(benchmarkPath).items():
+        print("{:5d} cores: save {:.2f} ms, load {:.2f} ms, {} bytes".format(cores, saveTime, loadTime, size))
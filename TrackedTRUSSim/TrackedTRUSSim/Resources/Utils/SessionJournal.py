@@ -0,0 +1,252 @@
+'''
+Append-only journal of a training session, so that a crash or a closed window loses at most the last
+unsynced events.
+
+The file is a 512 byte JSON header followed by fixed size binary records (RECORD_DTYPE): case selection,
+fired cores, needle depth changes, saves, loaded sessions and optionally decimated probe poses. Appending writes one record
+and fsyncs only every syncEvery records or syncInterval seconds, so an event costs the same at any session
+length. Each record carries a CRC32; replay stops at the first torn or corrupt record.
+'''
+
+import json
+import os
+import time
+import zlib
+
+import numpy as np
+
+from .BiopsyLedger import BiopsyLedger
+from .ZoneIndex import ZONES
+
+JOURNAL_VERSION = 1
+JOURNAL_EXTENSION = ".trusjournal"
+JOURNAL_MAGIC = b"TRUSJRNL"
+HEADER_SIZE = 512
+
+CASE_SELECTED = 1
+BIOPSY_FIRED = 2
+DEPTH_CHANGED = 3
+PROBE_POSE = 4
+SESSION_SAVED = 5
+SESSION_LOADED = 6
+
+#values holds the needle depth followed by the fraction of the core in each of the ZONES
+VALUE_COUNT = 1 + len(ZONES)
+RECORD_DTYPE = np.dtype([("timestamp", "<f8"), ("type", "<u4"), ("caseNumber", "<i4"), ("values", "<f8", (VALUE_COUNT,)),
+                         ("pose", "<f8", (4, 4)), ("checksum", "<u4"), ("reserved", "<u4")])
+CHECKED_BYTES = RECORD_DTYPE.fields["checksum"][1]
+
+
+def readHeader(f):
+    '''
+    The header of an open journal as a dict; the file is left at the first record.
+    '''
+    header = f.read(HEADER_SIZE)
+    if len(header) != HEADER_SIZE or not header.startswith(JOURNAL_MAGIC):
+        raise ValueError("not a session journal")
+    manifest = json.loads(header[len(JOURNAL_MAGIC):].rstrip(b"\0").decode("utf-8"))
+    if manifest.get("version") != JOURNAL_VERSION or manifest.get("recordSize") != RECORD_DTYPE.itemsize:
+        raise ValueError("journal version {} != {}".format(manifest.get("version"), JOURNAL_VERSION))
+    return manifest
+
+
+class JournalWriter:
+    '''
+    Appends records to the journal at path, creating it with a header for user, or continuing an existing
+    journal after its last valid record.
+    '''
+
+    def __init__(self, path, user="", syncEvery=32, syncInterval=1.0, poseInterval=0.1):
+        self.path = path
+        self.syncEvery = syncEvery
+        self.syncInterval = syncInterval
+        self.poseInterval = poseInterval
+        self.lastPoseTime = -np.inf
+        self.record = np.zeros(1, dtype=RECORD_DTYPE)
+        self.recordBytes = self.record.view(np.uint8)
+        self.recordCount = 0
+        self.lastEventType = None
+        self.unsyncedCount = 0
+        self.syncCount = 0
+
+        if os.path.exists(path):
+            with open(path, "rb") as f:
+                self.manifest = readHeader(f)
+            records, self.recordCount = readRecords(path)
+            if self.recordCount:
+                self.lastEventType = int(records["type"][-1])
+            self.file = open(path, "r+b")
+            #Drop a torn or corrupt tail so that new records follow the last valid one
+            self.file.truncate(HEADER_SIZE + self.recordCount * RECORD_DTYPE.itemsize)
+            self.file.seek(0, os.SEEK_END)
+        else:
+            self.manifest = {"version": JOURNAL_VERSION, "recordSize": RECORD_DTYPE.itemsize, "user": user,
+                             "created": time.time(), "zones": list(ZONES)}
+            header = JOURNAL_MAGIC + json.dumps(self.manifest).encode("utf-8")
+            if len(header) > HEADER_SIZE:
+                raise ValueError("journal header too long")
+            self.file = open(path, "wb")
+            self.file.write(header.ljust(HEADER_SIZE, b"\0"))
+            self.sync()
+        self.lastSyncTime = time.monotonic()
+
+    def append(self, eventType, caseNumber=0, values=None, pose=None, timestamp=None):
+        record = self.record[0]
+        record["timestamp"] = time.time() if timestamp is None else timestamp
+        record["type"] = eventType
+        record["caseNumber"] = caseNumber
+        record["values"] = np.nan if values is None else values
+        record["pose"] = np.eye(4) if pose is None else pose
+        record["checksum"] = zlib.crc32(self.recordBytes[:CHECKED_BYTES])
+        self.file.write(self.recordBytes)
+        #Hand the record to the OS on every event; only the fsync to the disk is batched
+        self.file.flush()
+        self.recordCount += 1
+        self.lastEventType = eventType
+        self.unsyncedCount += 1
+        if self.unsyncedCount >= self.syncEvery or time.monotonic() - self.lastSyncTime >= self.syncInterval:
+            self.sync()
+
+    def caseSelected(self, caseNumber):
+        self.append(CASE_SELECTED, caseNumber)
+        self.sync()
+
+    def biopsyFired(self, caseNumber, pose, depth, zoneFractions=None, timestamp=None):
+        values = np.full(VALUE_COUNT, np.nan)
+        values[0] = depth
+        if zoneFractions is not None:
+            values[1:] = zoneFractions
+        self.append(BIOPSY_FIRED, caseNumber, values, pose, timestamp)
+
+    def depthChanged(self, caseNumber, depth):
+        self.append(DEPTH_CHANGED, caseNumber, [depth] + [np.nan] * (VALUE_COUNT - 1))
+
+    def probePose(self, caseNumber, pose):
+        '''
+        Records the probe pose unless one was recorded less than poseInterval seconds ago.
+        '''
+        now = time.monotonic()
+        if now - self.lastPoseTime >= self.poseInterval:
+            self.lastPoseTime = now
+            self.append(PROBE_POSE, caseNumber, pose=pose)
+
+    def sessionSaved(self, caseNumber):
+        self.append(SESSION_SAVED, caseNumber)
+        self.sync()
+
+    def sessionLoaded(self, caseNumber, ledger):
+        '''
+        Records that a loaded session replaced the fired cores: a snapshot of its case and of every core of
+        ledger, which replay starts from instead of the cores recorded before it.
+        '''
+        self.append(SESSION_LOADED, caseNumber)
+        self.append(CASE_SELECTED, caseNumber)
+        for pose, timestamp, depth, zoneFractions in zip(ledger.poses, ledger.timestamps, ledger.depths,
+                                                         ledger.zoneFractions):
+            self.biopsyFired(caseNumber, pose, depth, zoneFractions, timestamp)
+        self.sync()
+
+    def sync(self):
+        self.file.flush()
+        os.fsync(self.file.fileno())
+        self.unsyncedCount = 0
+        self.lastSyncTime = time.monotonic()
+        self.syncCount += 1
+
+    def close(self):
+        if not self.file.closed:
+            self.sync()
+            self.file.close()
+
+
+def readRecords(path):
+    '''
+    (records, count of valid records) of a journal. Records after the first incomplete or corrupt one are dropped.
+    '''
+    with open(path, "rb") as f:
+        readHeader(f)
+        data = f.read()
+    records = np.frombuffer(data[:len(data) - len(data) % RECORD_DTYPE.itemsize], dtype=RECORD_DTYPE)
+    recordBytes = records.view(np.uint8).reshape(len(records), RECORD_DTYPE.itemsize)
+    for index in range(len(records)):
+        if zlib.crc32(recordBytes[index, :CHECKED_BYTES]) != records["checksum"][index]:
+            return records[:index], index
+    return records, len(records)
+
+
+class JournalState:
+    '''
+    The session as rebuilt by replayJournal: the last selected case, the fired cores, the needle depth, the
+    recorded probe poses (timestamps, N x 4 x 4), whether the session ended with a save, and the record count.
+    '''
+
+    def __init__(self, user, caseNumber, ledger, depth, probeTimestamps, probePoses, saved, recordCount):
+        self.user = user
+        self.caseNumber = caseNumber
+        self.ledger = ledger
+        self.depth = depth
+        self.probeTimestamps = probeTimestamps
+        self.probePoses = probePoses
+        self.saved = saved
+        self.recordCount = recordCount
+
+
+def replayJournal(path):
+    with open(path, "rb") as f:
+        manifest = readHeader(f)
+    records, count = readRecords(path)
+    types = records["type"]
+
+    caseRecords = records[types == CASE_SELECTED]
+    caseNumber = int(caseRecords["caseNumber"][-1]) if len(caseRecords) else 0
+    depthRecords = records[(types == DEPTH_CHANGED) | (types == BIOPSY_FIRED) | (types == CASE_SELECTED)]
+    #Firing the needle and selecting a case move it back to 0
+    depth = float(depthRecords["values"][-1, 0]) if len(depthRecords) and depthRecords["type"][-1] == DEPTH_CHANGED else 0.0
+
+    #Cores fired before the last loaded session were replaced by it
+    loaded = np.flatnonzero(types == SESSION_LOADED)
+    fired = records[(types == BIOPSY_FIRED) & (np.arange(count) > (loaded[-1] if len(loaded) else -1))]
+    ledger = BiopsyLedger.fromArrays(fired["pose"], fired["timestamp"], fired["values"][:, 0], fired["values"][:, 1:],
+                                     manifest["zones"])
+    probe = records[types == PROBE_POSE]
+    saved = count > 0 and types[-1] == SESSION_SAVED
+    return JournalState(manifest["user"], caseNumber, ledger, depth, probe["timestamp"].copy(), probe["pose"].copy(),
+                        saved, count)
+
+
+def benchmarkJournal(path, events=(100, 1000, 10000, 100000)):
+    '''
+    Mean append time in microseconds after the journal holds each number of events, and the replay time in ms.
+    '''
+    if os.path.exists(path):
+        os.remove(path)
+    writer = JournalWriter(path, "Benchmark")
+    rng = np.random.default_rng(0)
+    pose = np.eye(4)
+    results = {}
+    written = 0
+    for target in events:
+        blockSize = min(1000, target - written)
+        while written < target - blockSize:
+            writer.depthChanged(1, rng.uniform(0, 20))
+            written += 1
+        startTime = time.perf_counter()
+        for index in range(blockSize):
+            writer.biopsyFired(1, pose, rng.uniform(0, 20))
+        appendTime = 1e6 * (time.perf_counter() - startTime) / blockSize
+        written += blockSize
+        results[target] = appendTime
+    writer.close()
+    startTime = time.perf_counter()
+    state = replayJournal(path)
+    replayTime = 1000 * (time.perf_counter() - startTime)
+    os.remove(path)
+    return results, replayTime, state.recordCount
+
+
+if __name__ == "__main__":
+    import tempfile
+    appendTimes, replayTime, recordCount = benchmarkJournal(os.path.join(tempfile.gettempdir(), "Benchmark" + JOURNAL_EXTENSION))
+    for events, appendTime in appendTimes.items():
+        print("{:6d} events: {:.1f} us per append".format(events, appendTime))
+    print("replayed {} records in {:.1f} ms".format(recordCount, replayTime))
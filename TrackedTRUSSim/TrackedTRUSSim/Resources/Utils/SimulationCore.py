@@ -0,0 +1,253 @@
+'''
+The simulation without Slicer: the transform chain from the tracked poses to the probe, US mask, needle and
+pointer frames, the simulated US frame, the biopsy ledger and the scoring of the cores against the zones.
+It depends on numpy and VTK only, so batch servers and worker processes can import it directly.
+
+The module's logic is an adapter over SimulationCore: it reads the matrices to parent from the MRML transform
+nodes, puts the case's TRUS volume and zones in, and draws what the core computes. HeadlessPipeline drives
+the same core from a dictionary of matrices.
+'''
+
+import time
+
+import numpy as np
+
+from .BiopsyLedger import BiopsyLedger
+from .TransformUtils import TransformChainCache
+from .ZoneIndex import ZONES
+
+#Transform names, the same as the transform nodes of the module's scene
+REFERENCE_TO_RAS = "ReferenceToRAS"
+PHANTOM_TO_REFERENCE = "PhantomToReference"
+PROBE_TO_PHANTOM = "ProbeToPhantom"
+PROBETIP_TO_PROBE = "ProbeTipToProbe"
+PROBEMODEL_TO_PROBETIP = "ProbeModelToProbeTip"
+USMASK_TO_PROBEMODEL = "USMaskToProbeModel"
+USSIMVOLUME_TO_USMASK = "USSimVolumeToUSMask"
+BIOPSYTRAJECTORY_TO_PROBEMODEL = "BiopsyTrajectoryToProbeModel"
+BIOPSYMODEL_TO_BIOPSYTRAJECTORY = "BiopsyModelToBiopsyTrajectory"
+POINTER_TO_PHANTOM = "PointerToPhantom"
+POINTERTIP_TO_POINTER = "PointerTipToPointer"
+
+#The tracked poses; every other link is a calibration that changes only when the user edits it
+DYNAMIC_LINKS = (PROBE_TO_PHANTOM, POINTER_TO_PHANTOM)
+
+#The chain of every frame, from the world side down, keyed by the link closest to the frame
+PHANTOM_CHAIN = (REFERENCE_TO_RAS, PHANTOM_TO_REFERENCE)
+PROBEMODEL_CHAIN = PHANTOM_CHAIN + (PROBE_TO_PHANTOM, PROBETIP_TO_PROBE, PROBEMODEL_TO_PROBETIP)
+USMASK_CHAIN = PROBEMODEL_CHAIN + (USMASK_TO_PROBEMODEL,)
+CHAINS = {
+    PROBEMODEL_TO_PROBETIP: PROBEMODEL_CHAIN,
+    USMASK_TO_PROBEMODEL: USMASK_CHAIN,
+    USSIMVOLUME_TO_USMASK: USMASK_CHAIN + (USSIMVOLUME_TO_USMASK,),
+    BIOPSYMODEL_TO_BIOPSYTRAJECTORY: PROBEMODEL_CHAIN + (BIOPSYTRAJECTORY_TO_PROBEMODEL, BIOPSYMODEL_TO_BIOPSYTRAJECTORY),
+    POINTERTIP_TO_POINTER: PHANTOM_CHAIN + (POINTER_TO_PHANTOM, POINTERTIP_TO_POINTER),
+}
+
+TARGET_ZONE = "PZ"
+#Cores with less than this fraction in a zone do not count as a hit of it
+MINIMUM_ZONE_FRACTION = 0.005
+#The axis of the default biopsy model, in biopsy model coordinates
+DEFAULT_CORE_SEGMENT = ((0, 0, -6), (0, 0, 6))
+
+
+def coreSegmentFromBounds(bounds):
+    '''
+    The two ends of the biopsy core (the axis of the biopsy model) from the bounds of the biopsy model.
+    '''
+    center = [(bounds[0] + bounds[1]) / 2.0, (bounds[2] + bounds[3]) / 2.0]
+    return (center[0], center[1], bounds[4]), (center[0], center[1], bounds[5])
+
+
+def scoreCores(ledger, coreSegment=DEFAULT_CORE_SEGMENT, zoneIndex=None, minimumZoneFraction=MINIMUM_ZONE_FRACTION):
+    '''
+    Scores the cores of a biopsy ledger. Zones recorded when a core was fired are kept; the others are sampled
+    from zoneIndex (already placed with setZonesToWorld), if given. Returns a dict of:
+      coresWithZones, outsideCores: cores with a known zone composition, and those of them entirely outside
+      hits<Zone>: cores with at least minimumZoneFraction in each of ZONES[1:] (nan without known zones)
+      spread: RMS distance (mm) of the core centres to their mean; nearestCore: mean distance to the nearest core
+      duration: seconds between the first and the last fire
+    '''
+    score = {"coresWithZones": 0, "outsideCores": 0, "spread": np.nan, "nearestCore": np.nan, "duration": np.nan}
+    score.update(("hits" + zone, np.nan) for zone in ZONES[1:])
+    if not len(ledger):
+        return score
+
+    zoneFractions = ledger.zoneFractions.copy()
+    unknown = np.isnan(zoneFractions).any(axis=1)
+    if zoneIndex is not None:
+        start, end = coreSegment
+        for index in np.flatnonzero(unknown):
+            zoneFractions[index] = zoneIndex.segmentComposition(start, end, ledger.poses[index])
+    known = zoneFractions[~np.isnan(zoneFractions).any(axis=1)]
+    score["coresWithZones"] = len(known)
+    score["outsideCores"] = int((known[:, 0] >= 1 - minimumZoneFraction).sum())
+    for zoneIndexInZones, zone in enumerate(ZONES[1:], 1):
+        score["hits" + zone] = int((known[:, zoneIndexInZones] >= minimumZoneFraction).sum()) if len(known) else np.nan
+
+    start, end = coreSegment
+    middle = np.append((np.asarray(start, dtype=float) + np.asarray(end, dtype=float)) / 2.0, 1.0)
+    centres = (ledger.poses @ middle)[:, :3]
+    score["spread"] = float(np.sqrt(((centres - centres.mean(axis=0)) ** 2).sum(axis=1).mean()))
+    if len(centres) > 1:
+        distances = np.linalg.norm(centres[:, None, :] - centres[None, :, :], axis=2)
+        np.fill_diagonal(distances, np.inf)
+        score["nearestCore"] = float(distances.min(axis=1).mean())
+    timestamps = ledger.timestamps[np.isfinite(ledger.timestamps)]
+    if len(timestamps):
+        score["duration"] = float(timestamps.max() - timestamps.min())
+    return score
+
+
+class SimulationCore:
+    '''
+    getMatrixToParent(linkName) returns the current 4x4 matrix to parent of a transform (see TransformChainCache).
+    setupTransformChain() builds the chains of CHAINS whose links are all available; lookups of the other frames
+    return None.
+
+    The case is set with setSliceGenerator (an UltrasoundSliceGenerator with the TRUS volume set) and setZones;
+    the biopsy model with setCoreSegment. Every part is optional: what needs a missing part returns None.
+    '''
+
+    def __init__(self, getMatrixToParent, availableLinks=None):
+        self.getMatrixToParent = getMatrixToParent
+        self.sliceGenerator = None
+        self.volumeCompounder = None
+        self.biopsyLedger = BiopsyLedger()
+        self.coreSegment = None
+        self.zoneIndex = None
+        self.zoneDistances = None
+        self.setupTransformChain(availableLinks)
+
+    def setupTransformChain(self, availableLinks=None):
+        '''
+        availableLinks: the links that exist (yet), or None if all of them do.
+        '''
+        self.transformChain = TransformChainCache(self.getMatrixToParent, dynamicLinks=DYNAMIC_LINKS)
+        for frameName, links in CHAINS.items():
+            if availableLinks is None or all(link in availableLinks for link in links):
+                self.transformChain.addChain(frameName, links)
+        return self.transformChain
+
+    def invalidate(self, linkName=None):
+        self.transformChain.invalidate(linkName)
+
+    def hasFrame(self, frameName):
+        return frameName in self.transformChain.chains
+
+    def matrixToWorld(self, frameName):
+        if frameName not in self.transformChain.chains:
+            return None
+        return self.transformChain.matrixToWorld(frameName)
+
+    def getMaskToWorld(self):
+        return self.matrixToWorld(USMASK_TO_PROBEMODEL)
+
+    def getNeedleToWorld(self):
+        '''
+        Biopsy needle model to world, at the current probe pose and needle depth.
+        '''
+        return self.matrixToWorld(BIOPSYMODEL_TO_BIOPSYTRAJECTORY)
+
+    def getProbeModelToWorld(self):
+        return self.matrixToWorld(PROBEMODEL_TO_PROBETIP)
+
+    def getProbeTipToWorld(self):
+        probeModelToWorld = self.getProbeModelToWorld()
+        if probeModelToWorld is None:
+            return None
+        return probeModelToWorld @ np.linalg.inv(np.asarray(self.getMatrixToParent(PROBEMODEL_TO_PROBETIP), dtype=float))
+
+    def getPointerTipToWorld(self):
+        return self.matrixToWorld(POINTERTIP_TO_POINTER)
+
+    def setSliceGenerator(self, sliceGenerator, volumeCompounder=None):
+        self.sliceGenerator = sliceGenerator
+        self.volumeCompounder = volumeCompounder
+
+    def getImageToWorld(self):
+        '''
+        US mask pixel (i, j, 0) to world for the current probe pose.
+        '''
+        maskToWorld = self.getMaskToWorld()
+        if maskToWorld is None or self.sliceGenerator is None:
+            return None
+        return maskToWorld @ self.sliceGenerator.maskIJKToMask
+
+    def generateFrame(self, out=None, compound=False):
+        '''
+        Samples the TRUS volume on the US mask plane at the current probe pose (into out, if given) and, with
+        compound, inserts the frame into the volume compounder. Returns the frame, or None without a slice
+        generator or US mask chain.
+        '''
+        maskToWorld = self.getMaskToWorld()
+        if maskToWorld is None or self.sliceGenerator is None:
+            return None
+        frame = self.sliceGenerator.generate(maskToWorld, out=out)
+        if compound and self.volumeCompounder is not None:
+            self.volumeCompounder.insertFrame(frame, maskToWorld @ self.sliceGenerator.maskIJKToMask,
+                                              self.sliceGenerator.fanMask)
+        return frame
+
+    def setCoreSegment(self, coreSegment):
+        self.coreSegment = coreSegment
+
+    def setZones(self, zoneIndex, zoneDistances=None):
+        self.zoneIndex = zoneIndex
+        self.zoneDistances = zoneDistances
+
+    def setZonesToWorld(self, zonesToWorld):
+        if self.zoneIndex is not None:
+            self.zoneIndex.setZonesToWorld(zonesToWorld)
+        if self.zoneDistances is not None:
+            self.zoneDistances.setZonesToWorld(zonesToWorld)
+
+    def getNeedleZoneComposition(self):
+        '''
+        The fraction of the biopsy core at the current needle pose in each of ZONES, or None without zones.
+        '''
+        needleToWorld = self.getNeedleToWorld()
+        if self.zoneIndex is None or self.coreSegment is None or needleToWorld is None:
+            return None
+        start, end = self.coreSegment
+        return self.zoneIndex.segmentComposition(start, end, needleToWorld)
+
+    def getTargetDistances(self, zone=TARGET_ZONE):
+        '''
+        Signed distances (mm, negative inside) from the biopsy core tip and from the probe tip to the boundary of
+        zone, as a dict with None for a distance that cannot be measured. None without zone distances.
+        '''
+        if self.zoneDistances is None:
+            return None
+
+        distances = {"needleTip": None, "probeTip": None}
+        needleToWorld = self.getNeedleToWorld()
+        if needleToWorld is not None and self.coreSegment is not None:
+            needleTip = needleToWorld @ np.append(self.coreSegment[1], 1.0)
+            distance = self.zoneDistances.distance(zone, needleTip[:3])
+            distances["needleTip"] = None if distance is None else float(distance[0])
+        probeTipToWorld = self.getProbeTipToWorld()
+        if probeTipToWorld is not None:
+            distance = self.zoneDistances.distance(zone, probeTipToWorld[:3, 3])
+            distances["probeTip"] = None if distance is None else float(distance[0])
+        return distances
+
+    def fireBiopsy(self, timestamp=None, depth=None):
+        '''
+        Appends the core at the current needle pose to the biopsy ledger, with its zone composition.
+        depth defaults to the needle depth of BiopsyModelToBiopsyTrajectory. Returns the core's pose and zones.
+        '''
+        needleToWorld = self.getNeedleToWorld()
+        if needleToWorld is None:
+            raise ValueError("The biopsy needle is not in the transform chain")
+        if depth is None:
+            depth = float(self.getMatrixToParent(BIOPSYMODEL_TO_BIOPSYTRAJECTORY)[2][3])
+        zoneFractions = self.getNeedleZoneComposition()
+        self.biopsyLedger.append(needleToWorld, time.time() if timestamp is None else timestamp, depth, zoneFractions)
+        return needleToWorld, zoneFractions
+
+    def score(self):
+        '''
+        scoreCores of the biopsy ledger against the current zones.
+        '''
+        return scoreCores(self.biopsyLedger, self.coreSegment or DEFAULT_CORE_SEGMENT, self.zoneIndex)
@@ -0,0 +1,189 @@
+import time
+
+import numpy as np
+import vtk
+from vtk.util import numpy_support
+
+from . import GenerateFanMask
+from .FrameBuffer import FrameStats
+from .TransformUtils import updateVTKMatrixFromArray
+
+
+def defaultFanMask():
+    return GenerateFanMask.fanMaskEngine.getMask(GenerateFanMask.DEFAULT_OUTER_RADIUS, GenerateFanMask.DEFAULT_INNER_RADIUS,
+                                                 GenerateFanMask.DEFAULT_FOV, GenerateFanMask.DEFAULT_IMAGE_HEIGHT,
+                                                 GenerateFanMask.DEFAULT_IMAGE_WIDTH, GenerateFanMask.DEFAULT_CENTER)
+
+
+class UltrasoundSliceGenerator:
+    '''
+    Samples the TRUS volume directly along the US mask plane with vtkImageReslice and writes
+    a fixed-size fan image at the mask resolution. Nothing is rendered, so the output does not
+    depend on the slice view size, zoom, annotations or the window system, and it runs headless.
+
+    Coordinates:
+      maskIJKToMask: mask pixel (i, j, 0) to the USMask frame (the MaskVolume IJKToRAS matrix)
+      maskToWorld: USMask frame to RAS, ie. USMaskToProbeModel composed up to ReferenceToRAS
+      volumeIJKToWorld: TRUS volume voxel to RAS, including its parent transforms
+    '''
+
+    def __init__(self, fanMask=None, maskIJKToMask=None):
+        if fanMask is None:
+            fanMask = defaultFanMask()
+        self.fanMask = np.asarray(fanMask, dtype=bool)
+        self.height, self.width = self.fanMask.shape
+        self.fanMaskWeights = self.fanMask.astype(np.float32)
+        self.maskIJKToMask = np.eye(4) if maskIJKToMask is None else np.array(maskIJKToMask, dtype=float)
+
+        self.volumeImage = vtk.vtkImageData()
+        self.volumeWorldToIJK = np.eye(4)
+        self.window = 255.0
+        self.level = 127.5
+
+        #Reslice from mask pixels straight into volume voxels; the axes are the only per-frame input
+        self.resliceAxes = vtk.vtkMatrix4x4()
+        self.reslice = vtk.vtkImageReslice()
+        self.reslice.SetInputData(self.volumeImage)
+        self.reslice.SetResliceAxes(self.resliceAxes)
+        self.reslice.SetInterpolationModeToLinear()
+        self.reslice.SetOutputExtent(0, self.width - 1, 0, self.height - 1, 0, 0)
+        self.reslice.SetOutputOrigin(0.0, 0.0, 0.0)
+        self.reslice.SetOutputSpacing(1.0, 1.0, 1.0)
+        self.reslice.SetOutputDimensionality(2)
+        self.reslice.SetBackgroundLevel(0.0)
+
+        self.scaled = np.zeros((self.height, self.width), dtype=np.float32)
+        self.image = np.zeros((self.height, self.width), dtype=np.uint8)
+        self.stats = FrameStats()
+
+        #Optional cylindrical resampling of the volume (see CylindricalResampling), used when the mask plane
+        #contains its axis; every other pose is resliced obliquely
+        self.cylindricalVolume = None
+        self.cylindricalFrames = 0
+        self.obliqueFrames = 0
+
+        #Optional image formation stage (see ImageFormation) applied to every windowed frame
+        self.imageFormation = None
+
+    def setVolume(self, imageData, volumeIJKToWorld, window=None, level=None):
+        '''
+        Sets the volume to sample. The image data is shallow copied and resampled in voxel
+        coordinates, so its own origin and spacing are ignored in favour of volumeIJKToWorld.
+        If no window / level is given, the full scalar range is mapped to 0-255.
+        '''
+        self.volumeImage.ShallowCopy(imageData)
+        self.volumeImage.SetOrigin(0.0, 0.0, 0.0)
+        self.volumeImage.SetSpacing(1.0, 1.0, 1.0)
+        if hasattr(self.volumeImage, "SetDirectionMatrix"):
+            self.volumeImage.SetDirectionMatrix(1, 0, 0, 0, 1, 0, 0, 0, 1)
+        self.volumeWorldToIJK = np.linalg.inv(np.asarray(volumeIJKToWorld, dtype=float))
+        self.cylindricalVolume = None
+
+        if window is None or level is None or window <= 0:
+            low, high = imageData.GetScalarRange()
+            window = max(high - low, 1.0)
+            level = low + window / 2.0
+        self.window = float(window)
+        self.level = float(level)
+
+    def setVolumeToWorld(self, volumeIJKToWorld):
+        self.volumeWorldToIJK = np.linalg.inv(np.asarray(volumeIJKToWorld, dtype=float))
+
+    def setCylindricalVolume(self, cylindricalVolume):
+        '''
+        A CylindricalVolume resampled from the volume of setVolume (which clears it), or None.
+        '''
+        self.cylindricalVolume = cylindricalVolume
+
+    def setImageFormation(self, imageFormation):
+        '''
+        An UltrasoundImageFormation for frames of this size, or None for the windowed slice alone.
+        '''
+        if imageFormation is not None and imageFormation.scanConversion.imageShape != (self.height, self.width):
+            raise ValueError("Image formation is for {} images, the slices are {}".format(
+                imageFormation.scanConversion.imageShape, (self.height, self.width)))
+        self.imageFormation = imageFormation
+
+    def generate(self, maskToWorld, out=None):
+        '''
+        Samples the slice for the given USMask-to-RAS pose and returns the uint8 fan image
+        (height x width, row 0 is mask row 0). Pixels outside the fan are 0.
+        If out is given, the image is written into it instead of the internal buffer.
+        '''
+        startTime = time.perf_counter()
+
+        maskIJKToVolumeIJK = self.volumeWorldToIJK @ np.asarray(maskToWorld) @ self.maskIJKToMask
+        resliced = None
+        if self.cylindricalVolume is not None:
+            resliced = self.cylindricalVolume.extractSlice(maskIJKToVolumeIJK, self.width, self.height)
+        if resliced is None:
+            resliced = self.resliceOblique(maskIJKToVolumeIJK)
+            self.obliqueFrames += 1
+        else:
+            self.cylindricalFrames += 1
+
+        out = self.windowAndMask(resliced, out)
+        if self.imageFormation is not None:
+            self.imageFormation.apply(out, out, maskToWorld)
+        self.stats.addFrame(time.perf_counter() - startTime, 0)
+        return out
+
+    def resliceOblique(self, maskIJKToVolumeIJK):
+        updateVTKMatrixFromArray(self.resliceAxes, maskIJKToVolumeIJK)
+        self.reslice.Update()
+        scalars = self.reslice.GetOutput().GetPointData().GetScalars()
+        return numpy_support.vtk_to_numpy(scalars).reshape(self.height, self.width)
+
+    def windowAndMask(self, resliced, out=None):
+        #Window / level to 0-255 and mask the fan, in preallocated buffers
+        np.subtract(resliced, self.level - self.window / 2.0, out=self.scaled, casting="unsafe")
+        np.multiply(self.scaled, 255.0 / self.window, out=self.scaled)
+        np.clip(self.scaled, 0.0, 255.0, out=self.scaled)
+        np.multiply(self.scaled, self.fanMaskWeights, out=self.scaled)
+
+        if out is None:
+            out = self.image
+        np.copyto(out, self.scaled, casting="unsafe")
+        return out
+
+
+def syntheticVolume(dimensions=(200, 200, 200)):
+    '''
+    Smooth random uint8 volume for benchmarks and tests that cannot load a TRUS.nrrd.
+    '''
+    rng = np.random.default_rng(0)
+    coarse = rng.integers(0, 256, size=tuple(max(d // 8, 2) for d in dimensions[::-1]), dtype=np.uint8)
+    volume = np.repeat(np.repeat(np.repeat(coarse, 8, axis=0), 8, axis=1), 8, axis=2)
+    volume = np.ascontiguousarray(volume[:dimensions[2], :dimensions[1], :dimensions[0]])
+
+    imageData = vtk.vtkImageData()
+    imageData.SetDimensions(dimensions)
+    imageData.GetPointData().SetScalars(numpy_support.numpy_to_vtk(volume.ravel(), deep=True, array_type=vtk.VTK_UNSIGNED_CHAR))
+    return imageData
+
+
+def benchmarkSliceGenerator(frames=300, dimensions=(200, 200, 200), maskScale=0.25):
+    '''
+    Generates frames for a probe sweeping through a synthetic volume and returns frames per second.
+    maskScale is the mask pixel size in voxels.
+    '''
+    generator = UltrasoundSliceGenerator(maskIJKToMask=np.diag([maskScale, maskScale, 1.0, 1.0]))
+    generator.setVolume(syntheticVolume(dimensions), np.eye(4))
+
+    startTime = time.perf_counter()
+    for frame in range(frames):
+        angle = np.radians(frame * 0.5)
+        maskToWorld = np.eye(4)
+        maskToWorld[:3, :3] = [[1, 0, 0], [0, np.cos(angle), -np.sin(angle)], [0, np.sin(angle), np.cos(angle)]]
+        maskToWorld[:3, 3] = [dimensions[0] / 4.0, dimensions[1] / 2.0, dimensions[2] / 2.0]
+        generator.generate(maskToWorld)
+    elapsed = time.perf_counter() - startTime
+
+    summary = generator.stats.summary()
+    summary["fps"] = frames / elapsed
+    return summary
+
+
+if __name__ == "__main__":
+    result = benchmarkSliceGenerator()
+    print("reslice: {frames} frames, {fps:.1f} fps, mean {meanLatencyMs:.3f} ms, max {maxLatencyMs:.3f} ms".format(**result))
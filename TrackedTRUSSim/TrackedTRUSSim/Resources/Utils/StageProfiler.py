@@ -0,0 +1,194 @@
+'''
+Per-stage latency of the frame pipeline. Each stage of a frame (grab, grayscale conversion, VTK update,
+render, ...) is timed with perf_counter between two marks and kept in a fixed size ring buffer, so the
+percentiles always describe the last frames and memory does not grow with the session.
+
+The pipeline always calls a profiler; when profiling is off that is NULL_PROFILER, whose methods do
+nothing, so the disabled cost is one empty method call per mark.
+'''
+
+import json
+import time
+
+import numpy as np
+
+#Log-spaced histogram bins from 10 us to 1 s, in ms
+HISTOGRAM_EDGES_MS = np.logspace(-2, 3, 26)
+#Characters of increasing density for one-line text histograms
+HISTOGRAM_LEVELS = " .:-=+*#"
+
+
+class LatencyHistogram:
+    '''
+    The last capacity latencies (seconds) of one stage, in a preallocated ring buffer.
+    '''
+
+    def __init__(self, capacity=1024):
+        self.samples = np.zeros(capacity)
+        self.position = 0
+        self.count = 0
+        self.totalCount = 0
+
+    def add(self, latency):
+        self.samples[self.position] = latency
+        self.position = (self.position + 1) % len(self.samples)
+        self.count = min(self.count + 1, len(self.samples))
+        self.totalCount += 1
+
+    def reset(self):
+        self.position = 0
+        self.count = 0
+        self.totalCount = 0
+
+    def recent(self):
+        '''
+        The buffered latencies in ms, oldest first.
+        '''
+        if self.count < len(self.samples):
+            return 1000 * self.samples[:self.count]
+        return 1000 * np.roll(self.samples, -self.position)
+
+    def summary(self):
+        latencies = self.recent()
+        if not len(latencies):
+            return {"count": self.totalCount, "p50Ms": 0.0, "p95Ms": 0.0, "p99Ms": 0.0, "maxMs": 0.0, "meanMs": 0.0}
+        p50, p95, p99 = np.percentile(latencies, (50, 95, 99))
+        return {"count": self.totalCount, "p50Ms": float(p50), "p95Ms": float(p95), "p99Ms": float(p99),
+                "maxMs": float(latencies.max()), "meanMs": float(latencies.mean())}
+
+    def histogram(self, edges=HISTOGRAM_EDGES_MS):
+        return np.histogram(np.clip(self.recent(), edges[0], edges[-1]), edges)[0]
+
+    def textHistogram(self, edges=HISTOGRAM_EDGES_MS):
+        '''
+        The histogram as one character per bin, denser characters for fuller bins.
+        '''
+        counts = self.histogram(edges)
+        if not counts.any():
+            return " " * len(counts)
+        levels = np.ceil(counts / counts.max() * (len(HISTOGRAM_LEVELS) - 1)).astype(int)
+        return "".join(HISTOGRAM_LEVELS[level] for level in levels)
+
+
+class StageProfiler:
+    '''
+    Times the stages of each frame: begin() starts a frame, mark(stage) records the time since the previous
+    mark (or begin) as that stage, and end(stage) records the time since begin as the frame total.
+    record(stage, latency) adds a latency measured elsewhere (eg. a render).
+    '''
+
+    enabled = True
+
+    def __init__(self, capacity=1024, clock=time.perf_counter):
+        self.capacity = capacity
+        self.clock = clock
+        self.histograms = {}
+        self.frameStart = None
+        self.lastMark = None
+
+    def histogramFor(self, stage):
+        histogram = self.histograms.get(stage)
+        if histogram is None:
+            histogram = self.histograms[stage] = LatencyHistogram(self.capacity)
+        return histogram
+
+    def begin(self):
+        self.frameStart = self.lastMark = self.clock()
+
+    def mark(self, stage):
+        now = self.clock()
+        if self.lastMark is not None:
+            self.histogramFor(stage).add(now - self.lastMark)
+        self.lastMark = now
+
+    def end(self, stage="frame"):
+        now = self.clock()
+        if self.frameStart is not None:
+            self.histogramFor(stage).add(now - self.frameStart)
+        self.frameStart = self.lastMark = None
+        return now
+
+    def record(self, stage, latency):
+        self.histogramFor(stage).add(latency)
+
+    def reset(self):
+        for histogram in self.histograms.values():
+            histogram.reset()
+
+    def summary(self):
+        '''
+        {stage: count and p50 / p95 / p99 / max / mean in ms}, in the order the stages were first seen.
+        '''
+        return {stage: histogram.summary() for stage, histogram in self.histograms.items()}
+
+    def formatSummary(self):
+        '''
+        A text table of the percentiles and the histogram of every stage, for the view overlay.
+        '''
+        lines = ["{:16s} {:>7s} {:>7s} {:>7s}  {}".format("stage (ms)", "p50", "p95", "p99",
+                                                       "{:g} ms .. {:g} s".format(HISTOGRAM_EDGES_MS[0], HISTOGRAM_EDGES_MS[-1] / 1000))]
+        for stage, histogram in self.histograms.items():
+            summary = histogram.summary()
+            lines.append("{:16s} {:7.2f} {:7.2f} {:7.2f}  |{}|".format(stage[:16], summary["p50Ms"], summary["p95Ms"],
+                                                                     summary["p99Ms"], histogram.textHistogram()))
+        return "\n".join(lines)
+
+    def export(self, path, metadata=None):
+        '''
+        Writes the summary, the histogram counts and the buffered latencies of every stage to a JSON file.
+        '''
+        stages = {}
+        for stage, histogram in self.histograms.items():
+            stages[stage] = dict(histogram.summary(), histogram=histogram.histogram().tolist(),
+                                 latenciesMs=histogram.recent().round(4).tolist())
+        with open(path, "w") as f:
+            json.dump({"time": time.time(), "metadata": metadata or {}, "histogramEdgesMs": HISTOGRAM_EDGES_MS.tolist(),
+                       "stages": stages}, f, indent=1)
+
+
+class NullStageProfiler:
+    '''
+    The profiler used while profiling is off: every call does nothing.
+    '''
+
+    enabled = False
+
+    def begin(self):
+        pass
+
+    def mark(self, stage):
+        pass
+
+    def end(self, stage="frame"):
+        pass
+
+    def record(self, stage, latency):
+        pass
+
+
+NULL_PROFILER = NullStageProfiler()
+
+
+def benchmarkOverhead(marks=1000000):
+    '''
+    Nanoseconds per mark with profiling off and on.
+    '''
+    results = {}
+    for name, profiler in (("disabled", NULL_PROFILER), ("enabled", StageProfiler())):
+        profiler.begin()
+        startTime = time.perf_counter()
+        for index in range(marks):
+            profiler.mark("stage")
+        results[name] = 1e9 * (time.perf_counter() - startTime) / marks
+    return results
+
+
+if __name__ == "__main__":
+    for name, overhead in benchmarkOverhead().items():
+        print("{}: {:.0f} ns per mark".format(name, overhead))
+    profiler = StageProfiler()
+    rng = np.random.default_rng(0)
+    for frame in range(2000):
+        for stage, scale in (("grab", 4.0), ("grayscale", 0.3), ("render", 8.0)):
+            profiler.record(stage, rng.gamma(2.0, scale / 2000.0))
+    print(profiler.formatSummary())
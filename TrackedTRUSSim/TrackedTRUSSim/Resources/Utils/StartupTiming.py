@@ -0,0 +1,73 @@
+'''
+Staged start up of the module. Each stage of building the scene is timed with StartupTimer, and the parts that
+only some sessions need (the tracker server, the reconstruction, the benchmarks, OpenCV) are LazyModules: they
+are imported, and their import is timed as a stage, on the first attribute lookup instead of when the module opens.
+'''
+
+import importlib
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+
+
+class StartupTimer:
+    '''
+    Seconds per start up stage, in the order the stages ran. log (eg. logging.info) is called with a line
+    for every stage as it finishes.
+    '''
+
+    def __init__(self, log=None, clock=time.perf_counter):
+        self.log = log
+        self.clock = clock
+        self.stages = OrderedDict()
+
+    @contextmanager
+    def stage(self, name):
+        startTime = self.clock()
+        try:
+            yield
+        finally:
+            self.record(name, self.clock() - startTime)
+
+    def record(self, name, seconds):
+        #A stage that runs again (eg. the base scene after a scene close) accumulates
+        self.stages[name] = self.stages.get(name, 0.0) + seconds
+        if self.log is not None:
+            self.log("Startup stage {} in {:.3f} s".format(name, seconds))
+
+    def total(self):
+        return sum(self.stages.values())
+
+    def formatSummary(self):
+        return ", ".join("{} {:.3f} s".format(name, seconds) for name, seconds in self.stages.items())
+
+
+class LazyModule:
+    '''
+    Stands in for a module until one of its attributes is used, then imports it (timed as the stage
+    "import <name>" of timer, if given) and forwards every lookup to it.
+    '''
+
+    def __init__(self, name, timer=None):
+        self.__dict__["_name"] = name
+        self.__dict__["_timer"] = timer
+        self.__dict__["_module"] = None
+
+    @property
+    def loaded(self):
+        return self._module is not None
+
+    def load(self):
+        if self._module is None:
+            startTime = time.perf_counter()
+            module = importlib.import_module(self._name)
+            if self._timer is not None:
+                self._timer.record("import " + self._name.rsplit(".", 1)[-1], time.perf_counter() - startTime)
+            self.__dict__["_module"] = module
+        return self._module
+
+    def __getattr__(self, attribute):
+        return getattr(self.load(), attribute)
+
+    def __repr__(self):
+        return "<lazy module {} ({})>".format(self._name, "loaded" if self.loaded else "not loaded")
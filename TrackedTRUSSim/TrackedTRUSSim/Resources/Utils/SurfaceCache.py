@@ -0,0 +1,78 @@
+'''
+On-disk cache of the closed surfaces of a segmentation file.
+
+Converting a labelmap segmentation to closed surfaces (surface extraction, decimation, smoothing) takes
+much longer than reading the result back. Entries are keyed by the sha256 of the segmentation file and
+the conversion parameters, so an edited file or different smoothing settings never hit a stale entry.
+'''
+
+import glob
+import hashlib
+import json
+import os
+
+import numpy as np
+
+from .ArrayUtils import atomicSaveNpz
+from .AssetBundle import fileHash, polyDataFromBytes, polyDataToBytes
+
+CACHE_VERSION = 1
+
+
+def surfaceCacheKey(segmentationPath, conversionParameters):
+    key = hashlib.sha256()
+    key.update(str(CACHE_VERSION).encode("utf-8"))
+    key.update(fileHash(segmentationPath).encode("utf-8"))
+    key.update(conversionParameters.encode("utf-8"))
+    return key.hexdigest()
+
+
+class SurfaceCache:
+    '''
+    Stores one .npz per key in cacheDir, holding the polydata of every segment by segment ID.
+    '''
+
+    def __init__(self, cacheDir):
+        self.cacheDir = cacheDir
+        self.hits = 0
+        self.misses = 0
+
+    def entryPath(self, key):
+        return os.path.join(self.cacheDir, key + ".npz")
+
+    def read(self, key):
+        '''
+        Returns {segmentId: vtkPolyData}, or None if there is no usable entry for key.
+        '''
+        path = self.entryPath(key)
+        if not os.path.exists(path):
+            self.misses += 1
+            return None
+        try:
+            with np.load(path) as entry:
+                segmentIds = json.loads(entry["segmentIds"].tobytes().decode("utf-8"))
+                surfaces = {segmentId: polyDataFromBytes(entry["surface_{}".format(index)])
+                            for index, segmentId in enumerate(segmentIds)}
+        except (OSError, ValueError, KeyError):
+            self.misses += 1
+            return None
+        self.hits += 1
+        return surfaces
+
+    def write(self, key, surfaces):
+        '''
+        surfaces: {segmentId: vtkPolyData}
+        '''
+        os.makedirs(self.cacheDir, exist_ok=True)
+        segmentIds = list(surfaces)
+        arrays = {"segmentIds": np.frombuffer(json.dumps(segmentIds).encode("utf-8"), dtype=np.uint8)}
+        for index, segmentId in enumerate(segmentIds):
+            arrays["surface_{}".format(index)] = polyDataToBytes(surfaces[segmentId])
+
+        #Concurrent warming never leaves a half written entry
+        atomicSaveNpz(self.entryPath(key), **arrays)
+        return self.entryPath(key)
+
+    def clear(self):
+        for path in glob.glob(os.path.join(self.cacheDir, "*.npz")):
+            os.remove(path)
@@ -0,0 +1,416 @@
+'''
+Stand-in for the PLUS server and the OptiTrack: a localhost OpenIGTLink server that sends TRANSFORM messages
+for ProbeToPhantom, PhantomToTracker and PointerToPhantom from scripted trajectories or tracking recordings,
+at a configurable rate with optional jitter and dropouts. Slicer connects to it with an OpenIGTLink connector
+exactly as to the PLUS server, so the receive-to-display path can be measured at tracker rates the hardware
+does not offer.
+
+Messages are OpenIGTLink version 1: a 58 byte big-endian header (version, type, device name, timestamp, body
+size, CRC-64 of the body) and a 48 byte body with the upper 3 x 4 of the matrix as float32, column by column.
+The header timestamp is the wall clock time the pose was due, so a receiver on the same host can tell how late
+it arrived.
+'''
+
+import socket
+import struct
+import threading
+import time
+
+import numpy as np
+
+from .TrackingRecording import TrackingRecording, sweepPose
+
+DEFAULT_PORT = 18944
+HEADER_FORMAT = ">H12s20sQQQ"
+HEADER_SIZE = struct.calcsize(HEADER_FORMAT)
+TRANSFORM_BODY_SIZE = 48
+IGTL_VERSION = 1
+
+PROBE_TO_PHANTOM = "ProbeToPhantom"
+PHANTOM_TO_TRACKER = "PhantomToTracker"
+POINTER_TO_PHANTOM = "PointerToPhantom"
+
+#CRC-64 of OpenIGTLink (ECMA-182 polynomial, not reflected, no final xor), one table entry per byte value
+CRC64_POLYNOMIAL = 0x42F0E1EBA9EA3693
+CRC64_MASK = (1 << 64) - 1
+
+
+def makeCRC64Table():
+    table = []
+    for byte in range(256):
+        crc = byte << 56
+        for bit in range(8):
+            crc = ((crc << 1) ^ CRC64_POLYNOMIAL) if crc & (1 << 63) else (crc << 1)
+        table.append(crc & CRC64_MASK)
+    return table
+
+
+CRC64_TABLE = makeCRC64Table()
+
+
+def crc64(data):
+    crc = 0
+    for byte in data:
+        crc = CRC64_TABLE[((crc >> 56) ^ byte) & 0xFF] ^ ((crc << 8) & CRC64_MASK)
+    return crc
+
+
+def packTransform(deviceName, matrix, timestamp):
+    '''
+    One OpenIGTLink TRANSFORM message of the 4x4 matrix, stamped with timestamp in seconds since the epoch.
+    '''
+    matrix = np.asarray(matrix, dtype=float)
+    body = np.concatenate((matrix[:3, :3].T.ravel(), matrix[:3, 3])).astype(">f4").tobytes()
+    seconds = int(timestamp)
+    fixedPoint = (seconds << 32) | int((timestamp - seconds) * (1 << 32))
+    header = struct.pack(HEADER_FORMAT, IGTL_VERSION, b"TRANSFORM", deviceName.encode("ascii"), fixedPoint,
+                         len(body), crc64(body))
+    return header + body
+
+
+def unpackHeader(header):
+    '''
+    (message type, device name, timestamp, body size, CRC-64) of a message header.
+    '''
+    version, messageType, deviceName, fixedPoint, bodySize, crc = struct.unpack(HEADER_FORMAT, header)
+    timestamp = (fixedPoint >> 32) + (fixedPoint & 0xFFFFFFFF) / float(1 << 32)
+    return messageType.rstrip(b"\0").decode("ascii"), deviceName.rstrip(b"\0").decode("ascii"), timestamp, bodySize, crc
+
+
+def unpackTransform(body):
+    values = np.frombuffer(body, dtype=">f4", count=12).astype(float)
+    matrix = np.eye(4)
+    matrix[:3, :3] = values[:9].reshape(3, 3).T
+    matrix[:3, 3] = values[9:]
+    return matrix
+
+
+def constantTrajectory(matrix):
+    matrix = np.array(matrix, dtype=float)
+    return lambda timestamp: matrix
+
+
+def pointerCircleTrajectory(center=(50.0, 50.0, 30.0), radius=10.0, period=5.0):
+    '''
+    PointerToPhantom of a pointer tip going round a circle in the axial plane.
+    '''
+    def trajectory(timestamp):
+        angle = 2 * np.pi * timestamp / period
+        matrix = np.eye(4)
+        matrix[:3, 3] = np.add(center, (radius * np.cos(angle), radius * np.sin(angle), 0.0))
+        return matrix
+    return trajectory
+
+
+def recordingTrajectory(recording, channel, loop=True):
+    '''
+    The poses of one channel of a TrackingRecording, as the last sample at or before each time since the
+    start of the recording; the recording repeats when loop is set and holds its last pose otherwise.
+    '''
+    timestamps, matrices = recording.channelSamples(channel)
+    if not len(timestamps):
+        raise ValueError("recording has no {} samples".format(channel))
+    timestamps = np.array(timestamps - timestamps[0])
+    matrices = np.array(matrices)
+    duration = timestamps[-1]
+
+    def trajectory(timestamp):
+        if loop and duration > 0:
+            timestamp = timestamp % duration
+        return matrices[max(0, np.searchsorted(timestamps, timestamp, side="right") - 1)]
+    return trajectory
+
+
+def scriptedTrajectories():
+    '''
+    A probe sweeping back and forth, a still phantom and a pointer going round, as {device name: trajectory}.
+    '''
+    phantomToTracker = np.eye(4)
+    phantomToTracker[:3, 3] = [0.0, 0.0, -1000.0]
+    return {PROBE_TO_PHANTOM: sweepPose, PHANTOM_TO_TRACKER: constantTrajectory(phantomToTracker),
+            POINTER_TO_PHANTOM: pointerCircleTrajectory()}
+
+
+def recordedTrajectories(path, loop=True):
+    '''
+    {device name: trajectory} of every channel of the recording at path.
+    '''
+    recording = TrackingRecording(path)
+    trajectories = {}
+    for channel in recording.channels:
+        if len(recording.channelSamples(channel)[0]):
+            trajectories[channel] = recordingTrajectory(recording, channel, loop)
+    return trajectories
+
+
+class SyntheticTrackerServer:
+    '''
+    Serves trajectories ({device name: function of seconds since start -> 4x4 matrix}) to every client that
+    connects to host:port, rate times per second.
+
+    jitter is the standard deviation in seconds of a random delay added to each send (clipped to half a period
+    so messages stay in order), and dropout the probability that a message of a device is left out. A client
+    that stops reading for clientTimeout seconds is disconnected rather than stalling the others.
+    '''
+
+    def __init__(self, trajectories, rate=120.0, jitter=0.0, dropout=0.0, port=DEFAULT_PORT, host="127.0.0.1",
+                 seed=None, clientTimeout=1.0):
+        self.trajectories = dict(trajectories)
+        self.jitter = jitter
+        self.dropout = dropout
+        self.port = port
+        self.host = host
+        self.clientTimeout = clientTimeout
+        self.rng = np.random.default_rng(seed)
+        self.setRate(rate)
+
+        self.serverSocket = None
+        self.clients = []
+        self.clientsLock = threading.Lock()
+        self.running = threading.Event()
+        self.threads = []
+        self.resetStats()
+
+    def setRate(self, rate):
+        '''
+        Changes the send rate; the schedule restarts from the next tick.
+        '''
+        self.rate = float(rate)
+        self.restartSchedule = True
+
+    def resetStats(self):
+        self.tickCount = 0
+        self.sentCount = 0
+        self.droppedCount = 0
+        self.maxLateness = 0.0
+        self.statsStartTime = time.perf_counter()
+
+    def getStats(self):
+        '''
+        Ticks, messages sent and dropped, connected clients, the achieved tick rate and the worst scheduling
+        lateness in ms since the last resetStats.
+        '''
+        elapsed = time.perf_counter() - self.statsStartTime
+        with self.clientsLock:
+            clientCount = len(self.clients)
+        return {"ticks": self.tickCount, "sent": self.sentCount, "dropped": self.droppedCount, "clients": clientCount,
+                "tickRate": self.tickCount / elapsed if elapsed > 0 else 0.0, "maxLatenessMs": 1000 * self.maxLateness}
+
+    def start(self):
+        '''
+        Listens on host:port (port 0 picks a free one, see self.port) and starts sending from a background thread.
+        '''
+        self.serverSocket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.serverSocket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.serverSocket.bind((self.host, self.port))
+        self.serverSocket.listen()
+        self.serverSocket.settimeout(0.2)
+        self.port = self.serverSocket.getsockname()[1]
+        self.running.set()
+        self.threads = [threading.Thread(target=self.acceptLoop, name="SyntheticTrackerAccept", daemon=True),
+                        threading.Thread(target=self.sendLoop, name="SyntheticTrackerSend", daemon=True)]
+        for thread in self.threads:
+            thread.start()
+
+    def stop(self):
+        self.running.clear()
+        for thread in self.threads:
+            thread.join()
+        self.threads = []
+        if self.serverSocket is not None:
+            self.serverSocket.close()
+            self.serverSocket = None
+        with self.clientsLock:
+            for client in self.clients:
+                client.close()
+            self.clients = []
+
+    def acceptLoop(self):
+        while self.running.is_set():
+            try:
+                client, address = self.serverSocket.accept()
+            except socket.timeout:
+                continue
+            except OSError:
+                break
+            client.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            client.settimeout(self.clientTimeout)
+            with self.clientsLock:
+                self.clients.append(client)
+
+    def sendLoop(self):
+        names = list(self.trajectories)
+        startTime = time.perf_counter()
+        wallOffset = time.time() - startTime
+        while self.running.is_set():
+            if self.restartSchedule:
+                self.restartSchedule = False
+                scheduleStart = time.perf_counter()
+                period = 1.0 / self.rate
+                tick = 0
+            dueTime = scheduleStart + tick * period
+            sendTime = dueTime
+            if self.jitter:
+                sendTime += min(max(self.rng.normal(0.0, self.jitter), 0.0), 0.5 * period)
+            delay = sendTime - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+            self.maxLateness = max(self.maxLateness, time.perf_counter() - sendTime)
+
+            keep = self.rng.random(len(names)) >= self.dropout if self.dropout else [True] * len(names)
+            messages = [packTransform(name, self.trajectories[name](dueTime - startTime), dueTime + wallOffset)
+                        for name, send in zip(names, keep) if send]
+            self.tickCount += 1
+            self.sentCount += len(messages)
+            self.droppedCount += len(names) - len(messages)
+            if messages:
+                self.sendToClients(b"".join(messages))
+
+            tick += 1
+            #Skip the ticks that are already over instead of sending them in a burst
+            if time.perf_counter() - (scheduleStart + tick * period) > period:
+                tick = int((time.perf_counter() - scheduleStart) / period) + 1
+
+    def sendToClients(self, data):
+        with self.clientsLock:
+            clients = list(self.clients)
+        for client in clients:
+            try:
+                client.sendall(data)
+            except OSError:
+                client.close()
+                with self.clientsLock:
+                    self.clients.remove(client)
+
+
+class TransformReceiver:
+    '''
+    Minimal OpenIGTLink client: reads messages from host:port on a background thread and calls
+    sink(device name, matrix, header timestamp) for each TRANSFORM with a valid CRC. The receive latency
+    (wall clock at arrival minus header timestamp) of each message is kept in latencies.
+    '''
+
+    def __init__(self, host="127.0.0.1", port=DEFAULT_PORT, sink=None):
+        self.host = host
+        self.port = port
+        self.sink = sink
+        self.socket = None
+        self.thread = None
+        self.running = threading.Event()
+        self.resetStats()
+
+    def resetStats(self):
+        self.receivedCount = 0
+        self.crcErrorCount = 0
+        self.latencies = []
+
+    def start(self):
+        self.socket = socket.create_connection((self.host, self.port))
+        self.socket.settimeout(0.2)
+        self.running.set()
+        self.thread = threading.Thread(target=self.receiveLoop, name="TransformReceiver", daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.running.clear()
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+        if self.socket is not None:
+            self.socket.close()
+            self.socket = None
+
+    def receiveLoop(self):
+        buffer = bytearray()
+        while self.running.is_set():
+            try:
+                data = self.socket.recv(65536)
+            except socket.timeout:
+                continue
+            except OSError:
+                break
+            if not data:
+                break
+            arrivalTime = time.time()
+            buffer += data
+            while len(buffer) >= HEADER_SIZE:
+                messageType, deviceName, timestamp, bodySize, crc = unpackHeader(bytes(buffer[:HEADER_SIZE]))
+                if len(buffer) < HEADER_SIZE + bodySize:
+                    break
+                body = bytes(buffer[HEADER_SIZE:HEADER_SIZE + bodySize])
+                del buffer[:HEADER_SIZE + bodySize]
+                if crc64(body) != crc:
+                    self.crcErrorCount += 1
+                    continue
+                if messageType != "TRANSFORM":
+                    continue
+                self.receivedCount += 1
+                self.latencies.append(arrivalTime - timestamp)
+                if self.sink is not None:
+                    self.sink(deviceName, unpackTransform(body), timestamp)
+
+
+def benchmarkRates(trajectories, rates=(30, 60, 120, 250, 500, 1000), seconds=2.0, jitter=0.0, dropout=0.0,
+                   pipeline=None):
+    '''
+    Serves the trajectories at each rate to a TransformReceiver on this host, feeding pipeline.setMatrixToParent
+    if given. {rate: (server stats, received messages, mean and max receive latency in ms, frames per second)}.
+    '''
+    results = {}
+    for rate in rates:
+        server = SyntheticTrackerServer(trajectories, rate, jitter, dropout, port=0, seed=0)
+        server.start()
+        receiver = TransformReceiver(port=server.port, sink=pipeline.setMatrixToParent if pipeline is not None else None)
+        receiver.start()
+        #Start counting once the client is connected
+        while not server.getStats()["clients"]:
+            time.sleep(0.01)
+        server.resetStats()
+        receiver.resetStats()
+        startFrames = pipeline.frameCount if pipeline is not None else 0
+        time.sleep(seconds)
+        stats = server.getStats()
+        receiver.stop()
+        server.stop()
+        latencies = 1000 * np.array(receiver.latencies) if receiver.latencies else np.zeros(1)
+        frameRate = (pipeline.frameCount - startFrames) / seconds if pipeline is not None else 0.0
+        results[rate] = (stats, receiver.receivedCount, float(latencies.mean()), float(latencies.max()), frameRate)
+    return results
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Serves synthetic tracker transforms over OpenIGTLink until interrupted, "
+                                                 "or with --benchmark measures a local receiver at several rates.")
+    parser.add_argument("recording", nargs="?", help="tracking recording to serve (default: scripted trajectories)")
+    parser.add_argument("--rate", type=float, default=120.0, help="messages per second per device")
+    parser.add_argument("--jitter", type=float, default=0.0, help="send jitter standard deviation in ms")
+    parser.add_argument("--dropout", type=float, default=0.0, help="probability of leaving out a message")
+    parser.add_argument("--port", type=int, default=DEFAULT_PORT)
+    parser.add_argument("--benchmark", nargs="*", type=float, metavar="RATE",
+                        help="rates to benchmark (default: 30 to 1000 Hz)")
+    parser.add_argument("--seconds", type=float, default=2.0, help="seconds per benchmarked rate")
+    arguments = parser.parse_args()
+
+    trajectories = recordedTrajectories(arguments.recording) if arguments.recording else scriptedTrajectories()
+    if arguments.benchmark is not None:
+        rates = arguments.benchmark or (30, 60, 120, 250, 500, 1000)
+        results = benchmarkRates(trajectories, rates, arguments.seconds, arguments.jitter / 1000, arguments.dropout)
+        for rate, (stats, received, meanLatency, maxLatency, frameRate) in results.items():
+            print("{:6.0f} Hz: {:.0f} ticks/s, sent {}, dropped {}, received {}, latency mean {:.2f} ms, max {:.2f} ms, "
+                  "send lateness max {:.2f} ms".format(rate, stats["tickRate"], stats["sent"], stats["dropped"], received,
+                                                       meanLatency, maxLatency, stats["maxLatenessMs"]))
+    else:
+        server = SyntheticTrackerServer(trajectories, arguments.rate, arguments.jitter / 1000, arguments.dropout,
+                                        arguments.port, seed=0)
+        server.start()
+        print("serving {} on port {} at {:g} Hz".format(", ".join(trajectories), server.port, arguments.rate))
+        try:
+            while True:
+                time.sleep(5.0)
+                print(server.getStats())
+                server.resetStats()
+        except KeyboardInterrupt:
+            pass
+        server.stop()
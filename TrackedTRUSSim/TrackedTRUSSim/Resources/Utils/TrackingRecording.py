@@ -0,0 +1,289 @@
+'''
+Recording and replay of tracker poses, so that the simulation can be driven, profiled and benchmarked
+without the tracking hardware.
+
+A recording is a 4096 byte header (magic, sample count, JSON manifest with the channel names) followed by
+fixed size samples (SAMPLE_DTYPE: timestamp, channel index, 4x4 matrix). The recorder writes samples into a
+memory map of the file, so an append is a copy into memory at any tracker rate, and the samples of a
+crashed process are still in the file; the map doubles in size when full. Readers map the file read-only.
+'''
+
+import json
+import mmap
+import os
+import time
+
+import numpy as np
+
+RECORDING_VERSION = 1
+RECORDING_EXTENSION = ".trustrack"
+RECORDING_MAGIC = b"TRUSTRAK"
+HEADER_SIZE = 4096
+COUNT_OFFSET = 8
+MANIFEST_OFFSET = 16
+
+SAMPLE_DTYPE = np.dtype([("timestamp", "<f8"), ("channel", "<u4"), ("reserved", "<u4"), ("matrix", "<f8", (4, 4))])
+
+
+class TrackingRecorder:
+    '''
+    Records matrices of the named channels (eg. ProbeToPhantom, PointerToPhantom) into a new recording at path.
+    '''
+
+    def __init__(self, path, channels, capacity=1 << 16):
+        self.path = path
+        self.channels = list(channels)
+        self.channelIndex = {name: index for index, name in enumerate(self.channels)}
+        manifest = json.dumps({"version": RECORDING_VERSION, "sampleSize": SAMPLE_DTYPE.itemsize,
+                               "channels": self.channels, "created": time.time()}).encode("utf-8")
+        if MANIFEST_OFFSET + len(manifest) > HEADER_SIZE:
+            raise ValueError("too many channels for the recording header")
+
+        with open(path, "wb") as f:
+            f.write((RECORDING_MAGIC + bytes(MANIFEST_OFFSET - len(RECORDING_MAGIC)) + manifest).ljust(HEADER_SIZE, b"\0"))
+        self.map = None
+        self.count = 0
+        self.mapSamples(capacity)
+
+    def unmap(self):
+        if self.map is None:
+            return
+        self.map.flush()
+        #The arrays export the map's buffer and have to go before it can be closed
+        self.header = self.samples = self.timestamps = self.channelIndices = self.matrices = None
+        self.map.close()
+        self.map = None
+
+    def mapSamples(self, capacity):
+        self.unmap()
+        with open(self.path, "r+b") as f:
+            f.truncate(HEADER_SIZE + capacity * SAMPLE_DTYPE.itemsize)
+            self.map = mmap.mmap(f.fileno(), 0)
+        #Plain arrays over the map (np.memmap indexing is several times slower per sample)
+        self.header = np.ndarray((1,), dtype="<u8", buffer=self.map, offset=COUNT_OFFSET)
+        self.samples = np.ndarray((capacity,), dtype=SAMPLE_DTYPE, buffer=self.map, offset=HEADER_SIZE)
+        #Field views, so that an append is three plain array assignments
+        self.timestamps = self.samples["timestamp"]
+        self.channelIndices = self.samples["channel"]
+        self.matrices = self.samples["matrix"]
+        self.capacity = capacity
+
+    def append(self, channel, matrix, timestamp=None):
+        '''
+        channel is a channel name or index. Returns the index of the sample.
+        '''
+        if self.count == self.capacity:
+            self.mapSamples(2 * self.capacity)
+        self.timestamps[self.count] = time.perf_counter() if timestamp is None else timestamp
+        self.channelIndices[self.count] = self.channelIndex[channel] if isinstance(channel, str) else channel
+        self.matrices[self.count] = matrix
+        #The count is written after the sample, so a reader never sees a sample that is not complete
+        self.count += 1
+        self.header[0] = self.count
+        return self.count - 1
+
+    def close(self):
+        '''
+        Flushes the samples and trims the file to them.
+        '''
+        if self.map is None:
+            return
+        self.unmap()
+        with open(self.path, "r+b") as f:
+            f.truncate(HEADER_SIZE + self.count * SAMPLE_DTYPE.itemsize)
+
+
+class TrackingRecording:
+    '''
+    A recording mapped read-only: timestamps, channel indices and matrices of all samples, in recording order.
+    '''
+
+    def __init__(self, path):
+        with open(path, "rb") as f:
+            header = f.read(HEADER_SIZE)
+        if len(header) != HEADER_SIZE or not header.startswith(RECORDING_MAGIC):
+            raise ValueError("not a tracking recording")
+        manifest = json.loads(header[MANIFEST_OFFSET:].rstrip(b"\0").decode("utf-8"))
+        if manifest.get("version") != RECORDING_VERSION or manifest.get("sampleSize") != SAMPLE_DTYPE.itemsize:
+            raise ValueError("recording version {} != {}".format(manifest.get("version"), RECORDING_VERSION))
+        self.channels = manifest["channels"]
+
+        #A recording that was not closed is longer than its sample count
+        count = int(np.frombuffer(header, dtype="<u8", count=1, offset=COUNT_OFFSET)[0])
+        count = min(count, (os.path.getsize(path) - HEADER_SIZE) // SAMPLE_DTYPE.itemsize)
+        samples = np.memmap(path, dtype=SAMPLE_DTYPE, mode="r", offset=HEADER_SIZE, shape=(count,)) if count else \
+            np.zeros(0, dtype=SAMPLE_DTYPE)
+        self.timestamps = samples["timestamp"]
+        self.channelIndices = samples["channel"]
+        self.matrices = samples["matrix"]
+
+    def __len__(self):
+        return len(self.timestamps)
+
+    @property
+    def duration(self):
+        return float(self.timestamps[-1] - self.timestamps[0]) if len(self) else 0.0
+
+    def channelSamples(self, channel):
+        '''
+        (timestamps, matrices) of one channel.
+        '''
+        selected = self.channelIndices == self.channels.index(channel)
+        return self.timestamps[selected], self.matrices[selected]
+
+
+class TrackingReplayer:
+    '''
+    Plays a recording into sink(channel name, matrix, timestamp), keeping the recorded timing scaled by 1 / speed,
+    or as fast as possible when speed is None.
+
+    step() emits the samples that are due and returns the seconds until the next one (None when finished), so
+    the replay can run from an event loop timer; run() blocks until the end. Lateness is how far behind the
+    recorded timing a sample was emitted.
+    '''
+
+    def __init__(self, recording, sink, speed=1.0, maxSamplesPerStep=None, clock=time.perf_counter):
+        self.recording = recording
+        self.sink = sink
+        self.speed = speed
+        self.maxSamplesPerStep = maxSamplesPerStep
+        self.clock = clock
+        self.position = 0
+        self.startTime = None
+        self.maxLateness = 0.0
+        self.totalLateness = 0.0
+
+    def start(self):
+        self.position = 0
+        self.maxLateness = 0.0
+        self.totalLateness = 0.0
+        self.startTime = self.clock()
+
+    def step(self):
+        if self.startTime is None:
+            self.start()
+        recording = self.recording
+        end = len(recording)
+        if self.maxSamplesPerStep is not None:
+            end = min(end, self.position + self.maxSamplesPerStep)
+        firstTimestamp = recording.timestamps[0] if len(recording) else 0.0
+
+        while self.position < end:
+            if self.speed:
+                dueTime = self.startTime + (recording.timestamps[self.position] - firstTimestamp) / self.speed
+                lateness = self.clock() - dueTime
+                if lateness < 0:
+                    return -lateness
+                self.maxLateness = max(self.maxLateness, lateness)
+                self.totalLateness += lateness
+            self.sink(recording.channels[recording.channelIndices[self.position]], recording.matrices[self.position],
+                      recording.timestamps[self.position])
+            self.position += 1
+        return 0.0 if self.position < len(recording) else None
+
+    def run(self, sleep=time.sleep):
+        self.start()
+        delay = self.step()
+        while delay is not None:
+            if delay > 0:
+                sleep(delay)
+            delay = self.step()
+        return self.clock() - self.startTime
+
+    def getStats(self):
+        return {"samples": self.position, "maxLateness": float(self.maxLateness),
+                "meanLateness": float(self.totalLateness / self.position) if self.position and self.speed else 0.0}
+
+
+def sweepPose(timestamp):
+    '''
+    ProbeToPhantom of a probe rocking +-30 degrees about its axis every 4 s while moving in and out every 7 s.
+    '''
+    angle = np.radians(30.0 * np.sin(2 * np.pi * timestamp / 4.0))
+    probe = np.eye(4)
+    probe[:3, :3] = [[1, 0, 0], [0, np.cos(angle), -np.sin(angle)], [0, np.sin(angle), np.cos(angle)]]
+    probe[:3, 3] = [50.0, 50.0, 50.0 + 5.0 * np.sin(2 * np.pi * timestamp / 7.0)]
+    return probe
+
+
+def syntheticSweep(path, seconds=10.0, rate=120.0, channels=("ProbeToPhantom", "PointerToPhantom")):
+    '''
+    Records a probe sweeping back and forth (and a still pointer) at rate samples per second per channel.
+    '''
+    recorder = TrackingRecorder(path, channels)
+    for index in range(int(seconds * rate)):
+        timestamp = index / rate
+        recorder.append(0, sweepPose(timestamp), timestamp)
+        for channel in range(1, len(channels)):
+            recorder.append(channel, np.eye(4), timestamp)
+    recorder.close()
+    return TrackingRecording(path)
+
+
+def benchmarkRecorder(path, samples=1000000):
+    '''
+    Microseconds per appended sample.
+    '''
+    matrix = np.eye(4)
+    recorder = TrackingRecorder(path, ["ProbeToPhantom"])
+    startTime = time.perf_counter()
+    for index in range(samples):
+        recorder.append(0, matrix, float(index))
+    elapsed = time.perf_counter() - startTime
+    recorder.close()
+    return 1e6 * elapsed / samples
+
+
+if __name__ == "__main__":
+    import argparse
+    import tempfile
+    import vtk
+    from vtk.util import numpy_support
+    from .AssetBundle import readBundleTransforms
+    from .HeadlessPipeline import HeadlessPipeline
+    from .NrrdIO import readNrrd
+    from .SliceGenerator import UltrasoundSliceGenerator, syntheticVolume
+    from .VolumeReconstruction import VolumeCompounder
+
+    parser = argparse.ArgumentParser(description="Replays a tracking recording through the headless pipeline. Without a "
+                                                 "recording, benchmarks the recorder and replays a synthetic sweep.")
+    parser.add_argument("recording", nargs="?")
+    parser.add_argument("--volume", help="NRRD volume to sample, placed by its own IJK to RAS (default: synthetic)")
+    parser.add_argument("--speed", type=float, default=None, help="replay speed (default: as fast as possible)")
+    parser.add_argument("--spacing", type=float, default=2.0, help="reconstruction spacing in mm")
+    arguments = parser.parse_args()
+
+    resourceDir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    bundlePath = os.path.join(resourceDir, "BaseScene.bundle.npz")
+    temporaryPath = os.path.join(tempfile.gettempdir(), "Benchmark" + RECORDING_EXTENSION)
+    if arguments.recording is None:
+        print("recorder: {:.2f} us per sample".format(benchmarkRecorder(temporaryPath)))
+        recording = syntheticSweep(temporaryPath)
+        staticTransforms = {}
+    else:
+        recording = TrackingRecording(arguments.recording)
+        staticTransforms = readBundleTransforms(bundlePath) if os.path.exists(bundlePath) else {}
+
+    generator = UltrasoundSliceGenerator(maskIJKToMask=np.diag([0.25, 0.25, 1.0, 1.0]))
+    if arguments.volume:
+        array, ijkToRAS, _ = readNrrd(arguments.volume)
+        imageData = vtk.vtkImageData()
+        imageData.SetDimensions(array.shape[::-1])
+        imageData.GetPointData().SetScalars(numpy_support.numpy_to_vtk(array.reshape(-1), deep=True))
+        generator.setVolume(imageData, ijkToRAS)
+    else:
+        imageData, ijkToRAS = syntheticVolume((200, 200, 200)), np.eye(4)
+        generator.setVolume(imageData, ijkToRAS)
+    corners = np.array([[i, j, k, 1.0] for i in (0, imageData.GetDimensions()[0] - 1) for j in (0, imageData.GetDimensions()[1] - 1)
+                        for k in (0, imageData.GetDimensions()[2] - 1)]) @ ijkToRAS.T
+    bounds = np.ravel(np.column_stack((corners[:, :3].min(axis=0), corners[:, :3].max(axis=0))))
+    pipeline = HeadlessPipeline(staticTransforms, generator, VolumeCompounder.fromBounds(bounds, arguments.spacing))
+
+    replayer = TrackingReplayer(recording, pipeline.setMatrixToParent, speed=arguments.speed)
+    elapsed = replayer.run()
+    stats = replayer.getStats()
+    print("replayed {} samples ({:.1f} s recorded) in {:.2f} s: {} frames, {:.0f} per second, lateness max {:.1f} ms".format(
+        len(recording), recording.duration, elapsed, pipeline.frameCount, pipeline.frameCount / elapsed,
+        1000 * stats["maxLateness"]))
+    if arguments.recording is None:
+        os.remove(temporaryPath)
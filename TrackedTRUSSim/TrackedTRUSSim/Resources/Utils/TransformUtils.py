@@ -0,0 +1,101 @@
+import numpy as np
+import vtk
+
+
+def arrayFromVTKMatrix(vmatrix):
+    '''
+    Returns a 4x4 numpy array with the contents of a vtkMatrix4x4.
+    '''
+    matrix = np.eye(4)
+    vmatrix.DeepCopy(matrix.ravel(), vmatrix)
+    return matrix
+
+
+def updateVTKMatrixFromArray(vmatrix, matrix):
+    '''
+    Copies a 4x4 numpy array into an existing vtkMatrix4x4 (which triggers a single Modified()).
+    '''
+    vmatrix.DeepCopy(np.ascontiguousarray(matrix, dtype=float).ravel())
+    return vmatrix
+
+
+def vtkMatrixFromArray(matrix):
+    return updateVTKMatrixFromArray(vtk.vtkMatrix4x4(), matrix)
+
+
+class TransformChainCache:
+    '''
+    Computes frame-to-world matrices of a transform hierarchy with every run of static links
+    precomposed into a single matrix. Only the dynamic links (eg. tracker poses) are read on
+    each lookup; a static run is recomposed only after invalidate() is called for one of its links.
+
+    getMatrixToParent(linkName) returns the current 4x4 matrix to parent of a link.
+    '''
+
+    def __init__(self, getMatrixToParent, dynamicLinks=()):
+        self.getMatrixToParent = getMatrixToParent
+        self.dynamicLinks = set(dynamicLinks)
+        self.chains = {}
+        self.compiledChains = {}
+        self.compileCount = 0
+
+    def addChain(self, frameName, links):
+        '''
+        links are the link names from the world side down to the frame, eg.
+        [ReferenceToRAS, PhantomToReference, ProbeToPhantom, ProbeTipToProbe].
+        '''
+        self.chains[frameName] = list(links)
+        self.compiledChains.pop(frameName, None)
+
+    def links(self):
+        allLinks = set()
+        for links in self.chains.values():
+            allLinks.update(links)
+        return allLinks
+
+    def staticLinks(self):
+        return self.links() - self.dynamicLinks
+
+    def invalidate(self, linkName=None):
+        '''
+        Drops the precomposed matrices of every chain that contains linkName (or of all chains).
+        '''
+        if linkName is None:
+            self.compiledChains.clear()
+            return
+        for frameName, links in self.chains.items():
+            if linkName in links:
+                self.compiledChains.pop(frameName, None)
+
+    def compile(self, frameName):
+        '''
+        Returns the chain as a list of precomposed static matrices and dynamic link names.
+        '''
+        compiled = self.compiledChains.get(frameName)
+        if compiled is not None:
+            return compiled
+
+        compiled = []
+        staticRun = None
+        for link in self.chains[frameName]:
+            if link in self.dynamicLinks:
+                if staticRun is not None:
+                    compiled.append(staticRun)
+                    staticRun = None
+                compiled.append(link)
+            else:
+                matrix = np.asarray(self.getMatrixToParent(link), dtype=float)
+                staticRun = matrix if staticRun is None else staticRun @ matrix
+        if staticRun is not None:
+            compiled.append(staticRun)
+
+        self.compiledChains[frameName] = compiled
+        self.compileCount += 1
+        return compiled
+
+    def matrixToWorld(self, frameName):
+        result = None
+        for item in self.compile(frameName):
+            matrix = self.getMatrixToParent(item) if isinstance(item, str) else item
+            result = matrix if result is None else result @ matrix
+        return np.eye(4) if result is None else np.array(result, dtype=float)
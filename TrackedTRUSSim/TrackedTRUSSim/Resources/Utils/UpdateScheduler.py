@@ -0,0 +1,119 @@
+import time
+from collections import deque
+
+
+class CoalescingScheduler:
+    '''
+    Sits between transform observers and the per-frame simulation work.
+
+    Observer callbacks only record that a new pose arrived; the work itself runs at most
+    maxRate times per second, always for the latest pose. Events that arrive while one is
+    already pending are coalesced into it. The latest pose is always processed, so the view
+    settles on it even after a stall; the events it replaced are counted as dropped when the
+    oldest of them waited longer than maxLatency seconds (eg. because the UI was blocked).
+
+    scheduleCallback(delaySeconds, function) is used to run processPending later, eg. with
+    qt.QTimer.singleShot. Without it the owner has to call processPending itself (poll mode).
+    '''
+
+    def __init__(self, callback, maxRate=30.0, maxLatency=0.5, scheduleCallback=None, clock=time.perf_counter):
+        self.callback = callback
+        self.maxLatency = maxLatency
+        self.scheduleCallback = scheduleCallback
+        self.clock = clock
+        self.setMaxRate(maxRate)
+
+        self.observations = []
+        self.pendingEvent = None
+        #Arrival of the oldest event coalesced into the pending one, and how many it replaced
+        self.pendingSince = None
+        self.pendingReplaced = 0
+        self.tickScheduled = False
+        self.lastProcessedTime = None
+        self.currentEventTime = None
+        #Seconds from the arrival of the processed pose to the end of its callback, for the last frames
+        self.latencies = deque(maxlen=1000)
+        self.resetCounts()
+
+    def setMaxRate(self, maxRate):
+        self.maxRate = maxRate
+        self.minInterval = 1.0 / maxRate if maxRate else 0.0
+
+    def resetCounts(self):
+        self.receivedCount = 0
+        self.processedCount = 0
+        self.coalescedCount = 0
+        self.droppedCount = 0
+        self.latencies.clear()
+
+    def getCounts(self):
+        return {"received": self.receivedCount, "processed": self.processedCount,
+                "coalesced": self.coalescedCount, "dropped": self.droppedCount}
+
+    def observe(self, node, eventId):
+        '''
+        Adds an observer to node and remembers its tag, so that detachAll only removes observers added here.
+        '''
+        tag = node.AddObserver(eventId, self.onEvent)
+        self.observations.append((node, tag))
+        return tag
+
+    def detachAll(self):
+        for node, tag in self.observations:
+            node.RemoveObserver(tag)
+        self.observations = []
+        self.pendingEvent = None
+        self.pendingSince = None
+        self.pendingReplaced = 0
+
+    def onEvent(self, caller, eventId):
+        now = self.clock()
+        self.receivedCount += 1
+        if self.pendingEvent is not None:
+            self.coalescedCount += 1
+            self.pendingReplaced += 1
+        else:
+            self.pendingSince = now
+        self.pendingEvent = (caller, eventId, now)
+        self.scheduleTick(now)
+
+    def scheduleTick(self, now):
+        if self.scheduleCallback is None or self.tickScheduled:
+            return
+        self.tickScheduled = True
+        self.scheduleCallback(max(0.0, self.nextAllowedTime() - now), self.processPending)
+
+    def nextAllowedTime(self):
+        if self.lastProcessedTime is None:
+            return 0.0
+        return self.lastProcessedTime + self.minInterval
+
+    def processPending(self):
+        '''
+        Runs the callback for the pending event if the rate cap allows it. Returns True if it ran.
+        '''
+        self.tickScheduled = False
+        if self.pendingEvent is None:
+            return False
+
+        now = self.clock()
+        if now < self.nextAllowedTime():
+            self.scheduleTick(now)
+            return False
+
+        caller, eventId, eventTime = self.pendingEvent
+        if self.maxLatency is not None and now - self.pendingSince > self.maxLatency:
+            #Stalled: the poses replaced by the latest one were never shown in time
+            self.coalescedCount -= self.pendingReplaced
+            self.droppedCount += self.pendingReplaced
+        self.pendingEvent = None
+        self.pendingSince = None
+        self.pendingReplaced = 0
+
+        self.lastProcessedTime = now
+        self.processedCount += 1
+        #The callback can read when its pose arrived
+        self.currentEventTime = eventTime
+        self.callback(caller, eventId)
+        self.latencies.append(self.clock() - eventTime)
+        return True
@@ -0,0 +1,242 @@
+import math
+import time
+
+import numpy as np
+import vtk
+from vtk.util import numpy_support
+
+from .FrameBuffer import FrameStats
+
+
+class VolumeCompounder:
+    '''
+    Incremental freehand 3D reconstruction: every tracked 2D frame is inserted into a persistent
+    output grid, either into the nearest voxel of each pixel (NEAREST) or splatted into the 8
+    surrounding voxels with trilinear weights (WEIGHTED).
+
+    Only the voxels a frame touches are updated, so the cost of a frame depends on the frame
+    size and not on the grid size. Voxels that no pixel reached stay empty until fillHoles,
+    which only looks at the region touched since the previous fill.
+
+    Arrays are indexed [k, j, i] like VTK image data; gridIJKToWorld maps (i, j, k) to RAS.
+    '''
+
+    NEAREST = "Nearest"
+    WEIGHTED = "Weighted"
+
+    def __init__(self, gridIJKToWorld, dimensions, method=NEAREST):
+        self.gridIJKToWorld = np.array(gridIJKToWorld, dtype=float)
+        self.worldToGridIJK = np.linalg.inv(self.gridIJKToWorld)
+        self.dimensions = tuple(int(d) for d in dimensions)
+        self.method = method
+
+        shape = self.dimensions[::-1]
+        self.accumulator = np.zeros(shape, dtype=np.float32)
+        self.weights = np.zeros(shape, dtype=np.float32)
+        self.output = np.zeros(shape, dtype=np.uint8)
+
+        #Image data that wraps self.output without copying
+        self.vtkArray = numpy_support.numpy_to_vtk(self.output.reshape(-1), deep=False, array_type=vtk.VTK_UNSIGNED_CHAR)
+        self.imageData = vtk.vtkImageData()
+        self.imageData.SetDimensions(self.dimensions)
+        self.imageData.GetPointData().SetScalars(self.vtkArray)
+
+        self.pixelShape = None
+        self.pixelMask = None
+        self.pixelCoordinates = None
+        self.pixelIndices = None
+
+        self.dirtyMin = None
+        self.dirtyMax = None
+        self.stats = FrameStats()
+
+    @classmethod
+    def fromBounds(cls, bounds, spacing, method=NEAREST):
+        '''
+        Grid with isotropic spacing (in mm) that covers RAS bounds (xmin, xmax, ymin, ymax, zmin, zmax).
+        '''
+        origin = [bounds[0], bounds[2], bounds[4]]
+        dimensions = [int(math.ceil((bounds[2 * axis + 1] - bounds[2 * axis]) / spacing)) + 1 for axis in range(3)]
+        gridIJKToWorld = np.diag([spacing, spacing, spacing, 1.0])
+        gridIJKToWorld[:3, 3] = origin
+        return cls(gridIJKToWorld, dimensions, method)
+
+    def reset(self):
+        self.accumulator.fill(0)
+        self.weights.fill(0)
+        self.output.fill(0)
+        self.dirtyMin = None
+        self.dirtyMax = None
+        self.stats.reset()
+        self.markModified()
+
+    def markModified(self):
+        self.vtkArray.Modified()
+        self.imageData.Modified()
+
+    def setPixels(self, height, width, mask=None):
+        '''
+        Caches the homogeneous coordinates of the frame pixels to insert (the pixels inside mask, or all of them).
+        '''
+        if (height, width) == self.pixelShape and mask is self.pixelMask:
+            return
+        if mask is None:
+            rows, cols = np.divmod(np.arange(height * width), width)
+        else:
+            rows, cols = np.nonzero(mask)
+        self.pixelCoordinates = np.vstack((cols, rows, np.zeros_like(cols), np.ones_like(cols))).astype(np.float64)
+        self.pixelIndices = rows * width + cols
+        self.pixelShape = (height, width)
+        self.pixelMask = mask
+
+    def insertFrame(self, frame, imageIJKToWorld, mask=None):
+        '''
+        Inserts a 2D frame (rows x columns) whose pixel (i, j) is at imageIJKToWorld @ (i, j, 0, 1).
+        Returns the number of voxels that were updated.
+        '''
+        startTime = time.perf_counter()
+
+        height, width = frame.shape[-2:]
+        self.setPixels(height, width, mask)
+        pixelToGrid = (self.worldToGridIJK @ np.asarray(imageIJKToWorld, dtype=float))[:3]
+        points = pixelToGrid @ self.pixelCoordinates
+        values = frame.reshape(-1)[self.pixelIndices].astype(np.float32)
+
+        if self.method == self.WEIGHTED:
+            flatIndices, pixelWeights, values = self.trilinearSplat(points, values)
+        else:
+            flatIndices, pixelWeights, values = self.nearestVoxels(points, values)
+        if flatIndices.size == 0:
+            return 0
+
+        #Sum the contributions per voxel; sorting the touched voxels keeps this independent of the grid size
+        voxels, inverse = np.unique(flatIndices, return_inverse=True)
+        accumulator = self.accumulator.reshape(-1)
+        weights = self.weights.reshape(-1)
+        accumulator[voxels] += np.bincount(inverse, weights=values * pixelWeights, minlength=voxels.size)
+        weights[voxels] += np.bincount(inverse, weights=pixelWeights, minlength=voxels.size)
+        self.output.reshape(-1)[voxels] = np.clip(accumulator[voxels] / weights[voxels] + 0.5, 0, 255)
+
+        self.markDirty(voxels)
+        self.markModified()
+        self.stats.addFrame(time.perf_counter() - startTime, 0)
+        return voxels.size
+
+    def nearestVoxels(self, points, values):
+        ijk = np.rint(points).astype(np.intp)
+        inside = self.insideGrid(ijk)
+        ijk = ijk[:, inside]
+        return self.flatIndex(ijk), np.ones(ijk.shape[1], dtype=np.float32), values[inside]
+
+    def trilinearSplat(self, points, values):
+        base = np.floor(points).astype(np.intp)
+        fraction = (points - base).astype(np.float32)
+        flatIndices, pixelWeights, cornerValues = [], [], []
+        for offset in np.ndindex(2, 2, 2):
+            corner = base + np.array(offset, dtype=np.intp)[:, None]
+            weight = np.prod(np.where(np.array(offset)[:, None] == 1, fraction, 1.0 - fraction), axis=0)
+            inside = np.logical_and(self.insideGrid(corner), weight > 0)
+            flatIndices.append(self.flatIndex(corner[:, inside]))
+            pixelWeights.append(weight[inside])
+            cornerValues.append(values[inside])
+        return np.concatenate(flatIndices), np.concatenate(pixelWeights), np.concatenate(cornerValues)
+
+    def insideGrid(self, ijk):
+        dimensions = np.array(self.dimensions)[:, None]
+        return np.logical_and(ijk >= 0, ijk < dimensions).all(axis=0)
+
+    def flatIndex(self, ijk):
+        return ijk[0] + self.dimensions[0] * (ijk[1] + self.dimensions[1] * ijk[2])
+
+    def markDirty(self, voxels):
+        #voxels is sorted, so the first and last give the k range; j and i need the full range
+        kji = np.unravel_index(voxels, self.output.shape)
+        voxelMin = np.array([kji[0][0], kji[1].min(), kji[2].min()])
+        voxelMax = np.array([kji[0][-1], kji[1].max(), kji[2].max()])
+        if self.dirtyMin is None:
+            self.dirtyMin, self.dirtyMax = voxelMin, voxelMax
+        else:
+            self.dirtyMin = np.minimum(self.dirtyMin, voxelMin)
+            self.dirtyMax = np.maximum(self.dirtyMax, voxelMax)
+
+    def fillHoles(self, radius=1):
+        '''
+        Fills empty voxels in the region touched since the last fill with the weighted mean of the
+        non-empty voxels in the surrounding (2 * radius + 1) cube. Filled voxels are not added to the
+        accumulator, so real data inserted later replaces them. Returns the number of voxels filled.
+        '''
+        if self.dirtyMin is None:
+            return 0
+        low = np.maximum(self.dirtyMin - radius, 0)
+        high = np.minimum(self.dirtyMax + radius + 1, self.output.shape)
+        region = tuple(slice(l, h) for l, h in zip(low, high))
+
+        accumulator = self.accumulator[region]
+        weights = self.weights[region]
+        neighbourSum = boxSum(accumulator, radius)
+        neighbourWeight = boxSum(weights, radius)
+
+        holes = np.logical_and(weights == 0, neighbourWeight > 0)
+        output = self.output[region]
+        output[holes] = np.clip(neighbourSum[holes] / neighbourWeight[holes] + 0.5, 0, 255)
+
+        self.dirtyMin = None
+        self.dirtyMax = None
+        self.markModified()
+        return int(holes.sum())
+
+
+def boxSum(array, radius):
+    '''
+    Sum over a (2 * radius + 1) cube around every element, with zero padding, using separable sums.
+    '''
+    result = array.astype(np.float32)
+    for axis in range(3):
+        padWidth = [(0, 0)] * 3
+        padWidth[axis] = (radius, radius)
+        padded = np.pad(result, padWidth)
+        length = result.shape[axis]
+        result = sum(np.take(padded, range(offset, offset + length), axis=axis) for offset in range(2 * radius + 1))
+    return result
+
+
+def benchmarkCompounding(spacings=(2.0, 1.0, 0.5, 0.25), frames=100, extent=60.0, method=VolumeCompounder.NEAREST):
+    '''
+    Inserts the same sweep of 400x400 fan frames into grids of a 60 mm cube at several spacings and
+    returns frames per second and the hole filling time for each grid resolution.
+    '''
+    from .GenerateFanMask import fanMaskEngine
+
+    fanMask = fanMaskEngine.getMask(210, 40, 140, 400, 400, (200, 300))
+    rng = np.random.default_rng(0)
+    frame = rng.integers(0, 256, size=fanMask.shape, dtype=np.uint8)
+    pixelSpacing = 0.15
+
+    results = []
+    for spacing in spacings:
+        compounder = VolumeCompounder.fromBounds([0, extent, 0, extent, 0, extent], spacing, method)
+        startTime = time.perf_counter()
+        for index in range(frames):
+            #Rotate the fan about the probe axis (world x), like a TRUS sweep
+            angle = math.radians(-60 + 120.0 * index / frames)
+            imageToWorld = np.eye(4)
+            imageToWorld[:3, :3] = np.array([[0, 0, 1], [math.cos(angle), -math.sin(angle), 0],
+                                             [math.sin(angle), math.cos(angle), 0]]) @ np.diag([pixelSpacing, -pixelSpacing, 1])
+            imageToWorld[:3, 3] = [extent / 2, extent / 2, extent / 2]
+            imageToWorld[:3, 3] -= imageToWorld[:3, :3] @ [200, 300, 0]
+            compounder.insertFrame(frame, imageToWorld, fanMask)
+        elapsed = time.perf_counter() - startTime
+
+        startTime = time.perf_counter()
+        filled = compounder.fillHoles()
+        results.append({"spacing": spacing, "voxels": int(np.prod(compounder.dimensions)),
+                        "fps": frames / elapsed, "holeFillSeconds": time.perf_counter() - startTime,
+                        "filledVoxels": filled})
+    return results
+
+
+if __name__ == "__main__":
+    for method in (VolumeCompounder.NEAREST, VolumeCompounder.WEIGHTED):
+        for result in benchmarkCompounding(method=method):
+            print("{} spacing {spacing} mm ({voxels} voxels): {fps:.1f} fps, hole filling {holeFillSeconds:.3f} s "
+                  "({filledVoxels} voxels)".format(method, **result))
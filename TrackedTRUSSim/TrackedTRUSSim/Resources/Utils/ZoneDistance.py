@@ -0,0 +1,169 @@
+'''
+Signed distance fields of the prostate zones, for constant cost distance readouts at any pose.
+
+Each zone of a ZoneSamplingIndex gets a signed Euclidean distance transform in mm (negative inside the
+zone) on the labelmap grid. The fields are computed once per case, cached in an .npz beside the case
+that records the sha256 of its Zones.seg.nrrd, and read with trilinear interpolation.
+'''
+
+import os
+import time
+
+import numpy as np
+
+from .ArrayUtils import atomicSaveNpz, interpolateTrilinear
+from .AssetBundle import fileHash
+from .ZoneIndex import ZONES, ZoneSamplingIndex
+
+DISTANCE_CACHE_VERSION = 1
+
+
+def squaredDistanceAlongAxis(squaredDistance, spacing, axis, chunkElements=1 << 24):
+    '''
+    One pass of the separable exact EDT: min over j of f[j] + ((i - j) * spacing)^2 along axis.
+    The (n x n) candidates are evaluated in chunks of lines to bound memory.
+    '''
+    moved = np.moveaxis(squaredDistance, axis, -1)
+    lines = moved.reshape(-1, moved.shape[-1])
+    n = lines.shape[1]
+    offsets = np.arange(n, dtype=np.float32)
+    penalty = ((offsets[:, None] - offsets[None, :]) * spacing) ** 2
+    result = np.empty_like(lines)
+    linesPerChunk = max(1, chunkElements // (n * n))
+    for start in range(0, len(lines), linesPerChunk):
+        chunk = lines[start:start + linesPerChunk]
+        result[start:start + linesPerChunk] = (chunk[:, None, :] + penalty[None, :, :]).min(axis=2)
+    return np.moveaxis(result.reshape(moved.shape), -1, axis)
+
+
+def distanceToMask(mask, spacing):
+    '''
+    Euclidean distance in mm from every voxel to the nearest voxel of mask (0 inside mask). mask is
+    indexed [k, j, i] and spacing is given as (i, j, k) for an orthogonal grid.
+    '''
+    if not mask.any():
+        return np.full(mask.shape, np.inf, dtype=np.float32)
+    squaredDistance = np.where(mask, 0.0, np.inf).astype(np.float32)
+    for axis, axisSpacing in zip((2, 1, 0), spacing):
+        squaredDistance = squaredDistanceAlongAxis(squaredDistance, axisSpacing, axis)
+    return np.sqrt(squaredDistance)
+
+
+def signedDistance(mask, spacing):
+    '''
+    Distance to the zone for voxels outside of it, minus the distance to the outside for voxels inside.
+    '''
+    return distanceToMask(mask, spacing) - distanceToMask(~mask, spacing)
+
+
+class ZoneDistanceField:
+    '''
+    fields: {zone name: signed distance [k, j, i] in mm} on the grid of labelsIJKToZones.
+    '''
+
+    def __init__(self, fields, labelsIJKToZones):
+        self.fields = fields
+        self.labelsIJKToZones = np.array(labelsIJKToZones, dtype=float)
+        self.setZonesToWorld(np.eye(4))
+
+    @classmethod
+    def fromZoneIndex(cls, zoneIndex, zones=None):
+        labels = zoneIndex.zones[1:-1, 1:-1, 1:-1]
+        spacing = np.linalg.norm(zoneIndex.labelsIJKToZones[:3, :3], axis=0)
+        fields = {}
+        for zone in zones or ZONES[1:]:
+            mask = labels == ZONES.index(zone)
+            if mask.any():
+                fields[zone] = signedDistance(mask, spacing)
+        return cls(fields, zoneIndex.labelsIJKToZones)
+
+    @property
+    def nbytes(self):
+        return sum(field.nbytes for field in self.fields.values())
+
+    def setZonesToWorld(self, zonesToWorld):
+        self.worldToIJK = np.linalg.inv(np.asarray(zonesToWorld, dtype=float) @ self.labelsIJKToZones)
+        self.worldToMM = np.linalg.norm((np.asarray(zonesToWorld, dtype=float) @ self.labelsIJKToZones)[:3, :3], axis=0)
+
+    def distance(self, zone, pointsWorld):
+        '''
+        Signed distance (mm) from each N x 3 world point to the boundary of zone, or None if the case has no such
+        zone. Points outside the grid get the distance at the nearest grid point plus the distance to the grid.
+        '''
+        field = self.fields.get(zone)
+        if field is None:
+            return None
+        pointsWorld = np.atleast_2d(np.asarray(pointsWorld, dtype=float))
+        ijk = pointsWorld @ self.worldToIJK[:3, :3].T + self.worldToIJK[:3, 3]
+        upper = np.array(field.shape[::-1], dtype=float) - 1
+        clamped = np.clip(ijk, 0, upper)
+        outsideGrid = np.linalg.norm((ijk - clamped) * self.worldToMM, axis=1)
+        return interpolateTrilinear(field, clamped) + outsideGrid
+
+    def save(self, path, sourceHash):
+        arrays = {"field_" + zone: field for zone, field in self.fields.items()}
+        atomicSaveNpz(path, version=DISTANCE_CACHE_VERSION, sourceHash=sourceHash,
+                      labelsIJKToZones=self.labelsIJKToZones, **arrays)
+
+    @classmethod
+    def load(cls, path, sourceHash):
+        '''
+        Returns the cached fields, or None if there are none for this version of the zone file.
+        '''
+        if not os.path.exists(path):
+            return None
+        try:
+            with np.load(path) as cached:
+                if int(cached["version"]) != DISTANCE_CACHE_VERSION or str(cached["sourceHash"]) != sourceHash:
+                    return None
+                fields = {name[len("field_"):]: cached[name] for name in cached.files if name.startswith("field_")}
+                return cls(fields, cached["labelsIJKToZones"])
+        except (OSError, ValueError, KeyError):
+            return None
+
+
+def zoneDistanceCachePath(zonePath):
+    return os.path.join(os.path.dirname(zonePath), "ZoneDistances.npz")
+
+
+def loadCachedZoneDistances(zonePath):
+    '''
+    Distance fields of a Zones.seg.nrrd from the cache beside it, or None if it does not match the file.
+    '''
+    return ZoneDistanceField.load(zoneDistanceCachePath(zonePath), fileHash(zonePath))
+
+
+def loadOrComputeZoneDistances(zonePath, zoneIndex=None):
+    '''
+    Distance fields of a Zones.seg.nrrd, from the cache beside it when it matches the file, otherwise computed
+    and cached.
+    '''
+    sourceHash = fileHash(zonePath)
+    cachePath = zoneDistanceCachePath(zonePath)
+    distanceField = ZoneDistanceField.load(cachePath, sourceHash)
+    if distanceField is not None:
+        return distanceField
+    if zoneIndex is None:
+        zoneIndex = ZoneSamplingIndex.fromSegmentationFile(zonePath)
+    distanceField = ZoneDistanceField.fromZoneIndex(zoneIndex)
+    try:
+        distanceField.save(cachePath, sourceHash)
+    except OSError:
+        pass #Read-only install; the fields are simply computed again next time
+    return distanceField
+
+
+if __name__ == "__main__":
+    import glob
+    resourceDir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    for path in sorted(glob.glob(os.path.join(resourceDir, "registered_zones", "Patient_*", "Zones.seg.nrrd"))):
+        zoneIndex = ZoneSamplingIndex.fromSegmentationFile(path)
+        startTime = time.perf_counter()
+        distanceField = ZoneDistanceField.fromZoneIndex(zoneIndex)
+        computeTime = time.perf_counter() - startTime
+        points = np.random.default_rng(0).uniform(-40, 40, size=(1, 3))
+        startTime = time.perf_counter()
+        for repeat in range(1000):
+            distanceField.distance("PZ", points)
+        print("{}: fields computed in {:.2f} s, {:.4f} ms per lookup".format(
+            os.path.relpath(path, resourceDir), computeTime, (time.perf_counter() - startTime)))
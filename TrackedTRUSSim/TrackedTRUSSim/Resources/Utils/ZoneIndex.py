@@ -0,0 +1,145 @@
+'''
+Which prostate zones a biopsy core samples, looked up directly in the voxels of the zone labelmap.
+
+The segment names of the Zones.seg.nrrd files differ between cases (CZ / central / Central, ...), so labels
+are mapped to the canonical ZONES once when the index is built. Index 0 is everything outside the zones.
+'''
+
+import math
+import time
+
+import numpy as np
+
+from . import NrrdIO
+
+ZONES = ("Outside", "CZ", "PZ", "TZ", "U", "AFS", "Other")
+
+ZONE_ALIASES = {
+    "cz": "CZ", "central": "CZ",
+    "pz": "PZ", "peripheral": "PZ",
+    "tz": "TZ", "transition": "TZ",
+    "u": "U", "urethra": "U",
+    "afs": "AFS", "anterior": "AFS",
+}
+
+
+def canonicalZone(segmentName):
+    return ZONE_ALIASES.get(segmentName.strip().lower(), "Other")
+
+
+def labelNamesFromMetadata(keyValues):
+    '''
+    {label value: segment name} from the Segment<N>_LabelValue / Segment<N>_Name fields of a .seg.nrrd header.
+    '''
+    labelNames = {}
+    index = 0
+    while "Segment{}_Name".format(index) in keyValues:
+        label = int(keyValues.get("Segment{}_LabelValue".format(index), index + 1))
+        labelNames[label] = keyValues["Segment{}_Name".format(index)]
+        index += 1
+    return labelNames
+
+
+class ZoneSamplingIndex:
+    '''
+    The labelmap converted once to canonical zone indices (uint8) with a one voxel border of Outside, so a
+    lookup is a matrix product, a rounding and a gather: no bounds checks and no per-point Python.
+
+    labels are indexed [k, j, i]; labelsIJKToZones maps voxel (i, j, k) to the coordinates of the zone
+    segmentation node, and setZonesToWorld places that node in the world (its parent transforms).
+    '''
+
+    def __init__(self, labels, labelsIJKToZones, labelNames):
+        #Slicer casts floating point labelmaps to integers by truncation when importing them; do the same
+        labels = np.asarray(labels).astype(np.int64)
+        maxLabel = max(int(labels.max()), max(labelNames, default=0))
+        labelToZone = np.full(maxLabel + 1, ZONES.index("Other"), dtype=np.uint8)
+        labelToZone[0] = 0
+        for label, name in labelNames.items():
+            labelToZone[label] = ZONES.index(canonicalZone(name))
+        zones = labelToZone[np.clip(labels, 0, maxLabel)]
+
+        self.zones = np.pad(zones, 1)
+        self.labelNames = dict(labelNames)
+        self.labelsIJKToZones = np.array(labelsIJKToZones, dtype=float)
+        self.spacing = float(np.linalg.norm(self.labelsIJKToZones[:3, :3], axis=0).min())
+        self.setZonesToWorld(np.eye(4))
+
+    @classmethod
+    def fromSegmentationFile(cls, path):
+        labels, ijkToRAS, keyValues = NrrdIO.readNrrd(path)
+        return cls(labels, ijkToRAS, labelNamesFromMetadata(keyValues))
+
+    @property
+    def nbytes(self):
+        return self.zones.nbytes
+
+    def setZonesToWorld(self, zonesToWorld):
+        #World to padded (k, j, i) voxel index, rows reordered so the result indexes self.zones directly
+        worldToIJK = np.linalg.inv(np.asarray(zonesToWorld, dtype=float) @ self.labelsIJKToZones)
+        self.worldToPaddedKJI = worldToIJK[[2, 1, 0, 3]]
+        self.worldToPaddedKJI[:3, 3] += 1
+
+    def sampleZones(self, pointsWorld):
+        '''
+        Zone index of each of the N x 3 world points.
+        '''
+        kji = np.rint(pointsWorld @ self.worldToPaddedKJI[:3, :3].T + self.worldToPaddedKJI[:3, 3]).astype(np.intp)
+        np.clip(kji, 0, np.array(self.zones.shape) - 1, out=kji)
+        return self.zones[kji[:, 0], kji[:, 1], kji[:, 2]]
+
+    def segmentPoints(self, start, end, segmentToWorld=None):
+        length = float(np.linalg.norm(np.subtract(end, start)))
+        #Half a voxel between samples, so no voxel along the segment is skipped
+        samples = max(2, int(math.ceil(2 * length / self.spacing)) + 1)
+        t = np.linspace(0.0, 1.0, samples)[:, None]
+        points = (1 - t) * np.asarray(start, dtype=float) + t * np.asarray(end, dtype=float)
+        if segmentToWorld is not None:
+            segmentToWorld = np.asarray(segmentToWorld, dtype=float)
+            points = points @ segmentToWorld[:3, :3].T + segmentToWorld[:3, 3]
+        return points
+
+    def segmentComposition(self, start, end, segmentToWorld=None):
+        '''
+        Fraction of the segment from start to end (in segment coordinates) in each of the ZONES.
+        '''
+        zones = self.sampleZones(self.segmentPoints(start, end, segmentToWorld))
+        return np.bincount(zones, minlength=len(ZONES)) / float(len(zones))
+
+
+def formatComposition(fractions, minimumFraction=0.005):
+    '''
+    eg. "PZ 60%, TZ 40%"; Outside is only listed when the segment is entirely outside the zones.
+    '''
+    parts = ["{} {:.0f}%".format(ZONES[index], 100 * fraction) for index, fraction in enumerate(fractions)
+             if index > 0 and fraction >= minimumFraction]
+    return ", ".join(parts) if parts else ZONES[0]
+
+
+def benchmarkSegmentComposition(path, repeats=1000):
+    '''
+    Mean time in ms of one composition lookup for a 12 mm core at random poses in the zones' bounding box.
+    '''
+    index = ZoneSamplingIndex.fromSegmentationFile(path)
+    corners = np.array([[i, j, k, 1.0] for i in (0, index.zones.shape[2] - 3) for j in (0, index.zones.shape[1] - 3)
+                        for k in (0, index.zones.shape[0] - 3)])
+    cornersWorld = (index.labelsIJKToZones @ corners.T).T[:, :3]
+    rng = np.random.default_rng(0)
+    poses = []
+    for repeat in range(repeats):
+        pose = np.eye(4)
+        pose[:3, :3] = np.linalg.qr(rng.normal(size=(3, 3)))[0]
+        pose[:3, 3] = rng.uniform(cornersWorld.min(axis=0), cornersWorld.max(axis=0))
+        poses.append(pose)
+    startTime = time.perf_counter()
+    for pose in poses:
+        index.segmentComposition((0, 0, -6), (0, 0, 6), pose)
+    return 1000 * (time.perf_counter() - startTime) / repeats
+
+
+if __name__ == "__main__":
+    import glob
+    import os
+    resourceDir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    for path in sorted(glob.glob(os.path.join(resourceDir, "registered_zones", "Patient_*", "Zones.seg.nrrd"))):
+        print("{}: {:.4f} ms per lookup".format(os.path.relpath(path, resourceDir), benchmarkSegmentComposition(path)))
@@ -0,0 +1,51 @@
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", ".."))
+
+from Resources.Utils.CaseCache import LRUCache
+
+
+class CaseCacheTest(unittest.TestCase):
+    '''
+    Headless tests of the LRU eviction of the case cache, with the entry sizes given directly.
+    '''
+
+    def setUp(self):
+        self.cache = LRUCache(100, sizeOf=lambda value: value)
+
+    def test_EvictsLeastRecentlyUsed(self):
+        self.cache.put(1, 40)
+        self.cache.put(2, 40)
+        self.assertEqual(self.cache.get(1), 40)
+        self.cache.put(3, 40)
+        self.assertNotIn(2, self.cache)
+        self.assertIn(1, self.cache)
+        self.assertIn(3, self.cache)
+        self.assertEqual(self.cache.getStats()["bytes"], 80)
+        self.assertEqual(self.cache.evictions, 1)
+
+    def test_KeepsOversizedNewestEntry(self):
+        self.cache.put(1, 40)
+        self.cache.put(2, 500)
+        self.assertEqual(list(self.cache.entries), [2])
+        self.assertEqual(self.cache.totalBytes, 500)
+
+    def test_PutReplacesSize(self):
+        self.cache.put(1, 40)
+        self.cache.put(1, 60)
+        self.assertEqual(len(self.cache), 1)
+        self.assertEqual(self.cache.totalBytes, 60)
+
+    def test_SetMaxBytes(self):
+        for key in range(4):
+            self.cache.put(key, 25)
+        self.cache.setMaxBytes(50)
+        self.assertEqual(list(self.cache.entries), [2, 3])
+        self.assertIsNone(self.cache.get(0))
+        self.assertEqual((self.cache.hits, self.cache.misses), (0, 1))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,57 @@
+import importlib.util
+import os
+import sys
+import unittest
+
+import numpy as np
+from vtk.util import numpy_support
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", ".."))
+
+from Resources.Utils.FrameBuffer import GrayscaleFrameBuffer, bgraViewFromBuffer, copyFrameLegacy
+
+HAS_OPENCV = importlib.util.find_spec("cv2") is not None
+
+
+class FrameBufferTest(unittest.TestCase):
+    '''
+    Headless tests of the zero-copy grab path against the legacy copy chain.
+    '''
+
+    def setUp(self):
+        self.width, self.height = 7, 5
+        self.bgra = np.random.default_rng(0).integers(0, 256, size=(self.height, self.width, 4), dtype=np.uint8)
+
+    def test_BGRAViewWithPadding(self):
+        #Scan lines padded to 32 bytes, as QImage does
+        bytesPerLine = 32
+        padded = np.zeros((self.height, bytesPerLine), dtype=np.uint8)
+        padded[:, :self.width * 4] = self.bgra.reshape(self.height, -1)
+        view = bgraViewFromBuffer(memoryview(padded.tobytes()), self.width, self.height, bytesPerLine)
+        np.testing.assert_array_equal(view, self.bgra)
+
+    @unittest.skipUnless(HAS_OPENCV, "needs OpenCV")
+    def test_MatchesLegacyAndReusesBuffer(self):
+        frameBuffer = GrayscaleFrameBuffer()
+        self.assertEqual(frameBuffer.updateFromBGRA(self.bgra), 1)
+        array = frameBuffer.array
+        self.assertEqual(frameBuffer.updateFromBGRA(self.bgra[::-1].copy()), 0)
+        self.assertIs(frameBuffer.array, array)
+
+        legacy, allocations = copyFrameLegacy(memoryview(self.bgra[::-1].tobytes()), self.width, self.height)
+        self.assertEqual(allocations, 4)
+        expected = numpy_support.vtk_to_numpy(legacy.GetPointData().GetScalars()).reshape(self.height, self.width)
+        np.testing.assert_array_equal(frameBuffer.array, expected)
+
+        #The image data wraps the buffer, so it shows the new frame without a copy
+        scalars = numpy_support.vtk_to_numpy(frameBuffer.imageData.GetPointData().GetScalars())
+        np.testing.assert_array_equal(scalars.reshape(self.height, self.width), expected)
+        self.assertEqual(frameBuffer.imageData.GetDimensions(), (self.width, self.height, 1))
+
+        #A new frame size reallocates
+        self.assertEqual(frameBuffer.updateFromBGRA(self.bgra[:2]), 1)
+        self.assertEqual(frameBuffer.array.shape, (2, self.width))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,51 @@
+import os
+import sys
+import unittest
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", ".."))
+
+from Resources.Utils import GenerateFanMask
+
+
+class GenerateFanMaskTest(unittest.TestCase):
+    '''
+    Headless tests of the vectorized fan mask against the per-pixel reference, and of the mask cache.
+    '''
+
+    GEOMETRIES = (
+        (105.0, 20.0, 140, 100, 120, None),
+        (52.5, 10.0, 90, 80, 80, (40, 60)),
+        GenerateFanMask.scaledProbeGeometry(150, 125),
+        #A center outside the image and an FOV past 180 degrees
+        (80.0, 0.0, 200, 60, 90, (45, 70)),
+    )
+
+    def test_MatchesPerPixel(self):
+        for geometry in self.GEOMETRIES:
+            expected = GenerateFanMask.generateFanMaskPerPixel(*geometry)
+            self.assertTrue(expected.any(), geometry)
+            np.testing.assert_array_equal(GenerateFanMask.generateFanMask(*geometry), expected, err_msg=str(geometry))
+
+    def test_EngineCache(self):
+        engine = GenerateFanMask.FanMaskEngine(maxMasks=2)
+        geometry = self.GEOMETRIES[0]
+        mask = engine.getMask(*geometry)
+        np.testing.assert_array_equal(mask, GenerateFanMask.generateFanMask(*geometry))
+        self.assertFalse(mask.flags.writeable)
+        #An explicit center equal to the default one is the same geometry
+        outerRad, innerRad, FOV, imageHeight, imageWidth, _ = geometry
+        self.assertIs(engine.getMask(outerRad, innerRad, FOV, imageHeight, imageWidth, (60, 50)), mask)
+        self.assertEqual((engine.hits, engine.misses), (1, 1))
+
+        #Geometries of the same image share its polar grid; the oldest mask is evicted
+        engine.getMasks([dict(outerRad=90.0, innerRad=20.0, FOV=140, imageHeight=100, imageWidth=120),
+                         (70.0, 20.0, 140, 100, 120)])
+        self.assertEqual(len(engine.grids), 1)
+        self.assertEqual(len(engine.masks), 2)
+        self.assertIsNot(engine.getMask(*geometry), mask)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,62 @@
+import gzip
+import os
+import sys
+import tempfile
+import unittest
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", ".."))
+
+from Resources.Utils import NrrdIO
+
+
+class NrrdIOTest(unittest.TestCase):
+    '''
+    Headless tests of the NRRD reader on small files written here.
+    '''
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.array = np.arange(2 * 3 * 4).reshape(2, 3, 4)
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def writeNrrd(self, name, header, data):
+        path = os.path.join(self.directory.name, name)
+        with open(path, "wb") as f:
+            f.write(("NRRD0004\n" + header + "\n").encode("ascii"))
+            f.write(data)
+        return path
+
+    def test_RawBigEndianLPS(self):
+        path = self.writeNrrd("Raw.nrrd", "type: short\ndimension: 3\nsizes: 4 3 2\nendian: big\nencoding: raw\n"
+                              "space: left-posterior-superior\nspace directions: (2,0,0) (0,3,0) (0,0,4)\n"
+                              "space origin: (10,20,30)\nSegment0_Name:=PZ\n", self.array.astype(">i2").tobytes())
+        array, ijkToRAS, keyValues = NrrdIO.readNrrd(path)
+        np.testing.assert_array_equal(array, self.array)
+        self.assertEqual(array.dtype, np.dtype("int16"))
+        np.testing.assert_array_equal(ijkToRAS, [[-2, 0, 0, -10], [0, -3, 0, -20], [0, 0, 4, 30], [0, 0, 0, 1]])
+        self.assertEqual(keyValues, {"Segment0_Name": "PZ"})
+
+    def test_GzipWithLayers(self):
+        #A segmentation with a non-spatial layer axis first
+        layers = np.stack([self.array, self.array + 1], axis=-1).astype(np.uint8)
+        path = self.writeNrrd("Gzip.nrrd", "type: unsigned char\ndimension: 4\nsizes: 2 4 3 2\nencoding: gzip\n"
+                              "space: right-anterior-superior\nspace directions: none (1,0,0) (0,1,0) (0,0,1)\n",
+                              gzip.compress(layers.tobytes()))
+        array, ijkToRAS, _ = NrrdIO.readNrrd(path)
+        np.testing.assert_array_equal(array, layers)
+        np.testing.assert_array_equal(ijkToRAS, np.eye(4))
+
+    def test_Unsupported(self):
+        detached = self.writeNrrd("Detached.nhdr", "type: uchar\ndimension: 1\nsizes: 4\ndata file: Detached.raw\n", b"")
+        short = self.writeNrrd("Short.nrrd", "type: uchar\ndimension: 1\nsizes: 4\nencoding: raw\n", b"\0\0")
+        for path in (detached, short):
+            with self.assertRaises(ValueError):
+                NrrdIO.readNrrd(path)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,72 @@
+import os
+import sys
+import tempfile
+import unittest
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", ".."))
+
+from Resources.Utils import SessionJournal
+from Resources.Utils.BiopsyLedger import BiopsyLedger
+
+
+class SessionJournalTest(unittest.TestCase):
+    '''
+    Headless tests of the journal records: checksums, torn tails and loaded sessions.
+    '''
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.directory.name, "Test" + SessionJournal.JOURNAL_EXTENSION)
+        self.recordSize = SessionJournal.RECORD_DTYPE.itemsize
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def writeJournal(self, cores):
+        writer = SessionJournal.JournalWriter(self.path, "Test")
+        writer.caseSelected(2)
+        for core in range(cores):
+            writer.biopsyFired(2, np.eye(4), 10.0 + core)
+        writer.close()
+
+    def test_TornTail(self):
+        self.writeJournal(3)
+        with open(self.path, "r+b") as f:
+            f.truncate(SessionJournal.HEADER_SIZE + 3 * self.recordSize + self.recordSize // 2)
+        state = SessionJournal.replayJournal(self.path)
+        self.assertEqual(state.recordCount, 3)
+        np.testing.assert_array_equal(state.ledger.depths, [10.0, 11.0])
+
+        #Continuing the journal cuts the torn record off
+        SessionJournal.JournalWriter(self.path).close()
+        self.assertEqual(os.path.getsize(self.path), SessionJournal.HEADER_SIZE + 3 * self.recordSize)
+
+    def test_Checksum(self):
+        self.writeJournal(3)
+        with open(self.path, "r+b") as f:
+            f.seek(SessionJournal.HEADER_SIZE + 2 * self.recordSize + 8)
+            f.write(b"\xff")
+        state = SessionJournal.replayJournal(self.path)
+        self.assertEqual(state.recordCount, 2)
+        self.assertEqual(len(state.ledger), 1)
+
+    def test_SessionLoaded(self):
+        self.writeJournal(2)
+        loaded = BiopsyLedger()
+        loaded.append(np.diag([2.0, 2.0, 2.0, 1.0]), 100.0, 5.0)
+        writer = SessionJournal.JournalWriter(self.path)
+        writer.sessionLoaded(4, loaded)
+        writer.biopsyFired(4, np.eye(4), 7.0)
+        writer.close()
+
+        state = SessionJournal.replayJournal(self.path)
+        self.assertEqual(state.caseNumber, 4)
+        np.testing.assert_array_equal(state.ledger.depths, [5.0, 7.0])
+        np.testing.assert_array_equal(state.ledger.timestamps[:1], [100.0])
+        np.testing.assert_array_equal(state.ledger.poses[0], loaded.poses[0])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,75 @@
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", ".."))
+
+from Resources.Utils.UpdateScheduler import CoalescingScheduler
+
+
+class FakeClock:
+
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+class UpdateSchedulerTest(unittest.TestCase):
+    '''
+    Headless tests of CoalescingScheduler in poll mode, with a fake clock.
+    '''
+
+    def setUp(self):
+        self.clock = FakeClock()
+        self.processed = []
+        self.scheduler = CoalescingScheduler(lambda caller, eventId: self.processed.append(caller), maxRate=10.0,
+                                             maxLatency=0.5, clock=self.clock)
+
+    def test_CoalescesToLatestPose(self):
+        for pose in range(5):
+            self.scheduler.onEvent(pose, 0)
+        self.assertTrue(self.scheduler.processPending())
+        self.assertEqual(self.processed, [4])
+        self.assertEqual(self.scheduler.getCounts(), {"received": 5, "processed": 1, "coalesced": 4, "dropped": 0})
+
+    def test_RateCap(self):
+        self.scheduler.onEvent("first", 0)
+        self.assertTrue(self.scheduler.processPending())
+        self.clock.now = 0.05
+        self.scheduler.onEvent("second", 0)
+        self.assertFalse(self.scheduler.processPending())
+        self.clock.now = 0.1
+        self.assertTrue(self.scheduler.processPending())
+        self.assertEqual(self.processed, ["first", "second"])
+
+    def test_StallThenNoMoreEvents(self):
+        #Poses keep arriving while the UI is blocked, then the probe stops
+        for pose in range(3):
+            self.clock.now = 0.1 * pose
+            self.scheduler.onEvent(pose, 0)
+        self.clock.now = 2.0
+        self.assertTrue(self.scheduler.processPending())
+        self.assertEqual(self.processed, [2])
+        self.assertEqual(self.scheduler.getCounts(), {"received": 3, "processed": 1, "coalesced": 0, "dropped": 2})
+
+        #The final pose was shown and nothing is left pending
+        self.clock.now = 3.0
+        self.assertFalse(self.scheduler.processPending())
+        self.assertEqual(self.processed, [2])
+
+    def test_StallScheduleCallback(self):
+        scheduled = []
+        scheduler = CoalescingScheduler(lambda caller, eventId: self.processed.append(caller), maxRate=10.0,
+                                        maxLatency=0.5, clock=self.clock,
+                                        scheduleCallback=lambda delay, function: scheduled.append(function))
+        scheduler.onEvent("last", 0)
+        self.clock.now = 5.0
+        scheduled.pop()()
+        self.assertEqual(self.processed, ["last"])
+        self.assertEqual(scheduled, [])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,65 @@
+import os
+import sys
+import unittest
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", ".."))
+
+from Resources.Utils.VolumeReconstruction import VolumeCompounder
+
+
+class VolumeCompounderTest(unittest.TestCase):
+    '''
+    Headless tests of inserting frames into a 10 mm grid of 1 mm voxels.
+    '''
+
+    def setUp(self):
+        self.frame = np.arange(1, 13, dtype=np.uint8).reshape(3, 4) * 10
+        self.imageIJKToWorld = np.eye(4)
+        self.imageIJKToWorld[:3, 3] = [2, 3, 5]
+
+    def test_NearestInsertAndAverage(self):
+        compounder = VolumeCompounder.fromBounds([0, 9, 0, 9, 0, 9], 1.0)
+        self.assertEqual(compounder.insertFrame(self.frame, self.imageIJKToWorld), 12)
+        np.testing.assert_array_equal(compounder.output[5, 3:6, 2:6], self.frame)
+        self.assertEqual(np.count_nonzero(compounder.output), 12)
+
+        #The same voxels again average with what is there
+        compounder.insertFrame(np.zeros_like(self.frame), self.imageIJKToWorld)
+        np.testing.assert_array_equal(compounder.output[5, 3:6, 2:6], (self.frame.astype(float) / 2 + 0.5).astype(np.uint8))
+
+    def test_MaskAndOutsideGrid(self):
+        compounder = VolumeCompounder.fromBounds([0, 9, 0, 9, 0, 9], 1.0)
+        mask = np.ones(self.frame.shape, dtype=bool)
+        mask[0, 0] = False
+        self.imageIJKToWorld[0, 3] = 7
+        #Columns 3 and up fall outside the grid, pixel (0, 0) is masked out
+        self.assertEqual(compounder.insertFrame(self.frame, self.imageIJKToWorld, mask), 8)
+        self.assertEqual(compounder.output[5, 3, 7], 0)
+        self.assertEqual(compounder.output[5, 4, 7], self.frame[1, 0])
+
+        #A frame entirely outside the grid changes nothing
+        outside = np.eye(4)
+        outside[:3, 3] = [50, 0, 0]
+        self.assertEqual(compounder.insertFrame(self.frame, outside), 0)
+
+    def test_WeightedSplat(self):
+        compounder = VolumeCompounder.fromBounds([0, 9, 0, 9, 0, 9], 1.0, VolumeCompounder.WEIGHTED)
+        #Halfway between two k slices, every pixel lands in both with the same weight
+        self.imageIJKToWorld[2, 3] = 5.5
+        self.assertEqual(compounder.insertFrame(self.frame, self.imageIJKToWorld), 24)
+        np.testing.assert_array_equal(compounder.output[5, 3:6, 2:6], self.frame)
+        np.testing.assert_array_equal(compounder.output[6, 3:6, 2:6], self.frame)
+
+    def test_FillHoles(self):
+        compounder = VolumeCompounder.fromBounds([0, 9, 0, 9, 0, 9], 1.0)
+        compounder.insertFrame(np.full((1, 1), 100, dtype=np.uint8), self.imageIJKToWorld)
+        self.assertEqual(compounder.fillHoles(radius=1), 26)
+        self.assertEqual(compounder.output[4:7, 2:5, 1:4].min(), 100)
+        #Only the region touched since the last fill is filled again
+        self.assertEqual(compounder.fillHoles(radius=1), 0)
+
+
+if __name__ == "__main__":
+    unittest.main()
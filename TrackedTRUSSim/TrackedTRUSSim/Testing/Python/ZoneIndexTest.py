@@ -0,0 +1,54 @@
+import os
+import sys
+import unittest
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", ".."))
+
+from Resources.Utils.ZoneIndex import ZONES, ZoneSamplingIndex, formatComposition, labelNamesFromMetadata
+
+
+class ZoneIndexTest(unittest.TestCase):
+    '''
+    Headless tests of the needle zone composition on a labelmap of two zones stacked along k.
+    '''
+
+    def setUp(self):
+        labels = np.zeros((10, 4, 4), dtype=np.uint8)
+        labels[:5] = 1
+        labels[5:] = 2
+        labelNames = labelNamesFromMetadata({"Segment0_Name": "Peripheral", "Segment0_LabelValue": "1",
+                                             "Segment1_Name": "tz", "Segment1_LabelValue": "2"})
+        self.index = ZoneSamplingIndex(labels, np.diag([2.0, 2.0, 2.0, 1.0]), labelNames)
+
+    def fractions(self, start, end, segmentToWorld=None):
+        fractions = self.index.segmentComposition(start, end, segmentToWorld)
+        self.assertAlmostEqual(fractions.sum(), 1.0)
+        return dict(zip(ZONES, fractions))
+
+    def test_SegmentComposition(self):
+        #Along k through the middle, from the first to the last voxel: half in each zone
+        fractions = self.fractions((4, 4, 0), (4, 4, 18))
+        self.assertAlmostEqual(fractions["PZ"], 0.5, delta=0.05)
+        self.assertAlmostEqual(fractions["TZ"], 0.5, delta=0.05)
+        self.assertEqual(fractions["Outside"], 0.0)
+
+        #Entirely within one zone, and entirely outside the labelmap
+        self.assertEqual(self.fractions((4, 4, 2), (4, 4, 6))["PZ"], 1.0)
+        self.assertEqual(self.fractions((40, 40, 0), (40, 40, 18))["Outside"], 1.0)
+        self.assertEqual(formatComposition(self.index.segmentComposition((40, 40, 0), (40, 40, 18))), "Outside")
+
+    def test_SegmentToWorld(self):
+        #The segment is given in its own coordinates and the zones are moved in the world
+        segmentToWorld = np.eye(4)
+        segmentToWorld[:3, 3] = [4, 4, 2]
+        self.assertEqual(self.fractions((0, 0, 0), (0, 0, 4), segmentToWorld)["PZ"], 1.0)
+        zonesToWorld = np.eye(4)
+        zonesToWorld[2, 3] = -10
+        self.index.setZonesToWorld(zonesToWorld)
+        self.assertEqual(self.fractions((0, 0, 0), (0, 0, 4), segmentToWorld)["TZ"], 1.0)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -1,21 +1,48 @@
+import base64
 import json
 import os
+import tempfile
+import time
 import unittest
 import logging
 import vtk, qt, ctk, slicer
 from slicer.ScriptedLoadableModule import *
 from slicer.util import VTKObservationMixin
 
-import ScreenCapture
 import numpy as np
-from vtk.util.numpy_support import vtk_to_numpy
 from vtk.util import numpy_support
 from datetime import datetime
 from glob import glob
 from pathlib import Path
 
-import ScreenCapture
-import cv2
+from Resources.Utils import AssetBundle
+from Resources.Utils import BiopsyLedger
+from Resources.Utils import CaseCache
+from Resources.Utils import CasePrefetch
+from Resources.Utils import SessionFile
+from Resources.Utils import SessionJournal
+from Resources.Utils import SimulationCore
+from Resources.Utils import StageProfiler
+from Resources.Utils import StartupTiming
+from Resources.Utils import SurfaceCache
+from Resources.Utils import TransformUtils
+from Resources.Utils import UpdateScheduler
+from Resources.Utils import ZoneDistance
+from Resources.Utils import ZoneIndex
+
+#Start up stages of the module, logged as they finish
+startupTimer = StartupTiming.StartupTimer(logging.info)
+
+#Only needed for live tracking, the reconstruction, recordings and benchmarks, so they are imported on first use
+BenchmarkSuite = StartupTiming.LazyModule("Resources.Utils.BenchmarkSuite", startupTimer)
+CylindricalResampling = StartupTiming.LazyModule("Resources.Utils.CylindricalResampling", startupTimer)
+FrameBuffer = StartupTiming.LazyModule("Resources.Utils.FrameBuffer", startupTimer)
+ImageFormation = StartupTiming.LazyModule("Resources.Utils.ImageFormation", startupTimer)
+ScreenCapture = StartupTiming.LazyModule("ScreenCapture", startupTimer)
+SliceGenerator = StartupTiming.LazyModule("Resources.Utils.SliceGenerator", startupTimer)
+SyntheticTracker = StartupTiming.LazyModule("Resources.Utils.SyntheticTracker", startupTimer)
+TrackingRecording = StartupTiming.LazyModule("Resources.Utils.TrackingRecording", startupTimer)
+VolumeReconstruction = StartupTiming.LazyModule("Resources.Utils.VolumeReconstruction", startupTimer)
 
 #
 # TrackedTRUSSim
@@ -99,13 +126,16 @@ class TrackedTRUSSimWidget(ScriptedLoadableModuleWidget, VTKObservationMixin):
     """
     Called when the user opens the module the first time and the widget is initialized.
     """
+    setupStartTime = time.perf_counter()
+
     ScriptedLoadableModuleWidget.setup(self)
 
     # Load widget from .ui file (created by Qt Designer).
     # Additional widgets can be instantiated manually and added to self.layout.
-    uiWidget = slicer.util.loadUI(self.resourcePath('UI/TrackedTRUSSim.ui'))
-    self.layout.addWidget(uiWidget)
-    self.ui = slicer.util.childWidgetVariables(uiWidget)
+    with startupTimer.stage("ui"):
+      uiWidget = slicer.util.loadUI(self.resourcePath('UI/TrackedTRUSSim.ui'))
+      self.layout.addWidget(uiWidget)
+      self.ui = slicer.util.childWidgetVariables(uiWidget)
 
     #Get the path to module resources
     self.moduleDirPath = slicer.modules.trackedtrussim.path.replace("TrackedTRUSSim.py","")
@@ -114,7 +144,8 @@ class TrackedTRUSSimWidget(ScriptedLoadableModuleWidget, VTKObservationMixin):
     uiWidget.setMRMLScene(slicer.mrmlScene)
 
     #Create logic class
-    self.logic = TrackedTRUSSimLogic()
+    with startupTimer.stage("logic"):
+      self.logic = TrackedTRUSSimLogic()
 
     #Connect UI
     self.ui.userComboBox.currentIndexChanged.connect(self.onUserComboBoxChanged)
@@ -130,6 +161,8 @@ class TrackedTRUSSimWidget(ScriptedLoadableModuleWidget, VTKObservationMixin):
     self.ui.saveBiopsyButton.connect('clicked(bool)', self.saveBiopsy)
     self.ui.startReconstructionButton.connect('clicked(bool)', self.onStartReconstruction)
     self.ui.stopReconstructionButton.connect('clicked(bool)', self.onStopReconstruction)
+    self.ui.latencyOverlayButton.connect('toggled(bool)', self.onLatencyOverlayToggled)
+    self.ui.exportLatencyButton.connect('clicked(bool)', self.onExportLatencyClicked)
 
     self.eventFilter = MainWidgetEventFilter(self)
     slicer.util.mainWindow().installEventFilter(self.eventFilter)
@@ -137,14 +170,46 @@ class TrackedTRUSSimWidget(ScriptedLoadableModuleWidget, VTKObservationMixin):
     #Populate the users combobox with all folder names in UserData
     self.updateUsersComboBox()
 
-    #Open base models / transforms
-    self.logic.setupParameterNode()
+    #Open base models / transforms. The custom layout is switched to by enter, when the module panel is first
+    #shown; the PLUS server nodes and the reconstruction are set up when they are first used.
+    self.layoutReady = False
+    self.logic.setupParameterNode(deferLayout=True)
+
+    #Refresh the distance readouts when the probe moves, at most 10 times a second
+    self.readoutScheduler = UpdateScheduler.CoalescingScheduler(lambda caller, eventId: self.updateDistanceLabel(), 10.0,
+                                                                scheduleCallback=TrackedTRUSSimLogic.scheduleOnMainThread)
+    probeToPhantom = self.logic.getParameterNode().GetNodeReference(self.logic.PROBE_TO_PHANTOM)
+    self.readoutScheduler.observe(probeToPhantom, slicer.vtkMRMLTransformNode.TransformModifiedEvent)
 
     #Setup icons
-    self.placeIcons()
+    with startupTimer.stage("icons"):
+      self.placeIcons()
+
+    logging.info("TrackedTRUSSim ready in {:.3f} s (base scene from {}; {})".format(
+      time.perf_counter() - setupStartTime, self.logic.baseSceneSource, startupTimer.formatSummary()))
 
     #Ensure that all checkbox states
 
+  def enter(self):
+    """
+    Called each time the module panel is shown. The first time, switches to the custom layout.
+    """
+    if not self.layoutReady:
+      self.layoutReady = True
+      self.logic.setupLayout()
+
+  def cleanup(self):
+    """
+    Called when the application closes and the module widget is destroyed.
+    """
+    self.logic.casePrefetcher.shutdown()
+    self.logic.closeJournal()
+    self.logic.stopTrackingRecording()
+    self.logic.stopTrackingReplay()
+    self.logic.stopSyntheticTracker()
+    self.logic.setStageProfiling(False)
+    self.readoutScheduler.detachAll()
+
   def placeIcons(self):
 
     #Settings
@@ -330,7 +395,9 @@ class TrackedTRUSSimWidget(ScriptedLoadableModuleWidget, VTKObservationMixin):
     case = self.ui.caseComboBox.currentIndex
 
     # load the appropriate transforms
+    self.logic.openJournal(self.ui.userComboBox.currentText)
     self.logic.setupCase(case)
+    self.logic.prefetchCases(case, self.ui.caseComboBox.count)
 
     #Refresh the view toggle buttons
     self.onSegVisButton()
@@ -340,10 +407,18 @@ class TrackedTRUSSimWidget(ScriptedLoadableModuleWidget, VTKObservationMixin):
     self.updateBiopsyComboBox()
 
   def onLoadBiopsyButton(self):
-    self.logic.loadScene(self.ui.loadBiopsyComboBox.currentText, self.ui.userComboBox.currentText)
+    self.logic.openJournal(self.ui.userComboBox.currentText)
+    caseNumber = self.logic.loadScene(self.ui.loadBiopsyComboBox.currentText, self.ui.userComboBox.currentText)
+
+    #The loaded session or scene sets up its case itself; only show it, without setting the case up again
+    wasBlocked = self.ui.caseComboBox.blockSignals(True)
+    self.ui.caseComboBox.setCurrentIndex(caseNumber)
+    self.ui.caseComboBox.blockSignals(wasBlocked)
 
   def onLoadCase(self):
+    self.logic.openJournal(self.ui.userComboBox.currentText)
     self.logic.setupCase(self.ui.caseComboBox.currentIndex)
+    self.logic.prefetchCases(self.ui.caseComboBox.currentIndex, self.ui.caseComboBox.count)
 
     self.onShowZonesChecked()
 
@@ -374,9 +449,28 @@ class TrackedTRUSSimWidget(ScriptedLoadableModuleWidget, VTKObservationMixin):
 
     #Get the current location of the slider
     sliderVal = self.ui.biopsyDepthSlider.value
-    print("Slider value: " + str(sliderVal))
 
     self.logic.moveBiopsy(sliderVal)
+    self.updateZoneHitLabel()
+    self.updateDistanceLabel()
+
+  def updateDistanceLabel(self):
+    distances = self.logic.getTargetDistances()
+    if distances is None:
+      self.ui.distanceLabel.text = ""
+      return
+    parts = []
+    for name, distance in (("Needle tip", distances["needleTip"]), ("Probe tip", distances["probeTip"])):
+      if distance is not None:
+        parts.append("{} to {}: {:.1f} mm".format(name, self.logic.TARGET_ZONE, distance))
+    self.ui.distanceLabel.text = ", ".join(parts)
+
+  def updateZoneHitLabel(self):
+    zoneFractions = self.logic.getNeedleZoneComposition()
+    if zoneFractions is None:
+      self.ui.zoneHitLabel.text = ""
+    else:
+      self.ui.zoneHitLabel.text = "Needle in: " + ZoneIndex.formatComposition(zoneFractions)
 
   def onFireBiopsyClicked(self):
 
@@ -392,6 +486,19 @@ class TrackedTRUSSimWidget(ScriptedLoadableModuleWidget, VTKObservationMixin):
 
     self.logic.stopReconstruction()
 
+  def onLatencyOverlayToggled(self, toggled):
+
+    self.logic.setStageProfiling(toggled)
+    self.logic.setLatencyOverlayVisible(toggled)
+
+  def onExportLatencyClicked(self):
+
+    if not self.logic.stageProfiler.enabled:
+      slicer.util.warningDisplay("Turn on the latency overlay first, so that there are timings to export.")
+      return
+    path = self.logic.exportStageProfile()
+    slicer.util.infoDisplay("Frame latencies written to " + path)
+
 
   def confirmExit(self):
     msgBox = qt.QMessageBox()
@@ -448,20 +555,58 @@ class TrackedTRUSSimLogic(ScriptedLoadableModuleLogic):
   ZONE_SEGMENTATION = "ZoneSegmentation"
   BIOPSY_MODEL = "BiopsyModel"
   BIOPSY_TRAJECTORY_MODEL = "BiopsyTrajectoryModel"
+  BIOPSY_CORES_MODEL = "BiopsyCores" #All fired cores in a single model
 
   #Volume names
   MASK_VOLUME = "MaskVolume"
+  RECONSTRUCTED_VOLUME = "ReconstructedVolume"
 
   #OpenIGTLink PLUS connection
   CONFIG_FILE = "PlusDeviceSet_Server_Optitrak.xml"
   CONFIG_TEXT_NODE = "ConfigTextNode"
   PLUS_SERVER_NODE = "PlusServer"
   PLUS_SERVER_LAUNCHER_NODE = "PlusServerLauncher"
+  SYNTHETIC_TRACKER_CONNECTOR = "SyntheticTrackerConnector"
+
+  #Static resources of the base scene, which the asset bundle packs into a single file
+  ASSET_BUNDLE_FILE = "BaseScene.bundle.npz"
+  STATIC_TRANSFORM_FILES = {
+    BOXMODEL_TO_REFERENCE: "BoxModelToReference.h5",
+    CYLINDER_TO_BOX: "CylinderToBox.h5",
+    PHANTOM_TO_REFERENCE: "PhantomToReference.h5",
+    PROBE_TO_PHANTOM: "ProbeToPhantom.h5",
+    PROBETIP_TO_PROBE: "ProbeTipToProbe.h5",
+    PROBEMODEL_TO_PROBETIP: "ProbeModelToProbeTip.h5",
+    USMASK_TO_PROBEMODEL: "USMaskToProbeModel.h5",
+    BIOPSYTRAJECTORY_TO_PROBEMODEL: "BiopsyTrajectoryToProbeModel.h5",
+    BIOPSYMODEL_TO_BIOPSYTRAJECTORY: "BiopsyModelToBiopsyTrajectory.h5",
+    USSIMVOLUME_TO_USMASK: "USSimVolumeToUSMask.h5",
+    POINTERTIP_TO_POINTER: "PointerTipToPointer.h5",
+  }
+  STATIC_MODEL_FILES = {
+    BOX_MODEL: "BoxModel.vtk",
+    CYLINDER_MODEL: "CylinderModel.vtk",
+    PROBE_MODEL: "ProbeModel.stl",
+    BIOPSY_MODEL: "BiopsyModel.vtk",
+    BIOPSY_TRAJECTORY_MODEL: "BiopsyTrajectoryModel.stl",
+  }
+  STATIC_VOLUME_FILES = {
+    MASK_VOLUME: "USMask.png",
+  }
 
   #Various other node names
-  BIOPSY_TRANSFORM_ROLES = "BiopsyTransformRoles"
+  BIOPSY_TRANSFORM_ROLES = "BiopsyTransformRoles" #Per-core transform nodes of scenes saved before the biopsy ledger
+  BIOPSY_LEDGER = "BiopsyLedger"
+  CASE_NUMBER = "CaseNumber" #Case of a saved MRML scene
   ULTRASOUND_SIM_VOLUME = "UltrasoundSimVolume"
 
+  #Zone whose boundary the needle tip and probe tip distances are measured to
+  TARGET_ZONE = SimulationCore.TARGET_ZONE
+
+  #Sources of the simulated US frame
+  FRAME_SOURCE_RESLICE = "Reslice" #Sample TRUSVolume along the US mask plane, offscreen
+  FRAME_SOURCE_GRAB = "Grab" #Grab the pixels of the rendered Red slice view
+
 
   def __init__(self):
     """
@@ -472,13 +617,105 @@ class TrackedTRUSSimLogic(ScriptedLoadableModuleLogic):
     self.caseLoaded = False
     self.currCaseNumber = -1
 
+    moduleDir = os.path.dirname(slicer.modules.trackedtrussim.path)
+    self.registeredZonesDirectory = os.path.join(moduleDir, "Resources", "registered_zones")
+
+    #Prepared cases, least recently used evicted first once the budget (in MB) is exceeded
+    self.caseCacheBudget = 1024
+    self.caseCache = CaseCache.LRUCache(self.caseCacheBudget * 1024 * 1024)
+
+    #Closed surfaces of the zone segmentations, cached on disk by file content and conversion parameters
+    self.useSurfaceCache = True
+    self.surfaceCache = SurfaceCache.SurfaceCache(self.surfaceCacheDirectory())
+
+    #Likely next cases are decoded on worker threads; only node creation is left for setupCase
+    self.prefetchCount = 2
+    self.casePrefetcher = CasePrefetch.CasePrefetcher(self.decodeCaseFiles)
+    self.casePrefetcher.touchCounts.update(self.readCaseTouchCounts())
+    self.surfaceConversionParameters = slicer.vtkSegmentation().SerializeAllConversionParameters()
+
+    #Fill the base scene from the prebuilt asset bundle when it is up to date
+    self.useAssetBundle = True
+    self.baseSceneSource = None
+    self.baseSceneLoadTime = None
+
+    #Sessions are saved as compact session files; the full MRML scene is still written when this is off
+    self.useSessionFiles = True
+
+    #Every case selection, fired core and depth change is appended to a journal in the user's folder, which
+    #can be loaded like a saved session after a crash. Probe poses (at most 10 a second) only when enabled.
+    self.journal = None
+    self.journalProbePoses = False
+    self.journalProbePoseObservation = None
+
+    #Tracker poses recorded to a memory-mapped file, and replayed into the same nodes without the tracker
+    self.trackingRecorder = None
+    self.trackingRecorderObservations = []
+    self.trackingReplayer = None
+    self.trackingMatrix = vtk.vtkMatrix4x4()
+
+    #Local OpenIGTLink server standing in for PLUS and the tracker, for load tests at any tracker rate
+    self.syntheticTracker = None
+
+    #The Slicer-independent part of the simulation: transform chain, slice generator, biopsy ledger (poses,
+    #times and depths of the fired cores) and the zones of the current case for scoring. This logic feeds it
+    #from the MRML scene and shows its results.
+    self.core = SimulationCore.SimulationCore(self.getMatrixToParent, availableLinks=())
+    self.biopsyLedgerModified = False
+    self.biopsyCores = None #The fired cores, shown as one instanced model
+    self.zonesToWorld = vtk.vtkMatrix4x4()
+
+    #Preallocated frame used by reconstructionCallback, created by the first startReconstruction. The legacy
+    #grab path (a new copy of every frame) is kept so that per-frame allocations and latency can be compared.
+    self.frameBuffer = None
+    self.useLegacyFramePath = False
+    self.frameStats = {}
+    self.screencapLogic = None
+
+    #Offscreen slice generator (in the core), created by startReconstruction when a case is loaded
+    self.frameSource = self.FRAME_SOURCE_RESLICE
+    #Resample the TRUS volume into planes through the cylinder axis (cached beside the case), so that frames
+    #of the probe rotating about the axis are 2D resamples; other poses are still resliced obliquely
+    self.useCylindricalResampling = False
+    #Add speckle, depth attenuation with TGC and shadowing to the resliced frames (see ImageFormation)
+    self.useImageFormation = False
+    self.imageFormationParameters = {}
+
+    #Frame-to-RAS lookups with the static calibration transforms precomposed
+    self.transformChain = None
+    self.transformChainObservations = []
+    self.transformChainMTimes = {}
+    self.matrixToParent = vtk.vtkMatrix4x4()
+
+    #Tracker updates are coalesced and capped at maxFrameRate before a frame is produced
+    self.maxFrameRate = 30.0
+    self.reconstructionScheduler = UpdateScheduler.CoalescingScheduler(self.reconstructionCallback, self.maxFrameRate,
+                                                                       scheduleCallback=self.scheduleOnMainThread)
+
+    #3D compounding of the simulated frames, over the bounds of the TRUS volume
+    self.volumeCompounder = None
+    self.reconstructionSpacing = 0.5
+    self.reconstructionMethod = None #VolumeCompounder.NEAREST unless set
+
+    #Per-stage frame latencies; NULL_PROFILER (does nothing) unless setStageProfiling turns them on
+    self.stageProfiler = StageProfiler.NULL_PROFILER
+    self.renderObservations = []
+    self.renderStartTime = None
+    self.displayPending = None
+    self.latencyOverlayTimer = None
 
-  def saveScene(self, filename, currentUser):
 
-    filename = filename + ".mrml"
+  def saveScene(self, filename, currentUser):
 
     #only save the scene if a case is loaded
-    if self.caseLoaded:
+    if self.caseLoaded and self.useSessionFiles:
+      moduleDir = os.path.dirname(slicer.modules.trackedtrussim.path)
+      sessionPath = os.path.join(moduleDir, "Resources", "UserData", currentUser, filename + SessionFile.SESSION_EXTENSION)
+      self.saveSession(sessionPath, currentUser)
+
+    elif self.caseLoaded:
+
+      filename = filename + ".mrml"
 
       #Create filename
       # date = datetime.now().strftime("%m%d%y_%H%M%S")
@@ -488,36 +725,440 @@ class TrackedTRUSSimLogic(ScriptedLoadableModuleLogic):
       moduleDir = os.path.dirname(slicer.modules.trackedtrussim.path)
       biopsySavePath = os.path.join(moduleDir, "Resources", "UserData", currentUser, filename)
 
-      print("save path: " + biopsySavePath)
+      logging.debug("Saving the scene to " + biopsySavePath)
+
+      self.storeBiopsyLedger()
+      self.getCaseNode().SetParameter(self.CASE_NUMBER, str(self.currCaseNumber))
 
       #save the scene to file
       slicer.util.saveScene(biopsySavePath)
 
+    if self.caseLoaded and self.journal is not None:
+      self.journal.sessionSaved(self.currCaseNumber)
 
-  def loadScene(self, filename, currentUser):
 
-    print("filename: " + filename)
+  def loadScene(self, filename, currentUser):
+    """
+    Loads a session file, recovers a journal or loads an MRML scene of currentUser. Returns the case number
+    of what was loaded.
+    """
 
     # Append to current directory
     moduleDir = os.path.dirname(slicer.modules.trackedtrussim.path)
     biopsySavePath = os.path.join(moduleDir, "Resources", "UserData", currentUser, filename)
 
-    print("biopsySavePath: " + biopsySavePath)
+    logging.debug("Loading " + biopsySavePath)
+
+    if filename.endswith(SessionFile.SESSION_EXTENSION):
+      return self.loadSession(biopsySavePath).caseNumber
+    if filename.endswith(SessionJournal.JOURNAL_EXTENSION):
+      return self.recoverJournal(biopsySavePath).caseNumber
 
     # save the scene to file
     slicer.util.loadScene(biopsySavePath)
 
+    #Scenes saved before the case number was stored keep the current case
+    caseNumber = self.getCaseNode().GetParameter(self.CASE_NUMBER)
+    if caseNumber:
+      self.currCaseNumber = int(caseNumber)
+
+    self.visualizeBiopsies()
+    if self.journal is not None:
+      self.journal.sessionLoaded(self.currCaseNumber, self.core.biopsyLedger)
+    return self.currCaseNumber
+
+  def saveSession(self, sessionPath, currentUser):
+    """
+    Writes the user, case, case pose and biopsy ledger of the current session to one session file.
+    """
+    trusToCylinder = self.getCaseNode().GetNodeReference(self.TRUS_TO_CYLINDER)
+    session = SessionFile.Session(currentUser, self.currCaseNumber, self.core.biopsyLedger,
+                                  None if trusToCylinder is None else slicer.util.arrayFromTransformMatrix(trusToCylinder))
+    SessionFile.saveSession(sessionPath, session)
+
+  def loadSession(self, sessionPath):
+    """
+    Restores a session file. Its case is only set up if it is not the current one, and then comes from the
+    case cache or the prefetcher when it can. Returns the session.
+    """
+    session = SessionFile.loadSession(sessionPath)
+    if not self.caseLoaded or session.caseNumber != self.currCaseNumber:
+      self.setupCase(session.caseNumber)
+    if session.trusToCylinder is not None:
+      trusToCylinder = self.getCaseNode().GetNodeReference(self.TRUS_TO_CYLINDER)
+      trusToCylinder.SetMatrixTransformToParent(TransformUtils.vtkMatrixFromArray(session.trusToCylinder))
+
+    self.core.biopsyLedger = session.ledger
+    self.biopsyLedgerModified = False
+    self.getBiopsyCores().setInstances(self.core.biopsyLedger.poses)
+    #Recovering the journal has to bring back the loaded cores, not the ones from before the load
+    if self.journal is not None:
+      self.journal.sessionLoaded(session.caseNumber, self.core.biopsyLedger)
+    return session
+
+  def openJournal(self, currentUser):
+    """
+    Starts a journal for currentUser, unless one is already open for that user.
+    """
+    if self.journal is not None and self.journal.manifest["user"] == currentUser:
+      return
+    self.closeJournal()
+    moduleDir = os.path.dirname(slicer.modules.trackedtrussim.path)
+    journalPath = os.path.join(moduleDir, "Resources", "UserData", currentUser,
+                               "Session_{}{}".format(datetime.now().strftime("%m%d%y_%H%M%S"), SessionJournal.JOURNAL_EXTENSION))
+    self.startJournal(SessionJournal.JournalWriter(journalPath, currentUser))
+
+  def startJournal(self, journal):
+    self.journal = journal
+    if self.journalProbePoses:
+      probeToPhantom = self.getParameterNode().GetNodeReference(self.PROBE_TO_PHANTOM)
+      tag = probeToPhantom.AddObserver(slicer.vtkMRMLTransformNode.TransformModifiedEvent, self.onJournalProbeMoved)
+      self.journalProbePoseObservation = (probeToPhantom, tag)
+
+  def onJournalProbeMoved(self, caller, eventId):
+    if self.journal is not None:
+      self.journal.probePose(self.currCaseNumber, slicer.util.arrayFromTransformMatrix(caller))
+
+  def closeJournal(self):
+    """
+    Closes the journal. A journal whose session ended with a save (or that recorded nothing) holds nothing to
+    recover and is deleted.
+    """
+    if self.journalProbePoseObservation is not None:
+      probeToPhantom, tag = self.journalProbePoseObservation
+      probeToPhantom.RemoveObserver(tag)
+      self.journalProbePoseObservation = None
+    if self.journal is None:
+      return
+    self.journal.close()
+    if self.journal.lastEventType in (None, SessionJournal.SESSION_SAVED):
+      os.remove(self.journal.path)
+    self.journal = None
+
+  def recoverJournal(self, journalPath):
+    """
+    Rebuilds the case and the fired cores from a journal and keeps appending to it. The needle is left at
+    rest. Returns the replayed state.
+    """
+    state = SessionJournal.replayJournal(journalPath)
+    if self.journal is not None and os.path.abspath(self.journal.path) == os.path.abspath(journalPath):
+      return state
+    self.closeJournal()
+    if not self.caseLoaded or state.caseNumber != self.currCaseNumber:
+      self.setupCase(state.caseNumber)
+
+    self.core.biopsyLedger = state.ledger
+    self.biopsyLedgerModified = True
+    self.getBiopsyCores().setInstances(self.core.biopsyLedger.poses)
+    self.startJournal(SessionJournal.JournalWriter(journalPath))
+    return state
+
+  def benchmarkSessionFormats(self, directory, coreCounts=(10, 100, 1000), currentUser="Benchmark"):
+    """
+    Saves and loads the current case with random ledgers of coreCounts cores, as MRML scenes and as session
+    files in directory. Returns {cores: {format: (save s, load s, bytes)}}. Needs a loaded case; loading the
+    MRML scenes adds their nodes to the scene, so run it in a scratch session (Scripts/BenchmarkSessionFormats.py).
+    """
+    savedLedger, savedUseSessionFiles = self.core.biopsyLedger, self.useSessionFiles
+    results = {}
+    for cores in coreCounts:
+      results[cores] = {}
+      for useSessionFiles, extension in ((False, ".mrml"), (True, SessionFile.SESSION_EXTENSION)):
+        self.useSessionFiles = useSessionFiles
+        self.core.biopsyLedger = SessionFile.randomSession(cores).ledger
+        self.biopsyLedgerModified = True
+        path = os.path.join(directory, "Benchmark_{}{}".format(cores, extension))
+
+        startTime = time.perf_counter()
+        if useSessionFiles:
+          self.saveSession(path, currentUser)
+        else:
+          self.storeBiopsyLedger()
+          slicer.util.saveScene(path)
+        saveTime = time.perf_counter() - startTime
+
+        startTime = time.perf_counter()
+        if useSessionFiles:
+          self.loadSession(path)
+        else:
+          slicer.util.loadScene(path)
+          self.visualizeBiopsies()
+        loadTime = time.perf_counter() - startTime
+        results[cores]["session" if useSessionFiles else "mrml"] = (saveTime, loadTime, os.path.getsize(path))
+
+    self.core.biopsyLedger, self.useSessionFiles = savedLedger, savedUseSessionFiles
+    self.biopsyLedgerModified = True
+    self.getBiopsyCores().setInstances(self.core.biopsyLedger.poses)
+    return results
+
+  def addBenchmarks(self, suite, cases=None, coreCounts=(0, 100, 1000), currentUser="Benchmark"):
+    """
+    Adds the hot paths that need Slicer to a BenchmarkSuite: setupCase of each registered case from disk and
+    from the case cache, each stage of reconstructionCallback, fireBiopsyNeedle and visualizeBiopsies with
+    coreCounts cores already fired, and saveScene / loadScene as session files and as MRML scenes (written to
+    UserData/currentUser). The benchmarks replace the current ledger and loading MRML scenes adds their nodes,
+    so run them in a scratch session with the main window (Scripts/RunBenchmarks.py).
+    """
+    if cases is None:
+      cases = sorted(int(os.path.basename(path)[len("Patient_"):]) for path in glob(os.path.join(self.registeredZonesDirectory, "Patient_*"))
+                     if os.path.basename(path)[len("Patient_"):].isdigit())
+
+    def clearCase(case):
+      self.casePrefetcher.cancel()
+      if case in self.caseCache:
+        self.caseCache.remove(case)
+
+    for case in cases:
+      suite.add("setupCase[Patient_{}].fromDisk".format(case), lambda case=case: self.setupCase(case), repeats=2, warmup=0,
+                setup=lambda case=case: clearCase(case))
+      suite.add("setupCase[Patient_{}].cached".format(case), lambda case=case: self.setupCase(case), repeats=5)
+
+    #Reconstruction stages on the current case (the first one if none is loaded), for a sweeping probe
+    pose = {"index": 0}
+
+    def nextPose():
+      if not self.caseLoaded:
+        self.setupCase(cases[0])
+      if self.core.sliceGenerator is None or self.volumeCompounder is None:
+        self.startReconstruction()
+      pose["index"] += 1
+      probeToPhantom = self.getParameterNode().GetNodeReference(self.PROBE_TO_PHANTOM)
+      probeToPhantom.SetMatrixTransformToParent(TransformUtils.vtkMatrixFromArray(TrackingRecording.sweepPose(pose["index"] / 30.0)))
+
+    def ultrasoundSimVolume():
+      return self.getParameterNode().GetNodeReference(self.ULTRASOUND_SIM_VOLUME)
+
+    suite.add("reconstruction.resliceFrame", lambda: self.resliceFrame(self.getParameterNode(), ultrasoundSimVolume()),
+              repeats=50, setup=nextPose)
+    suite.add("reconstruction.compoundFrame", lambda: self.compoundFrame(self.getParameterNode(), ultrasoundSimVolume()),
+              repeats=50, setup=nextPose)
+    suite.add("reconstruction.grabFrame", lambda: self.grabFrame(ultrasoundSimVolume()), repeats=50, setup=nextPose)
+    suite.add("reconstructionCallback", lambda: self.reconstructionCallback(None, None), repeats=50, setup=nextPose)
+
+    #Firing, redrawing, saving and loading with a ledger of the given size
+    def setLedger(cores):
+      if not self.caseLoaded:
+        self.setupCase(cases[0])
+      self.core.biopsyLedger = SessionFile.randomSession(cores).ledger
+      self.biopsyLedgerModified = True
+      self.getBiopsyCores().setInstances(self.core.biopsyLedger.poses)
+
+    def storeLedger(cores):
+      setLedger(cores)
+      self.storeBiopsyLedger()
+
+    def saveAs(filename, useSessionFiles):
+      savedUseSessionFiles = self.useSessionFiles
+      self.useSessionFiles = useSessionFiles
+      try:
+        self.saveScene(filename, currentUser)
+      finally:
+        self.useSessionFiles = savedUseSessionFiles
+
+    moduleDir = os.path.dirname(slicer.modules.trackedtrussim.path)
+    Path(os.path.join(moduleDir, "Resources", "UserData", currentUser)).mkdir(parents=True, exist_ok=True)
+    for cores in coreCounts:
+      suite.add("fireBiopsyNeedle[{} cores]".format(cores), self.fireBiopsyNeedle, repeats=20,
+                setup=lambda cores=cores: setLedger(cores))
+      suite.add("visualizeBiopsies[{} cores]".format(cores), self.visualizeBiopsies, repeats=20,
+                setup=lambda cores=cores: storeLedger(cores))
+      for useSessionFiles, extension, repeats in ((True, SessionFile.SESSION_EXTENSION, 10), (False, ".mrml", 2)):
+        filename = "Benchmark_{}".format(cores)
+        formatName = "session" if useSessionFiles else "mrml"
+        suite.add("saveScene[{} cores].{}".format(cores, formatName),
+                  lambda filename=filename, useSessionFiles=useSessionFiles: saveAs(filename, useSessionFiles),
+                  repeats=repeats, warmup=0, setup=lambda cores=cores: setLedger(cores))
+        suite.add("loadScene[{} cores].{}".format(cores, formatName),
+                  lambda filename=filename + extension: self.loadScene(filename, currentUser), repeats=repeats, warmup=0)
+    return suite
+
+  def trackingRecordingDirectory(self):
+    moduleDir = os.path.dirname(slicer.modules.trackedtrussim.path)
+    return os.path.join(moduleDir, "Resources", "Recordings")
+
+  def startTrackingRecording(self, recordingPath=None):
+    """
+    Records every ProbeToPhantom and PointerToPhantom update, with its perf_counter time, until
+    stopTrackingRecording. Returns the path of the recording.
+    """
+    self.stopTrackingRecording()
+    if recordingPath is None:
+      Path(self.trackingRecordingDirectory()).mkdir(parents=True, exist_ok=True)
+      recordingPath = os.path.join(self.trackingRecordingDirectory(), "Tracking_{}{}".format(
+        datetime.now().strftime("%m%d%y_%H%M%S"), TrackingRecording.RECORDING_EXTENSION))
+
+    channels = [self.PROBE_TO_PHANTOM, self.POINTER_TO_PHANTOM]
+    self.setupPlusServer()
+    self.trackingRecorder = TrackingRecording.TrackingRecorder(recordingPath, channels)
+    parameterNode = self.getParameterNode()
+    for channel, name in enumerate(channels):
+      node = parameterNode.GetNodeReference(name)
+      tag = node.AddObserver(slicer.vtkMRMLTransformNode.TransformModifiedEvent,
+                             lambda caller, event, channel=channel: self.onTrackingRecorded(caller, channel))
+      self.trackingRecorderObservations.append((node, tag))
+    return recordingPath
+
+  def onTrackingRecorded(self, node, channel):
+    node.GetMatrixTransformToParent(self.trackingMatrix)
+    self.trackingRecorder.append(channel, TransformUtils.arrayFromVTKMatrix(self.trackingMatrix))
+
+  def stopTrackingRecording(self):
+    for node, tag in self.trackingRecorderObservations:
+      node.RemoveObserver(tag)
+    self.trackingRecorderObservations = []
+    if self.trackingRecorder is not None:
+      self.trackingRecorder.close()
+      self.trackingRecorder = None
+
+  def replayTrackingRecording(self, recordingPath, speed=1.0, onFinished=None):
+    """
+    Plays a recording into the ProbeToPhantom and PointerToPhantom nodes from the event loop, in real time
+    scaled by speed, or as fast as possible (in batches that leave the UI responsive) when speed is None.
+    onFinished(replayer) is called at the end. Returns the replayer.
+    """
+    self.stopTrackingReplay()
+    recording = TrackingRecording.TrackingRecording(recordingPath)
+    parameterNode = self.getParameterNode()
+    nodes = {name: parameterNode.GetNodeReference(name) for name in recording.channels}
+
+    def setMatrix(channel, matrix, timestamp):
+      node = nodes.get(channel)
+      if node is not None:
+        node.SetMatrixTransformToParent(TransformUtils.updateVTKMatrixFromArray(self.trackingMatrix, matrix))
+
+    replayer = TrackingRecording.TrackingReplayer(recording, setMatrix, speed, maxSamplesPerStep=None if speed else 100)
+    self.trackingReplayer = replayer
+
+    def tick():
+      if self.trackingReplayer is not replayer:
+        return #Stopped or replaced
+      delay = replayer.step()
+      if delay is None:
+        self.trackingReplayer = None
+        logging.info("Tracking replay of {} samples finished: {}".format(len(recording), replayer.getStats()))
+        if onFinished is not None:
+          onFinished(replayer)
+      else:
+        self.scheduleOnMainThread(delay, tick)
+
+    replayer.start()
+    tick()
+    return replayer
+
+  def stopTrackingReplay(self):
+    self.trackingReplayer = None
+
+  def startSyntheticTracker(self, rate=120.0, jitter=0.0, dropout=0.0, recordingPath=None, port=None):
+    """
+    Serves ProbeToPhantom, PhantomToTracker and PointerToPhantom over OpenIGTLink on localhost instead of the
+    PLUS server, from scripted trajectories or a tracking recording, and connects an OpenIGTLink client to it.
+    The PLUS server must not be running on the same port (SyntheticTracker.DEFAULT_PORT by default). Returns the server.
+    """
+    self.stopSyntheticTracker()
+    if port is None:
+      port = SyntheticTracker.DEFAULT_PORT
+    if recordingPath is None:
+      trajectories = SyntheticTracker.scriptedTrajectories()
+    else:
+      trajectories = SyntheticTracker.recordedTrajectories(recordingPath)
+    self.syntheticTracker = SyntheticTracker.SyntheticTrackerServer(trajectories, rate, jitter, dropout, port)
+    self.syntheticTracker.start()
+
+    #The connector updates the existing transform nodes of the same names
+    connectorNode = slicer.mrmlScene.GetFirstNodeByName(self.SYNTHETIC_TRACKER_CONNECTOR)
+    if connectorNode is None:
+      connectorNode = slicer.mrmlScene.AddNewNodeByClass("vtkMRMLIGTLConnectorNode", self.SYNTHETIC_TRACKER_CONNECTOR)
+      connectorNode.SaveWithSceneOff()
+    connectorNode.SetTypeClient("localhost", self.syntheticTracker.port)
+    connectorNode.Start()
+    return self.syntheticTracker
+
+  def stopSyntheticTracker(self):
+    connectorNode = slicer.mrmlScene.GetFirstNodeByName(self.SYNTHETIC_TRACKER_CONNECTOR)
+    if connectorNode is not None:
+      connectorNode.Stop()
+    if self.syntheticTracker is not None:
+      self.syntheticTracker.stop()
+      self.syntheticTracker = None
+
+  def measureTrackerRates(self, rates=(30, 60, 120, 250, 500, 1000), seconds=5.0, settleSeconds=1.0):
+    """
+    Runs the synthetic tracker at each rate while the reconstruction is running and returns, per rate, the
+    achieved tracker rate, the ProbeToPhantom updates received and frames produced per second, the poses
+    coalesced and dropped, and the receive-to-frame latency in ms. Blocks, processing events, for about
+    (seconds + settleSeconds) per rate.
+    """
+    if self.syntheticTracker is None:
+      self.startSyntheticTracker()
+    results = {}
+    for rate in rates:
+      self.syntheticTracker.setRate(rate)
+      self.processEventsFor(settleSeconds)
+      self.syntheticTracker.resetStats()
+      self.reconstructionScheduler.resetCounts()
+      self.processEventsFor(seconds)
+
+      serverStats = self.syntheticTracker.getStats()
+      counts = self.reconstructionScheduler.getCounts()
+      latencies = 1000 * np.array(self.reconstructionScheduler.latencies) if self.reconstructionScheduler.latencies else np.zeros(1)
+      results[rate] = {"trackerRate": serverStats["tickRate"], "receivedRate": counts["received"] / seconds,
+                       "frameRate": counts["processed"] / seconds, "coalesced": counts["coalesced"],
+                       "dropped": counts["dropped"], "meanLatencyMs": float(latencies.mean()),
+                       "p95LatencyMs": float(np.percentile(latencies, 95)), "maxLatencyMs": float(latencies.max())}
+      logging.info("Synthetic tracker at {} Hz: {}".format(rate, results[rate]))
+    return results
+
+  @staticmethod
+  def processEventsFor(seconds):
+    endTime = time.perf_counter() + seconds
+    while time.perf_counter() < endTime:
+      slicer.app.processEvents()
+      time.sleep(0.001)
+
+  @staticmethod
+  def scheduleOnMainThread(delaySeconds, function):
+    qt.QTimer.singleShot(int(round(delaySeconds * 1000)), function)
+
+  def setMaxFrameRate(self, maxFrameRate):
+    self.maxFrameRate = maxFrameRate
+    self.reconstructionScheduler.setMaxRate(maxFrameRate)
+
+  def getSchedulerCounts(self):
+    """
+    Returns how many tracker events were received, processed, coalesced into a newer pose and dropped as stale.
+    """
+    return self.reconstructionScheduler.getCounts()
+
   def stopReconstruction(self):
 
-    #Parameter node
-    parameterNode = slicer.mrmlScene.GetSingletonNode(self.moduleName, "vtkMRMLScriptedModuleNode")
+    #Remove only the listener that startReconstruction added to the tracking data
+    self.reconstructionScheduler.detachAll()
 
-    #Remove the listener from the tracking data
-    probeToPhantom = parameterNode.GetNodeReference(self.PROBE_TO_PHANTOM)
-    probeToPhantom.RemoveObserver(probeToPhantom.TransformModifiedEvent)
+    #Fill the gaps between the compounded frames
+    if self.volumeCompounder is not None:
+      filledVoxels = self.volumeCompounder.fillHoles()
+      logging.info("Reconstruction stopped after {} frames, {} voxels hole filled".format(
+        self.volumeCompounder.stats.frameCount, filledVoxels))
+
+  def setupReconstruction(self):
+    """
+    Creates what only the reconstruction needs: the PLUS server nodes for live tracking (again after a scene
+    close removed them) and, on the first start, the frame buffers and the screen capture logic of the grab path.
+    """
+    self.setupPlusServer()
+    if self.frameBuffer is not None:
+      return
+    with startupTimer.stage("reconstruction"):
+      self.frameBuffer = FrameBuffer.GrayscaleFrameBuffer()
+      self.frameStats = {self.FRAME_SOURCE_RESLICE: FrameBuffer.FrameStats(),
+                         self.FRAME_SOURCE_GRAB: FrameBuffer.FrameStats(),
+                         "LegacyGrab": FrameBuffer.FrameStats()}
+      self.screencapLogic = ScreenCapture.ScreenCaptureLogic()
 
   def startReconstruction(self):
 
+    self.setupReconstruction()
+
     #Get the current directory
     moduleDir = os.path.dirname(slicer.modules.trackedtrussim.path)
 
@@ -540,9 +1181,6 @@ class TrackedTRUSSimLogic(ScriptedLoadableModuleLogic):
     biopsyTrajectoryDispNode = biopsyTrajectoryModel.GetDisplayNode()
     biopsyTrajectoryDispNode.SliceIntersectionVisibilityOff()
 
-    #Instantiate screencapture logic
-    self.screencapLogic = ScreenCapture.ScreenCaptureLogic()
-
     # Create a new blank volume if it doesn't already exist
     ultrasoundSimVolume = parameterNode.GetNodeReference(self.ULTRASOUND_SIM_VOLUME)
     if ultrasoundSimVolume is None:
@@ -571,9 +1209,13 @@ class TrackedTRUSSimLogic(ScriptedLoadableModuleLogic):
       #Add to parameter node
       parameterNode.SetNodeReferenceID(self.ULTRASOUND_SIM_VOLUME, ultrasoundSimVolume.GetID())
 
-    #Add a listener to the tracking data
+    #Start a new 3D reconstruction
+    self.setupVolumeCompounder(parameterNode)
+
+    #Add a listener to the tracking data, through the scheduler so bursts of tracker messages are coalesced
     probeToPhantom = parameterNode.GetNodeReference(self.PROBE_TO_PHANTOM)
-    probeToPhantom.AddObserver(probeToPhantom.TransformModifiedEvent, self.reconstructionCallback)
+    self.reconstructionScheduler.detachAll()
+    self.reconstructionScheduler.observe(probeToPhantom, probeToPhantom.TransformModifiedEvent)
 
     #Confirm that USSimVolumeToUSMask is added to scene; if not, add it
     USMaskToProbeModel = parameterNode.GetNodeReference(self.USMASK_TO_PROBEMODEL)
@@ -585,12 +1227,22 @@ class TrackedTRUSSimLogic(ScriptedLoadableModuleLogic):
       parameterNode.SetNodeReferenceID(self.USSIMVOLUME_TO_USMASK, USSimVolumeToUSMask.GetID())
       USSimVolumeToUSMask.SetSaveWithScene(False)
 
-      #Since it is new to the scene, add the SimVolume to this transform
-      ultrasoundSimVolume.SetAndObserveTransformNodeID(USSimVolumeToUSMask.GetID())
-
     #Add the transform to the overall hierarchy
     USSimVolumeToUSMask.SetAndObserveTransformNodeID(USMaskToProbeModel.GetID())
 
+    #USSimVolumeToUSMask may have just been added to the hierarchy
+    self.setupTransformChain()
+
+    #The resliced frame has the geometry of the US mask, so place the volume exactly on the mask
+    if self.frameSource == self.FRAME_SOURCE_RESLICE and self.setupSliceGenerator():
+      usMaskVolume = parameterNode.GetNodeReference(self.MASK_VOLUME)
+      maskIJKToRAS = vtk.vtkMatrix4x4()
+      usMaskVolume.GetIJKToRASMatrix(maskIJKToRAS)
+      ultrasoundSimVolume.SetIJKToRASMatrix(maskIJKToRAS)
+      ultrasoundSimVolume.SetAndObserveTransformNodeID(USMaskToProbeModel.GetID())
+    else:
+      ultrasoundSimVolume.SetAndObserveTransformNodeID(USSimVolumeToUSMask.GetID())
+
     #Set the yellow slice to show the volume version of the slice
     layoutManager = slicer.app.layoutManager()
     compositeNode = layoutManager.sliceWidget("Yellow").sliceLogic().GetSliceCompositeNode()
@@ -629,33 +1281,344 @@ class TrackedTRUSSimLogic(ScriptedLoadableModuleLogic):
     # yellowSliceNode.SetFieldOfView(newSliceWidthMm, newSliceWidthMm * aspectRatioY, yellowSliceFovMm[2])
 
 
+  def setupSliceGenerator(self):
+    """
+    Creates the offscreen slice generator from the US mask and the current case's TRUS volume.
+    Returns False if there is no TRUS volume to sample yet.
+    """
+    parameterNode = self.getParameterNode()
+    if not self.caseLoaded:
+      logging.warning("No case loaded, the simulated US frame will be grabbed from the Red slice view")
+      return False
+    trusVolume = self.getCaseNode().GetNodeReference(self.TRUS_VOLUME)
+    if trusVolume is None:
+      logging.warning("No TRUS volume loaded, the simulated US frame will be grabbed from the Red slice view")
+      return False
+
+    usMaskVolume = parameterNode.GetNodeReference(self.MASK_VOLUME)
+    maskIJKToRAS = vtk.vtkMatrix4x4()
+    usMaskVolume.GetIJKToRASMatrix(maskIJKToRAS)
+    fanMask = slicer.util.arrayFromVolume(usMaskVolume)[0] > 0
+
+    self.core.setSliceGenerator(SliceGenerator.UltrasoundSliceGenerator(fanMask, slicer.util.arrayFromVTKMatrix(maskIJKToRAS)))
+    if self.useImageFormation:
+      imageFormation = ImageFormation.imageFormationForMask(fanMask, **self.imageFormationParameters)
+      if imageFormation is None:
+        logging.warning("The US mask does not match the probe geometry, frames are shown without image formation")
+      self.core.sliceGenerator.setImageFormation(imageFormation)
+    self.updateSliceGeneratorVolume()
+    return True
+
+  def updateSliceGeneratorVolume(self):
+    """
+    Hands the current TRUS volume, its voxel to RAS matrix and its window / level to the slice generator.
+    """
+    if self.core.sliceGenerator is None:
+      return
+    trusVolume = self.getCaseNode().GetNodeReference(self.TRUS_VOLUME)
+
+    ijkToRAS = vtk.vtkMatrix4x4()
+    trusVolume.GetIJKToRASMatrix(ijkToRAS)
+    volumeToWorld = vtk.vtkMatrix4x4()
+    if trusVolume.GetParentTransformNode() is not None:
+      trusVolume.GetParentTransformNode().GetMatrixTransformToWorld(volumeToWorld)
+    ijkToWorld = vtk.vtkMatrix4x4()
+    vtk.vtkMatrix4x4.Multiply4x4(volumeToWorld, ijkToRAS, ijkToWorld)
+
+    displayNode = trusVolume.GetDisplayNode()
+    window = displayNode.GetWindow() if displayNode else None
+    level = displayNode.GetLevel() if displayNode else None
+    self.core.sliceGenerator.setVolume(trusVolume.GetImageData(), slicer.util.arrayFromVTKMatrix(ijkToWorld), window, level)
+
+    if self.useCylindricalResampling:
+      startTime = time.perf_counter()
+      trusToCylinder = vtk.vtkMatrix4x4()
+      trusVolume.GetParentTransformNode().GetMatrixTransformToParent(trusToCylinder)
+      cylinderModel = self.getParameterNode().GetNodeReference(self.CYLINDER_MODEL)
+      axisToCylinder = CylindricalResampling.cylinderAxisFromBounds(cylinderModel.GetPolyData().GetBounds())
+      cylindricalVolume = CylindricalResampling.loadOrComputeCylindricalVolume(
+        trusVolume.GetStorageNode().GetFileName(), slicer.util.arrayFromVolume(trusVolume),
+        slicer.util.arrayFromVTKMatrix(ijkToRAS), slicer.util.arrayFromVTKMatrix(trusToCylinder), axisToCylinder)
+      self.core.sliceGenerator.setCylindricalVolume(cylindricalVolume)
+      logging.info("Cylindrical TRUS planes ({}, {:.1f} MB) ready in {:.3f} s".format(
+        len(cylindricalVolume.planes), cylindricalVolume.nbytes / 1e6, time.perf_counter() - startTime))
+
+  def resliceFrame(self, parameterNode, ultrasoundSimVolume):
+    """
+    Produces the simulated US frame offscreen, at the US mask resolution, into the frame buffer.
+    """
+    startTime = time.perf_counter()
+    profiler = self.stageProfiler
+
+    allocations = 1 if self.frameBuffer.resize(self.core.sliceGenerator.width, self.core.sliceGenerator.height) else 0
+    self.core.generateFrame(out=self.frameBuffer.array)
+    profiler.mark("reslice")
+    self.frameBuffer.markModified()
+    profiler.mark("vtkModified")
+
+    if ultrasoundSimVolume.GetImageData() is not self.frameBuffer.imageData:
+      ultrasoundSimVolume.SetAndObserveImageData(self.frameBuffer.imageData)
+    profiler.mark("setImageData")
+
+    self.frameStats[self.FRAME_SOURCE_RESLICE].addFrame(time.perf_counter() - startTime, allocations)
+
   def reconstructionCallback(self,caller, eventId):
 
+    profiler = self.stageProfiler
+    profiler.begin()
+    eventTime = self.reconstructionScheduler.currentEventTime
+    if profiler.enabled and eventTime is not None:
+      profiler.record("poseQueue", profiler.frameStart - eventTime)
+
     #Parameter node
     parameterNode = slicer.mrmlScene.GetSingletonNode(self.moduleName, "vtkMRMLScriptedModuleNode")
+    ultrasoundSimVolume = parameterNode.GetNodeReference(self.ULTRASOUND_SIM_VOLUME)
+
+    if self.frameSource == self.FRAME_SOURCE_RESLICE and self.core.sliceGenerator is not None:
+      self.resliceFrame(parameterNode, ultrasoundSimVolume)
+    else:
+      self.grabFrame(ultrasoundSimVolume)
+
+    #Compound the new frame into the 3D reconstruction
+    self.compoundFrame(parameterNode, ultrasoundSimVolume)
+    profiler.mark("compound")
+
+    if profiler.enabled:
+      #The Yellow view shows the frame at its next render
+      self.displayPending = (eventTime, profiler.end("callback"))
+
+  def grabFrame(self, ultrasoundSimVolume):
+    """
+    Produces the simulated US frame by grabbing the pixels of the rendered Red slice view.
+    """
+    startTime = time.perf_counter()
+
+    profiler = self.stageProfiler
 
     #Get the current contents of the red slice view
     redSliceView = self.screencapLogic.viewFromNode(slicer.mrmlScene.GetNodeByID('vtkMRMLSliceNodeRed'))
     im = qt.QPixmap.grabWidget(redSliceView).toImage()
+    profiler.mark("grab")
 
     width, height = im.width(), im.height()
-    img_np = np.array(im.constBits()).reshape(height, width, 4)
-    grayscale = cv2.cvtColor(img_np, cv2.COLOR_BGR2GRAY)
-    # grayscale = cv2.resize(grayscale, (800, 800))
-    # cv2.imshow("TEST", grayscale)
-    vtkGrayscale = numpy_support.numpy_to_vtk(grayscale.ravel(), deep=True, array_type=vtk.VTK_UNSIGNED_CHAR)
-
-    #Convert the image to vtkImageData object
-    sliceImageData = vtk.vtkImageData()
-    # sliceImageData.SetScalarTypeToUnsignedChar()
-    sliceImageData.SetDimensions(width, height, 1)
-    sliceImageData.SetOrigin(0.0, 0.0, 0.0)
-    sliceImageData.SetSpacing(800/width, 800/height, 1.0)
-    sliceImageData.GetPointData().SetScalars(vtkGrayscale)
-
-    #Write this image data to the volume node
-    ultrasoundSimVolume = parameterNode.GetNodeReference(self.ULTRASOUND_SIM_VOLUME)
-    ultrasoundSimVolume.SetAndObserveImageData(sliceImageData)
+    spacing = (800/width, 800/height, 1.0)
+
+    if self.useLegacyFramePath:
+      sliceImageData, allocations = FrameBuffer.copyFrameLegacy(im.constBits(), width, height, spacing)
+      profiler.mark("legacyCopy")
+      ultrasoundSimVolume.SetAndObserveImageData(sliceImageData)
+      profiler.mark("setImageData")
+      self.frameStats["LegacyGrab"].addFrame(time.perf_counter() - startTime, allocations)
+      return
+
+    #Convert the grabbed pixels straight into the preallocated grayscale buffer
+    bgra = FrameBuffer.bgraViewFromBuffer(im.constBits(), width, height, im.bytesPerLine())
+    profiler.mark("numpyView")
+    allocations = self.frameBuffer.updateFromBGRA(bgra, profiler)
+    if allocations:
+      self.frameBuffer.imageData.SetSpacing(spacing)
+
+    #The volume observes the buffer's image data, so the Modified() in updateFromBGRA is enough
+    #to refresh it; the image data only has to be set again after a reallocation or a scene change
+    if ultrasoundSimVolume.GetImageData() is not self.frameBuffer.imageData:
+      ultrasoundSimVolume.SetAndObserveImageData(self.frameBuffer.imageData)
+    profiler.mark("setImageData")
+
+    self.frameStats[self.FRAME_SOURCE_GRAB].addFrame(time.perf_counter() - startTime, allocations)
+
+  def setupVolumeCompounder(self, parameterNode):
+    """
+    Creates an empty reconstruction grid over the TRUS volume and shows it in the ReconstructedVolume node.
+    """
+    self.volumeCompounder = None
+    if not self.caseLoaded:
+      return
+    trusVolume = self.getCaseNode().GetNodeReference(self.TRUS_VOLUME)
+    if trusVolume is None:
+      logging.warning("No TRUS volume loaded, frames will not be compounded in 3D")
+      return
+
+    bounds = [0.0] * 6
+    trusVolume.GetRASBounds(bounds)
+    self.volumeCompounder = VolumeReconstruction.VolumeCompounder.fromBounds(
+      bounds, self.reconstructionSpacing, self.reconstructionMethod or VolumeReconstruction.VolumeCompounder.NEAREST)
+
+    reconstructedVolume = parameterNode.GetNodeReference(self.RECONSTRUCTED_VOLUME)
+    if reconstructedVolume is None:
+      reconstructedVolume = slicer.mrmlScene.AddNewNodeByClass("vtkMRMLScalarVolumeNode", self.RECONSTRUCTED_VOLUME)
+      reconstructedVolume.CreateDefaultDisplayNodes()
+      reconstructedVolume.SetSaveWithScene(False)
+      parameterNode.SetNodeReferenceID(self.RECONSTRUCTED_VOLUME, reconstructedVolume.GetID())
+
+    gridIJKToRAS = vtk.vtkMatrix4x4()
+    gridIJKToRAS.DeepCopy(self.volumeCompounder.gridIJKToWorld.ravel())
+    reconstructedVolume.SetIJKToRASMatrix(gridIJKToRAS)
+    reconstructedVolume.SetAndObserveTransformNodeID(None)
+    reconstructedVolume.SetAndObserveImageData(self.volumeCompounder.imageData)
+
+  def compoundFrame(self, parameterNode, ultrasoundSimVolume):
+    """
+    Inserts the current simulated frame into the 3D reconstruction at its tracked pose.
+    """
+    if self.volumeCompounder is None:
+      return
+
+    #The resliced frame sits on the US mask; only the fan carries image content
+    fanMask = None
+    parentTransformName = self.USSIMVOLUME_TO_USMASK
+    if self.frameSource == self.FRAME_SOURCE_RESLICE and self.core.sliceGenerator is not None:
+      fanMask = self.core.sliceGenerator.fanMask
+      parentTransformName = self.USMASK_TO_PROBEMODEL
+
+    #Pose of the frame pixels, from the volume geometry and the transform chain above it
+    ijkToRAS = vtk.vtkMatrix4x4()
+    ultrasoundSimVolume.GetIJKToRASMatrix(ijkToRAS)
+    ijkToWorld = self.transformChain.matrixToWorld(parentTransformName) @ TransformUtils.arrayFromVTKMatrix(ijkToRAS)
+
+    frame = slicer.util.arrayFromVolume(ultrasoundSimVolume)
+    self.volumeCompounder.insertFrame(frame[0], ijkToWorld, fanMask)
+
+  def setupTransformChain(self):
+    """
+    Builds the transform chain cache for the probe, US image, needle and pointer frames.
+    Only the tracked poses are read per lookup; the static calibration transforms between them
+    are precomposed and recomposed only when one of their nodes is modified.
+    """
+    parameterNode = self.getParameterNode()
+
+    for node, tag in self.transformChainObservations:
+      node.RemoveObserver(tag)
+    self.transformChainObservations = []
+    self.transformChainMTimes = {}
+
+    #The chains are defined by the core; frames whose transforms are not in the scene (yet) are left out
+    availableLinks = {link for links in SimulationCore.CHAINS.values() for link in links
+                      if parameterNode.GetNodeReference(link) is not None}
+    self.transformChain = self.core.setupTransformChain(availableLinks)
+
+    for link in self.transformChain.staticLinks():
+      node = parameterNode.GetNodeReference(link)
+      self.transformChainMTimes[link] = node.GetTransformToParent().GetMTime()
+      tag = node.AddObserver(slicer.vtkMRMLTransformNode.TransformModifiedEvent,
+                             lambda caller, event, link=link: self.onTransformChainLinkModified(caller, link))
+      self.transformChainObservations.append((node, tag))
+
+  def onTransformChainLinkModified(self, node, link):
+    #TransformModifiedEvent also fires when a parent moves; only the node's own matrix matters here
+    mtime = node.GetTransformToParent().GetMTime()
+    if mtime != self.transformChainMTimes.get(link):
+      self.transformChainMTimes[link] = mtime
+      self.transformChain.invalidate(link)
+
+  def getMatrixToParent(self, transformName):
+    transformNode = self.getParameterNode().GetNodeReference(transformName)
+    transformNode.GetMatrixTransformToParent(self.matrixToParent)
+    return TransformUtils.arrayFromVTKMatrix(self.matrixToParent)
+
+  def getImageToRAS(self):
+    """
+    Returns the matrix from US mask pixel (i, j, 0) to RAS for the current probe pose.
+    """
+    usMaskVolume = self.getParameterNode().GetNodeReference(self.MASK_VOLUME)
+    maskIJKToRAS = vtk.vtkMatrix4x4()
+    usMaskVolume.GetIJKToRASMatrix(maskIJKToRAS)
+    return self.transformChain.matrixToWorld(self.USMASK_TO_PROBEMODEL) @ TransformUtils.arrayFromVTKMatrix(maskIJKToRAS)
+
+  def getNeedleToRAS(self):
+    """
+    Returns the matrix from the biopsy needle model to RAS, at the current probe pose and needle depth.
+    """
+    return self.core.getNeedleToWorld()
+
+  def getProbeModelToRAS(self):
+    return self.core.getProbeModelToWorld()
+
+  def setStageProfiling(self, enabled):
+    """
+    Turns the per-stage frame latencies on or off. When on, the stages of reconstructionCallback, the render
+    of the Yellow view and the time from a tracker pose to its frame on screen are timed.
+    """
+    if enabled == self.stageProfiler.enabled:
+      return
+    for renderWindow, tag in self.renderObservations:
+      renderWindow.RemoveObserver(tag)
+    self.renderObservations = []
+    self.displayPending = None
+    if not enabled:
+      self.stageProfiler = StageProfiler.NULL_PROFILER
+      self.setLatencyOverlayVisible(False)
+      return
+
+    self.stageProfiler = StageProfiler.StageProfiler()
+    renderWindow = slicer.app.layoutManager().sliceWidget("Yellow").sliceView().renderWindow()
+    for event, callback in ((vtk.vtkCommand.StartEvent, self.onYellowRenderStarted),
+                            (vtk.vtkCommand.EndEvent, self.onYellowRenderEnded)):
+      self.renderObservations.append((renderWindow, renderWindow.AddObserver(event, callback)))
+
+  def onYellowRenderStarted(self, caller, event):
+    self.renderStartTime = time.perf_counter()
+
+  def onYellowRenderEnded(self, caller, event):
+    now = time.perf_counter()
+    if self.renderStartTime is not None:
+      self.stageProfiler.record("render", now - self.renderStartTime)
+      self.renderStartTime = None
+    if self.displayPending is not None:
+      eventTime, frameEndTime = self.displayPending
+      self.displayPending = None
+      self.stageProfiler.record("frameToDisplay", now - frameEndTime)
+      if eventTime is not None:
+        self.stageProfiler.record("poseToDisplay", now - eventTime)
+
+  def setLatencyOverlayVisible(self, visible, interval=0.5):
+    """
+    Shows the percentiles and histograms of the frame stages in the Yellow view, refreshed every interval
+    seconds (not every frame, so that the overlay does not add renders of its own).
+    """
+    sliceView = slicer.app.layoutManager().sliceWidget("Yellow").sliceView()
+    if self.latencyOverlayTimer is not None:
+      self.latencyOverlayTimer.stop()
+      self.latencyOverlayTimer = None
+    if not visible:
+      sliceView.cornerAnnotation().SetText(vtk.vtkCornerAnnotation.UpperLeft, "")
+      sliceView.scheduleRender()
+      return
+
+    sliceView.cornerAnnotation().SetNonlinearFontScaleFactor(0.6)
+    def updateOverlay():
+      sliceView.cornerAnnotation().SetText(vtk.vtkCornerAnnotation.UpperLeft, self.stageProfiler.formatSummary())
+      sliceView.scheduleRender()
+    self.latencyOverlayTimer = qt.QTimer()
+    self.latencyOverlayTimer.setInterval(int(interval * 1000))
+    self.latencyOverlayTimer.timeout.connect(updateOverlay)
+    self.latencyOverlayTimer.start()
+    updateOverlay()
+
+  def exportStageProfile(self, path=None):
+    """
+    Writes the frame stage latencies to a JSON file (by default Resources/Benchmarks/Latency_<date>.json) and
+    returns its path.
+    """
+    if path is None:
+      moduleDir = os.path.dirname(slicer.modules.trackedtrussim.path)
+      directory = os.path.join(moduleDir, "Resources", "Benchmarks")
+      Path(directory).mkdir(parents=True, exist_ok=True)
+      path = os.path.join(directory, "Latency_{}.json".format(datetime.now().strftime("%m%d%y_%H%M%S")))
+    self.stageProfiler.export(path, {"frameSource": self.frameSource, "maxFrameRate": self.maxFrameRate,
+                                     "legacyFramePath": self.useLegacyFramePath,
+                                     "scheduler": self.reconstructionScheduler.getCounts()})
+    return path
+
+  def getFrameStats(self):
+    """
+    Returns per-frame allocation counts, latency and frames per second of each frame source.
+    """
+    frameStats = {}
+    for source, stats in self.frameStats.items():
+      summary = stats.summary()
+      summary["fps"] = 1000.0 / summary["meanLatencyMs"] if summary["meanLatencyMs"] > 0 else 0.0
+      frameStats[source] = summary
+    return frameStats
 
 
   #Redefine createParameterNode method.
@@ -741,37 +1704,6 @@ class TrackedTRUSSimLogic(ScriptedLoadableModuleLogic):
     layoutManager.setLayout(customLayoutId)
 
 
-  def maskSlice(self):
-
-    #Use screencap module logic to get slice view
-    screenCapLogic = ScreenCapture.ScreenCaptureLogic()
-    view = screenCapLogic.viewFromNode(slicer.util.getNode('vtkMRMLSliceNodeRed'))
-    view.forceRender()
-
-    #Apply vtkWindowToImageFilter
-    rw = view.renderWindow()
-    wti = vtk.vtkWindowToImageFilter()
-
-    wti.SetInput(rw)
-    wti.Update()
-
-    capturedImage = wti.GetOutput()
-    cols, rows, _ = capturedImage.GetDimensions()
-    print("columns: " + str(cols))
-    print("rows: " + str(rows))
-    sc = capturedImage.GetPointData().GetScalars()
-    npImage = vtk_to_numpy(sc)
-    npImage = npImage.reshape(rows, cols, -1)
-    npImage = np.flipud(npImage)
-
-    cv2.imshow("MASK", mask_int)
-    cv2.imwrite("C:\\repos\\TRUS_Trainer\\TrackedTRUSSim\\TrackedTRUSSim\\Resources\\Utils\\US_Mask.png", mask)
-
-    npImage[~mask] = [0,0,0]
-
-    cv2.imshow("TEST", npImage)
-
-
   def moveBiopsy(self, biopsyDepth):
 
     #Get the parameter node and transform node
@@ -785,74 +1717,136 @@ class TrackedTRUSSimLogic(ScriptedLoadableModuleLogic):
 
     BiopsyModelToBiopsyTrajectory.SetMatrixTransformToParent(rawTransform)
 
+    if self.journal is not None:
+      self.journal.depthChanged(self.currCaseNumber, biopsyDepth)
+
     # transformStr = str(slicer.util.arrayFromTransformMatrix(BiopsyModelToBiopsyTrajectory))
 
 
   def fireBiopsyNeedle(self):
     '''
     When the biopsy needle is fired, the following occurs:
-    1. The current value of the BiopsyNeedleToProbeModel transform is saved.
-    2. The BiopsyNeedleToProbeModel transform, biopsy model and slider are moved back
+    1. The current value of the BiopsyModelToReference transform, the time and the needle depth are
+        appended to the biopsy ledger.
+    2. A core is added to the biopsy cores model.
+    3. The BiopsyModelToBiopsyTrajectory transform, biopsy model and slider are moved back
         to their default locations.
-    3. A label updated indicating that the biopsy was taken.
     '''
 
-    #Get the parameter node
-    parameterNode = self.getParameterNode()
-    caseNode = self.getCaseNode()
-
-    moduleDir = os.path.dirname(slicer.modules.trackedtrussim.path)
-
-    #Get relevant models / transforms
-    BiopsyModelToBiopsyTrajectory = parameterNode.GetNodeReference(self.BIOPSYMODEL_TO_BIOPSYTRAJECTORY)
-    biopsyTransformRolesNode = caseNode.GetParameter(self.BIOPSY_TRANSFORM_ROLES)
-
-    # print("biopsy transform roles node: " + str(biopsyTransformRolesNode))
-
-    #Load all previous biopsy names
-    biopsyTransformRoles = []
-    if biopsyTransformRolesNode is not '':
-      biopsyTransformRoles = json.loads(biopsyTransformRolesNode)
+    #The core records the pose, depth and zones of the core at the current needle pose
+    self.prepareScoring()
+    fireTime = time.time()
+    biopsyModelToReference, zoneFractions = self.core.fireBiopsy(fireTime)
+    biopsyDepth = self.core.biopsyLedger.depths[-1]
 
-    # print("biopsyTransformRoles: " + str(biopsyTransformRoles))
+    #Draw the core; neither recording nor drawing depends on how many cores were fired before
+    self.biopsyLedgerModified = True
+    if self.journal is not None:
+      self.journal.biopsyFired(self.currCaseNumber, biopsyModelToReference, biopsyDepth, zoneFractions, fireTime)
+    self.getBiopsyCores().appendInstance(biopsyModelToReference)
 
-    #Name the current one
-    currBiopsyRole = "BiopsyModelToReference_" + str(len(biopsyTransformRoles))
-
-    #Get a copy of the current biopsy transform
-    biopsyModelToReferenceTransform = vtk.vtkMatrix4x4()
-    BiopsyModelToBiopsyTrajectory.GetMatrixTransformToWorld(biopsyModelToReferenceTransform)
-
-    #Add a duplicate transform to the scene
-    biopsyModelToReferenceNode = slicer.mrmlScene.AddNewNodeByClass("vtkMRMLLinearTransformNode", currBiopsyRole)
-    biopsyModelToReferenceNode.SetMatrixTransformToParent(biopsyModelToReferenceTransform)
-    caseNode.SetNodeReferenceID(currBiopsyRole, biopsyModelToReferenceNode.GetID())
-
-    #Create a biopsy cylinder and add it to the new transform
-    biopsyModelPath = os.path.join(moduleDir, "Resources", "models", "BiopsyModel.vtk")
-    biopsyModel =  slicer.util.loadModel(biopsyModelPath)
-    biopsyModel.SetName("BiopsyModel_" + str(len(biopsyTransformRoles)))
-
-    biopsyModel.SetAndObserveTransformNodeID(biopsyModelToReferenceNode.GetID())
+    #Reset the value of BiopsyModelToBiopsyTrajectory after saving it
+    self.moveBiopsy(0)
 
-    #Change the colour
-    biopsyDispNode = biopsyModel.GetDisplayNode()
-    biopsyDispNode.SetColor(1,0.5,0)
-    biopsyDispNode.SliceIntersectionVisibilityOn()
-    biopsyDispNode.SetSliceIntersectionOpacity(0.8)
+  def getBiopsyCoreSegment(self):
+    '''
+    Returns the two ends of the biopsy core (the axis of the biopsy model) in biopsy model coordinates.
+    '''
+    if self.core.coreSegment is None:
+      bounds = self.getParameterNode().GetNodeReference(self.BIOPSY_MODEL).GetPolyData().GetBounds()
+      self.core.setCoreSegment(SimulationCore.coreSegmentFromBounds(bounds))
+    return self.core.coreSegment
 
-    #Update the list of transform IDs
-    biopsyTransformRoles = biopsyTransformRoles + [currBiopsyRole]
-    biopsyTransformRoles = json.dumps(biopsyTransformRoles)
-    caseNode.SetParameter(self.BIOPSY_TRANSFORM_ROLES, biopsyTransformRoles)
+  def prepareScoring(self):
+    '''
+    Hands the core what it scores against that lives in the scene: the biopsy model axis and the zones' pose.
+    '''
+    self.getBiopsyCoreSegment()
+    if self.core.zoneIndex is not None or self.core.zoneDistances is not None:
+      self.updateZonesToWorld()
 
-    biopsyTransformRolesNode = caseNode.GetParameter(self.BIOPSY_TRANSFORM_ROLES)
+  def getNeedleZoneComposition(self):
+    '''
+    Returns the fraction of the biopsy core at the current needle pose in each of ZoneIndex.ZONES,
+    or None if there is no zone index for the case.
+    '''
+    if self.core.zoneIndex is None or self.transformChain is None:
+      return None
+    self.prepareScoring()
+    return self.core.getNeedleZoneComposition()
+
+  def updateZonesToWorld(self):
+    #The zones follow TRUSToCylinder, which the user can move, so its pose is read on every lookup
+    trusToCylinder = self.getCaseNode().GetNodeReference(self.TRUS_TO_CYLINDER)
+    trusToCylinder.GetMatrixTransformToWorld(self.zonesToWorld)
+    self.core.setZonesToWorld(TransformUtils.arrayFromVTKMatrix(self.zonesToWorld))
+
+  def getTargetDistances(self):
+    '''
+    Returns the signed distances (mm, negative inside) from the biopsy core tip and from the probe tip to the
+    boundary of TARGET_ZONE, as a dict with None for a distance that cannot be measured. None without a case.
+    '''
+    if self.core.zoneDistances is None or self.transformChain is None:
+      return None
+    self.prepareScoring()
+    return self.core.getTargetDistances(self.TARGET_ZONE)
 
-    # print("new biopsyTRansformRoles" + biopsyTransformRoles)
-    # print("New transform roles node: " + str(biopsyTransformRoles))
+  def getBiopsyCores(self):
+    '''
+    Returns the instanced polydata of the fired cores, creating it and its model node on first use.
+    '''
+    parameterNode = self.getParameterNode()
+    if self.biopsyCores is None:
+      biopsyModel = parameterNode.GetNodeReference(self.BIOPSY_MODEL)
+      self.biopsyCores = BiopsyLedger.InstancedPolyData(biopsyModel.GetPolyData())
+
+    biopsyCoresModel = parameterNode.GetNodeReference(self.BIOPSY_CORES_MODEL)
+    if biopsyCoresModel is None:
+      biopsyCoresModel = slicer.mrmlScene.AddNewNodeByClass("vtkMRMLModelNode", self.BIOPSY_CORES_MODEL)
+      biopsyCoresModel.SetSaveWithScene(False) #Rebuilt from the biopsy ledger on load
+      biopsyCoresModel.CreateDefaultDisplayNodes()
+      parameterNode.SetNodeReferenceID(self.BIOPSY_CORES_MODEL, biopsyCoresModel.GetID())
+
+      #Change the colour
+      biopsyDispNode = biopsyCoresModel.GetDisplayNode()
+      biopsyDispNode.SetColor(1,0.5,0)
+      biopsyDispNode.SliceIntersectionVisibilityOn()
+      biopsyDispNode.SetSliceIntersectionOpacity(0.8)
+    if biopsyCoresModel.GetPolyData() is not self.biopsyCores.polyData:
+      biopsyCoresModel.SetAndObservePolyData(self.biopsyCores.polyData)
+    return self.biopsyCores
+
+  def storeBiopsyLedger(self):
+    '''
+    Writes the biopsy ledger into the case node as a single parameter. Done when saving, not on every fire.
+    '''
+    if self.biopsyLedgerModified:
+      self.getCaseNode().SetParameter(self.BIOPSY_LEDGER, self.core.biopsyLedger.toString())
+      self.biopsyLedgerModified = False
 
-    #Reset the value of BiopsyModelToBiopsyTrajectory after saving it
-    self.moveBiopsy(0)
+  def readLegacyBiopsyTransforms(self, caseNode):
+    '''
+    Moves the cores of scenes saved with one transform and model node per core into a ledger and removes
+    those nodes. Their fire times and depths were not recorded.
+    '''
+    ledger = BiopsyLedger.BiopsyLedger()
+    biopsyTransformRolesParameter = caseNode.GetParameter(self.BIOPSY_TRANSFORM_ROLES)
+    if not biopsyTransformRolesParameter:
+      return ledger
+
+    for idx, biopsyRole in enumerate(json.loads(biopsyTransformRolesParameter)):
+      biopsyModelToReferenceNode = caseNode.GetNodeReference(biopsyRole)
+      if biopsyModelToReferenceNode is None:
+        continue
+      ledger.append(slicer.util.arrayFromTransformMatrix(biopsyModelToReferenceNode, toWorld=True), float("nan"))
+      legacyModels = slicer.mrmlScene.GetNodesByName("BiopsyModel_{}".format(idx))
+      for modelIndex in range(legacyModels.GetNumberOfItems()):
+        slicer.mrmlScene.RemoveNode(legacyModels.GetItemAsObject(modelIndex))
+      caseNode.SetNodeReferenceID(biopsyRole, None)
+      slicer.mrmlScene.RemoveNode(biopsyModelToReferenceNode)
+
+    caseNode.SetParameter(self.BIOPSY_TRANSFORM_ROLES, "")
+    return ledger
 
   def changeZoneVisibility(self, showZonesState):
 
@@ -868,68 +1862,147 @@ class TrackedTRUSSimLogic(ScriptedLoadableModuleLogic):
 
   def visualizeBiopsies(self):
     '''
-    This method will ensure that all transforms with the name "BiopsyModelToReference_X" are added to
-    BiopsyModelToBiopsyTrajectory, as well as add a biopsy model to any that don't already have one.
+    Rebuilds the biopsy ledger from the case node and redraws all of its cores in one pass. Scenes saved
+    with one transform per core are converted to the ledger.
     '''
 
-    #Establish the location of the biopsy model file
-    moduleDir = os.path.dirname(slicer.modules.trackedtrussim.path)
-    biopsyModelPath = os.path.join(moduleDir, "Resources", "models", "BiopsyModel.vtk")
-
     #Get the parameter node
-    parameterNode = self.getParameterNode()
     caseNode = self.getCaseNode()
 
-    #Get parameter containing all the role IDs
-    biopsyTransformRolesNode = caseNode.GetParameter(self.BIOPSY_TRANSFORM_ROLES)
-
-    print(str(biopsyTransformRolesNode))
-
-    #If there are no biopsy transforms exit the function
-    if biopsyTransformRolesNode is '':
-      return
-
-    #Read the list of biopsy transform roles
-    biopsyTransformRoles = json.loads(biopsyTransformRolesNode)
-
-    #Go through each biopsy transform role
-    for idx, biopsyRole in enumerate(biopsyTransformRoles):
-
-      #Get the transform for each biopsy role
-      biopsyModelToReferenceNode = parameterNode.GetNodeReference(biopsyRole)
-
-      #If the parent node isn't BiopsyModelToBiopsyTrajectory, change it
-      # if biopsyModelToReferenceNode.GetParentTransformNode().GetName() is not "BiopsyModelToBiopsyTrajectory":
-      #   biopsyModelToReferenceNode.SetAndObserveTransformNodeID(BiopsyModelToBiopsyTrajectory.GetID())
-
-      #Check whether the biopsy model already exists
-      biopsyModelName = "BiopsyModel_{}".format(idx)
-
-      if slicer.mrmlScene.GetNodesByName(biopsyModelName).GetNumberOfItems() == 0:
-
-        # Create a biopsy cylinder and add it to the new transform
-        biopsyModel = slicer.util.loadModel(biopsyModelPath)
-        biopsyModel.SetName(biopsyModelName)
+    biopsyLedgerParameter = caseNode.GetParameter(self.BIOPSY_LEDGER)
+    if biopsyLedgerParameter:
+      self.core.biopsyLedger = BiopsyLedger.BiopsyLedger.fromString(biopsyLedgerParameter)
+      self.biopsyLedgerModified = False
+    else:
+      self.core.biopsyLedger = self.readLegacyBiopsyTransforms(caseNode)
+      self.biopsyLedgerModified = len(self.core.biopsyLedger) > 0
 
-        biopsyModel.SetAndObserveTransformNodeID(biopsyModelToReferenceNode.GetID())
+    self.getBiopsyCores().setInstances(self.core.biopsyLedger.poses)
 
-        # Change the colour
-        biopsyDispNode = biopsyModel.GetDisplayNode()
-        biopsyDispNode.SetColor(0, 0.5, 0)
 
+  def assetBundlePath(self):
+    moduleDir = os.path.dirname(slicer.modules.trackedtrussim.path)
+    return os.path.join(moduleDir, "Resources", self.ASSET_BUNDLE_FILE)
 
-  def setupParameterNode(self):
+  def buildAssetBundle(self, bundlePath=None):
+    """
+    Loads every static transform, model and volume of the base scene through the Slicer loaders once
+    and packs them into the asset bundle. Returns the path of the bundle.
     """
-    Setup the slicer scene.
+    if bundlePath is None:
+      bundlePath = self.assetBundlePath()
+    moduleDir = os.path.dirname(slicer.modules.trackedtrussim.path)
+    resourceDir = os.path.join(moduleDir, "Resources")
+
+    transforms, models, volumes, sources = {}, {}, {}, {}
+    loadedNodes = []
+
+    for name, fileName in self.STATIC_TRANSFORM_FILES.items():
+      sources[name] = os.path.join(resourceDir, "transforms", fileName)
+      transformNode = slicer.util.loadTransform(sources[name])
+      transforms[name] = slicer.util.arrayFromTransformMatrix(transformNode)
+      loadedNodes.append(transformNode)
+
+    for name, fileName in self.STATIC_MODEL_FILES.items():
+      sources[name] = os.path.join(resourceDir, "models", fileName)
+      modelNode = slicer.util.loadModel(sources[name])
+      polyData = vtk.vtkPolyData()
+      polyData.DeepCopy(modelNode.GetPolyData())
+      models[name] = polyData
+      loadedNodes.append(modelNode)
+
+    for name, fileName in self.STATIC_VOLUME_FILES.items():
+      sources[name] = os.path.join(resourceDir, "models", fileName)
+      volumeNode = slicer.util.loadVolume(sources[name])
+      ijkToRAS = vtk.vtkMatrix4x4()
+      volumeNode.GetIJKToRASMatrix(ijkToRAS)
+      volumes[name] = (slicer.util.arrayFromVolume(volumeNode).copy(), slicer.util.arrayFromVTKMatrix(ijkToRAS))
+      loadedNodes.append(volumeNode)
+
+    for node in loadedNodes:
+      if node.GetStorageNode():
+        slicer.mrmlScene.RemoveNode(node.GetStorageNode())
+      slicer.mrmlScene.RemoveNode(node)
+
+    AssetBundle.writeBundle(bundlePath, resourceDir, transforms, models, volumes, sources)
+    return bundlePath
+
+  def populateFromBundle(self, parameterNode, bundlePath):
+    """
+    Creates every base scene node that is not in the scene yet from the asset bundle, in a single
+    batch. setupTransformHierarchy and setupParameterNode then find the nodes and only wire them up.
+    """
+    transforms, models, volumes = AssetBundle.readBundle(bundlePath)
+
+    slicer.mrmlScene.StartState(slicer.mrmlScene.BatchProcessState)
+    try:
+      for name, matrix in transforms.items():
+        if parameterNode.GetNodeReference(name) is None:
+          transformNode = slicer.mrmlScene.AddNewNodeByClass("vtkMRMLLinearTransformNode", name)
+          transformNode.SetMatrixTransformToParent(slicer.util.vtkMatrixFromArray(matrix))
+          transformNode.SetSaveWithScene(False)
+          parameterNode.SetNodeReferenceID(name, transformNode.GetID())
+
+      for name, polyData in models.items():
+        if parameterNode.GetNodeReference(name) is None:
+          modelNode = slicer.modules.models.logic().AddModel(polyData)
+          modelNode.SetName(name)
+          parameterNode.SetNodeReferenceID(name, modelNode.GetID())
+
+      for name, (array, ijkToRAS) in volumes.items():
+        if parameterNode.GetNodeReference(name) is None:
+          volumeNode = slicer.mrmlScene.AddNewNodeByClass("vtkMRMLScalarVolumeNode", name)
+          volumeNode.SetIJKToRASMatrix(slicer.util.vtkMatrixFromArray(ijkToRAS))
+          slicer.util.updateVolumeFromArray(volumeNode, array)
+          volumeNode.CreateDefaultDisplayNodes()
+          parameterNode.SetNodeReferenceID(name, volumeNode.GetID())
+    finally:
+      slicer.mrmlScene.EndState(slicer.mrmlScene.BatchProcessState)
+
+  def setupParameterNode(self, deferLayout=False):
     """
+    Setup the slicer scene, in timed stages: the static nodes from the asset bundle, the transform hierarchy,
+    the models and the transform chain, then the custom layout (unless deferLayout, in which case the caller
+    runs setupLayout, eg. the widget when its panel is shown). The PLUS server nodes are created by the first
+    startReconstruction or tracking recording.
+    """
+    startTime = time.perf_counter()
 
     #Get the current directory
     moduleDir = os.path.dirname(slicer.modules.trackedtrussim.path)
 
-    self.setupTransformHierarchy()
-    self.splitSliceViewer()
-    self.setupPlusServer()
-
+    #Create the static nodes from the asset bundle if it matches the source files
+    self.baseSceneSource = "source files"
+    if self.useAssetBundle:
+      with startupTimer.stage("assetBundle"):
+        bundleValid, reason = AssetBundle.validateBundle(self.assetBundlePath(), os.path.join(moduleDir, "Resources"))
+        if bundleValid:
+          self.populateFromBundle(self.getParameterNode(), self.assetBundlePath())
+          self.baseSceneSource = "asset bundle"
+        else:
+          logging.info("Not using the asset bundle ({}), loading the source files".format(reason))
+
+    with startupTimer.stage("transforms"):
+      self.setupTransformHierarchy()
+    with startupTimer.stage("models"):
+      self.setupBaseModels(moduleDir)
+    with startupTimer.stage("transformChain"):
+      self.setupTransformChain()
+
+    self.baseSceneLoadTime = time.perf_counter() - startTime
+    logging.info("Base scene set up in {:.3f} s from {}".format(self.baseSceneLoadTime, self.baseSceneSource))
+
+    if not deferLayout:
+      self.setupLayout()
+
+  def setupLayout(self):
+    with startupTimer.stage("layout"):
+      self.splitSliceViewer()
+
+  def setupBaseModels(self, moduleDir):
+    """
+    Loads the models and the US mask of the base scene (unless the asset bundle created them) and places them.
+    """
     #Get the parameter node
     parameterNode = self.getParameterNode()
 
@@ -1146,57 +2219,28 @@ class TrackedTRUSSimLogic(ScriptedLoadableModuleLogic):
   def setupCase(self, case):
 
     self.currCaseNumber = case
+    if self.journal is not None:
+      self.journal.caseSelected(case)
 
     parameterNode = self.getParameterNode()
-    caseNode = self.getCaseNode()
 
-    print("casenode: ")
-
-    moduleDir = os.path.dirname(slicer.modules.trackedtrussim.path)
-
-    #Load TRUSToCylinder transform
-    trusToCylinder = caseNode.GetNodeReference(self.TRUS_TO_CYLINDER)
-    if trusToCylinder != None:
-      slicer.mrmlScene.RemoveNode(trusToCylinder)
-    trusToCylinderPath = os.path.join(moduleDir, "Resources", 'registered_zones', 'Patient_' + str(case), 'TRUSToCylinder.h5')
-    trusToCylinder = slicer.util.loadTransform(trusToCylinderPath)
-    trusToCylinder.SetName(self.TRUS_TO_CYLINDER)
-    caseNode.SetNodeReferenceID(self.TRUS_TO_CYLINDER, trusToCylinder.GetID())
-
-    #Add TRUSToCylinder into hierarchy
-    cylinderToBox = parameterNode.GetNodeReference(self.CYLINDER_TO_BOX)
-    trusToCylinder.SetAndObserveTransformNodeID(cylinderToBox.GetID())
-
-    #Load the TRUS volume
-    trusVolume = caseNode.GetNodeReference(self.TRUS_VOLUME)
-    if trusVolume != None:
-      slicer.mrmlScene.RemoveNode(trusVolume)
-    trusPath = os.path.join(moduleDir, "Resources", "registered_zones", "Patient_" + str(case), "TRUS.nrrd")
-    trusVolume = slicer.util.loadVolume(trusPath)
-    trusVolume.SetName(self.TRUS_VOLUME)
-    caseNode.SetNodeReferenceID(self.TRUS_VOLUME, trusVolume.GetID())
-
-    trusVolume.SetAndObserveTransformNodeID(trusToCylinder.GetID())
-
-    #load zone segmentation
-    seg = caseNode.GetNodeReference(self.ZONE_SEGMENTATION)
-    if seg != None:
-      slicer.mrmlScene.RemoveNode(seg)
-    zone_path = os.path.join(moduleDir, "Resources", 'registered_zones', 'Patient_' + str(case), 'Zones.seg.nrrd')
-    zoneNode = slicer.util.loadLabelVolume(zone_path)
-
-    #Setup segmentation
-    labelmapVolumeNode = zoneNode
-    seg = slicer.mrmlScene.AddNewNodeByClass('vtkMRMLSegmentationNode', self.ZONE_SEGMENTATION)
-    slicer.modules.segmentations.logic().ImportLabelmapToSegmentationNode(labelmapVolumeNode, seg)
-    seg.CreateClosedSurfaceRepresentation()
-    slicer.mrmlScene.RemoveNode(labelmapVolumeNode)
-    segDisplay = seg.GetDisplayNode()
-    segDisplay.SetVisibility(False)
-    segDisplay.SetOpacity(0.3)
-    caseNode.SetNodeReferenceID(self.ZONE_SEGMENTATION, seg.GetID())
-
-    seg.SetAndObserveTransformNodeID(trusToCylinder.GetID())
+    #Decoded case data is kept in an LRU cache, so switching back to a recent case only swaps references
+    startTime = time.perf_counter()
+    preparedCase = self.caseCache.get(case)
+    cacheHit = preparedCase is not None
+    if not cacheHit:
+      decodedCase = self.casePrefetcher.take(case)
+      if decodedCase is not None and decodedCase.trusArray is not None:
+        preparedCase = self.prepareCaseFromDecoded(decodedCase)
+      else:
+        preparedCase = self.prepareCase(case)
+      self.caseCache.put(case, preparedCase)
+    trusToCylinder, trusVolume, seg = self.applyPreparedCase(preparedCase)
+    self.core.setZones(preparedCase.zoneIndex, preparedCase.zoneDistances)
+    self.touchCase(case)
+    logging.info("Case {} {} in {:.3f} s (case cache: {}, prefetch: {})".format(
+      case, "restored from cache" if cacheHit else "loaded", time.perf_counter() - startTime,
+      self.caseCache.getStats(), self.casePrefetcher.getStats()))
 
     #Set the foreground and background of the red slice
     layoutManager = slicer.app.layoutManager()
@@ -1222,12 +2266,252 @@ class TrackedTRUSSimLogic(ScriptedLoadableModuleLogic):
     #Recenter the red slice on the new content
     layoutManager.sliceWidget("Red").sliceLogic().FitSliceToAll()
 
+    #Point the offscreen slice generator at the new TRUS volume
+    self.updateSliceGeneratorVolume()
+
+
+  def getCaseDirectory(self, case):
+    return os.path.join(self.registeredZonesDirectory, "Patient_" + str(case))
+
+  def prepareCase(self, case):
+    """
+    Loads the TRUSToCylinder transform, TRUS volume and zone segmentation (with closed surfaces) of a case
+    and returns their decoded contents. The nodes used for loading are removed from the scene again.
+    """
+    caseDirectory = self.getCaseDirectory(case)
+
+    trusToCylinderPath = os.path.join(caseDirectory, "TRUSToCylinder.h5")
+    trusToCylinder = self.loadCaseTransform(trusToCylinderPath)
+
+    trusPath = os.path.join(caseDirectory, "TRUS.nrrd")
+    trusNode = slicer.util.loadVolume(trusPath, {"show": False})
+    trusIJKToRAS = vtk.vtkMatrix4x4()
+    trusNode.GetIJKToRASMatrix(trusIJKToRAS)
+    trusDisplayNode = trusNode.GetDisplayNode()
+    window, level = trusDisplayNode.GetWindow(), trusDisplayNode.GetLevel()
+    trusImageData = trusNode.GetImageData()
+    slicer.mrmlScene.RemoveNode(trusNode)
+
+    zonePath = os.path.join(caseDirectory, "Zones.seg.nrrd")
+    segmentation = self.loadZoneSegmentation(zonePath)
+    try:
+      zoneIndex = ZoneIndex.ZoneSamplingIndex.fromSegmentationFile(zonePath)
+    except (OSError, ValueError, KeyError) as e:
+      logging.warning("No zone hit detection for case {}: {}".format(case, e))
+      zoneIndex = None
+    zoneDistances = ZoneDistance.loadCachedZoneDistances(zonePath) if zoneIndex is not None else None
+
+    sources = {self.TRUS_TO_CYLINDER: trusToCylinderPath, self.TRUS_VOLUME: trusPath, self.ZONE_SEGMENTATION: zonePath}
+    preparedCase = CaseCache.PreparedCase(case, trusToCylinder, trusImageData, slicer.util.arrayFromVTKMatrix(trusIJKToRAS),
+                                          window, level, segmentation, sources, zoneIndex, zoneDistances)
+    if zoneIndex is not None and zoneDistances is None:
+      self.computeZoneDistancesInBackground(preparedCase)
+    return preparedCase
+
+  def computeZoneDistancesInBackground(self, preparedCase):
+    """
+    Computes (and caches) the zone distance fields of a case that has none cached yet on the prefetch threads,
+    so opening it does not wait for the distance transform. The target distances read None until they are in.
+    """
+    zonePath = preparedCase.sources[self.ZONE_SEGMENTATION]
+    future = self.casePrefetcher.submit(ZoneDistance.loadOrComputeZoneDistances, zonePath, preparedCase.zoneIndex)
+
+    #Polled from the main thread, which owns the scene and the core
+    def applyWhenDone():
+      if not future.done():
+        self.scheduleOnMainThread(0.1, applyWhenDone)
+        return
+      try:
+        preparedCase.zoneDistances = future.result()
+      except (OSError, ValueError, KeyError) as e:
+        logging.warning("No zone distances for case {}: {}".format(preparedCase.caseNumber, e))
+        return
+      if preparedCase.caseNumber in self.caseCache:
+        self.caseCache.put(preparedCase.caseNumber, preparedCase)
+      if self.caseLoaded and self.currCaseNumber == preparedCase.caseNumber:
+        self.core.setZones(preparedCase.zoneIndex, preparedCase.zoneDistances)
+    self.scheduleOnMainThread(0.1, applyWhenDone)
+
+  def loadCaseTransform(self, transformPath):
+    transformNode = slicer.util.loadTransform(transformPath)
+    matrix = slicer.util.arrayFromTransformMatrix(transformNode)
+    slicer.mrmlScene.RemoveNode(transformNode)
+    return matrix
+
+  def decodeCaseFiles(self, case, cancelled):
+    """
+    Runs on a prefetch worker thread: reads the case files into arrays, without touching the scene.
+    """
+    return CasePrefetch.decodeCase(case, self.getCaseDirectory(case), self.surfaceCache,
+                                   self.surfaceConversionParameters, cancelled)
+
+  def prepareCaseFromDecoded(self, decodedCase):
+    """
+    Same as prepareCase, for a case whose volumes were already read by the prefetcher.
+    """
+    case = decodedCase.caseNumber
+    caseDirectory = self.getCaseDirectory(case)
+
+    trusToCylinderPath = os.path.join(caseDirectory, "TRUSToCylinder.h5")
+    trusToCylinder = self.loadCaseTransform(trusToCylinderPath)
+
+    #Wrap the decoded voxels without copying; geometry is kept in the node's IJKToRAS like Slicer loaders do
+    trusImageData = vtk.vtkImageData()
+    trusImageData.SetDimensions(decodedCase.trusArray.shape[::-1])
+    trusImageData.GetPointData().SetScalars(numpy_support.numpy_to_vtk(decodedCase.trusArray.reshape(-1), deep=False))
+
+    segmentation = self.loadZoneSegmentation(decodedCase.zonePath, decodedCase)
+
+    sources = {self.TRUS_TO_CYLINDER: trusToCylinderPath, self.TRUS_VOLUME: os.path.join(caseDirectory, "TRUS.nrrd"),
+               self.ZONE_SEGMENTATION: decodedCase.zonePath}
+    #Window / level are left to the display node (None) and remembered after the first applyPreparedCase
+    return CaseCache.PreparedCase(case, trusToCylinder, trusImageData, decodedCase.trusIJKToRAS,
+                                  None, None, segmentation, sources, decodedCase.zoneIndex, decodedCase.zoneDistances)
+
+  def prefetchCases(self, currentCase, caseCount):
+    """
+    Starts decoding, in the background, the cases that follow currentCase in the case list and the most opened
+    cases, skipping the ones already in the case cache. Pending work for other cases is cancelled.
+    """
+    upcomingCases = range(currentCase + 1, caseCount)
+    exclude = [case for case in range(caseCount)
+               if case == currentCase or case in self.caseCache or not os.path.isdir(self.getCaseDirectory(case))]
+    self.casePrefetcher.prefetch(self.casePrefetcher.candidates(upcomingCases, self.prefetchCount, exclude))
+
+  def touchCase(self, case):
+    self.casePrefetcher.touch(case)
+    touchCounts = {str(touchedCase): count for touchedCase, count in self.casePrefetcher.touchCounts.items()}
+    qt.QSettings().setValue(self.moduleName + "/CaseTouchCounts", json.dumps(touchCounts))
+
+  def readCaseTouchCounts(self):
+    try:
+      touchCounts = json.loads(qt.QSettings().value(self.moduleName + "/CaseTouchCounts", "{}"))
+    except ValueError:
+      return {}
+    return {int(case): count for case, count in touchCounts.items()}
+
+  def surfaceCacheDirectory(self):
+    moduleDir = os.path.dirname(slicer.modules.trackedtrussim.path)
+    return os.path.join(moduleDir, "Resources", "Cache", "ZoneSurfaces")
+
+  def loadZoneSegmentation(self, zonePath, decodedCase=None):
+    """
+    Imports a zone labelmap into a segmentation with closed surfaces. The surfaces are taken from the surface
+    cache when it has them for this file and these conversion parameters, otherwise they are converted and cached.
+    With a prefetched decodedCase the labelmap (and possibly the surfaces) come from memory instead of the files.
+    """
+    if decodedCase is None:
+      labelmapVolumeNode = slicer.util.loadLabelVolume(zonePath, {"show": False})
+    else:
+      labelmapVolumeNode = slicer.mrmlScene.AddNewNodeByClass("vtkMRMLLabelMapVolumeNode")
+      slicer.util.updateVolumeFromArray(labelmapVolumeNode, decodedCase.zoneArray)
+      labelmapVolumeNode.SetIJKToRASMatrix(TransformUtils.vtkMatrixFromArray(decodedCase.zoneIJKToRAS))
+      labelmapVolumeNode.CreateDefaultDisplayNodes()
+    zoneNode = slicer.mrmlScene.AddNewNodeByClass("vtkMRMLSegmentationNode")
+    slicer.modules.segmentations.logic().ImportLabelmapToSegmentationNode(labelmapVolumeNode, zoneNode)
+    segmentation = zoneNode.GetSegmentation()
+    slicer.mrmlScene.RemoveNode(labelmapVolumeNode)
+    slicer.mrmlScene.RemoveNode(zoneNode)
+
+    closedSurfaceName = slicer.vtkSegmentationConverter.GetSegmentationClosedSurfaceRepresentationName()
+    segmentIds = [segmentation.GetNthSegmentID(index) for index in range(segmentation.GetNumberOfSegments())]
+    if not self.useSurfaceCache:
+      segmentation.CreateRepresentation(closedSurfaceName)
+      return segmentation
+
+    key = SurfaceCache.surfaceCacheKey(zonePath, segmentation.SerializeAllConversionParameters())
+    if decodedCase is not None and decodedCase.surfacesKey == key:
+      surfaces = decodedCase.surfaces
+    else:
+      surfaces = self.surfaceCache.read(key)
+    if surfaces is not None and set(surfaces) == set(segmentIds):
+      for segmentId in segmentIds:
+        segmentation.GetSegment(segmentId).AddRepresentation(closedSurfaceName, surfaces[segmentId])
+      return segmentation
+
+    segmentation.CreateRepresentation(closedSurfaceName)
+    self.surfaceCache.write(key, {segmentId: segmentation.GetSegment(segmentId).GetRepresentation(closedSurfaceName)
+                                  for segmentId in segmentIds})
+    return segmentation
+
+  def warmSurfaceCache(self):
+    """
+    Converts every zone segmentation of every case that is not in the surface cache yet. Returns the files visited.
+    """
+    moduleDir = os.path.dirname(slicer.modules.trackedtrussim.path)
+    zonePaths = sorted(glob(os.path.join(moduleDir, "Resources", "registered_zones", "Patient_*", "Zones*.seg.nrrd")))
+    for zonePath in zonePaths:
+      self.loadZoneSegmentation(zonePath)
+    return zonePaths
+
+  def applyPreparedCase(self, preparedCase):
+    """
+    Points the case nodes (created on first use) at the data of a prepared case. No data is copied.
+    Returns the TRUSToCylinder, TRUS volume and zone segmentation nodes.
+    """
+    parameterNode = self.getParameterNode()
+    caseNode = self.getCaseNode()
+
+    trusToCylinder = caseNode.GetNodeReference(self.TRUS_TO_CYLINDER)
+    if trusToCylinder is None:
+      trusToCylinder = slicer.mrmlScene.AddNewNodeByClass("vtkMRMLLinearTransformNode", self.TRUS_TO_CYLINDER)
+      caseNode.SetNodeReferenceID(self.TRUS_TO_CYLINDER, trusToCylinder.GetID())
+    trusToCylinder.SetMatrixTransformToParent(TransformUtils.vtkMatrixFromArray(preparedCase.trusToCylinder))
+    cylinderToBox = parameterNode.GetNodeReference(self.CYLINDER_TO_BOX)
+    trusToCylinder.SetAndObserveTransformNodeID(cylinderToBox.GetID())
+
+    trusVolume = caseNode.GetNodeReference(self.TRUS_VOLUME)
+    if trusVolume is None:
+      trusVolume = slicer.mrmlScene.AddNewNodeByClass("vtkMRMLScalarVolumeNode", self.TRUS_VOLUME)
+      caseNode.SetNodeReferenceID(self.TRUS_VOLUME, trusVolume.GetID())
+    trusVolume.SetIJKToRASMatrix(TransformUtils.vtkMatrixFromArray(preparedCase.trusIJKToRAS))
+    trusVolume.SetAndObserveImageData(preparedCase.trusImageData)
+    trusVolume.CreateDefaultDisplayNodes()
+    trusDisplayNode = trusVolume.GetDisplayNode()
+    if preparedCase.window is None:
+      trusDisplayNode.SetAutoWindowLevel(True)
+      preparedCase.window, preparedCase.level = trusDisplayNode.GetWindow(), trusDisplayNode.GetLevel()
+    else:
+      trusDisplayNode.SetAutoWindowLevel(False)
+      trusDisplayNode.SetWindowLevel(preparedCase.window, preparedCase.level)
+    trusVolume.SetAndObserveTransformNodeID(trusToCylinder.GetID())
+
+    seg = caseNode.GetNodeReference(self.ZONE_SEGMENTATION)
+    if seg is None:
+      seg = slicer.mrmlScene.AddNewNodeByClass("vtkMRMLSegmentationNode", self.ZONE_SEGMENTATION)
+      caseNode.SetNodeReferenceID(self.ZONE_SEGMENTATION, seg.GetID())
+    seg.SetAndObserveSegmentation(preparedCase.segmentation)
+    seg.CreateDefaultDisplayNodes()
+    segDisplay = seg.GetDisplayNode()
+    segDisplay.SetVisibility(False)
+    segDisplay.SetOpacity(0.3)
+    seg.SetAndObserveTransformNodeID(trusToCylinder.GetID())
+
+    #Saved scenes only reference the case files, so keep the storage nodes pointing at the current case
+    for role, node in ((self.TRUS_TO_CYLINDER, trusToCylinder), (self.TRUS_VOLUME, trusVolume)):
+      if node.GetStorageNode() is None:
+        node.AddDefaultStorageNode(preparedCase.sources[role])
+      else:
+        node.GetStorageNode().SetFileName(preparedCase.sources[role])
+
+    return trusToCylinder, trusVolume, seg
+
+  def setCaseCacheBudget(self, maxMegabytes):
+    self.caseCacheBudget = maxMegabytes
+    self.caseCache.setMaxBytes(int(maxMegabytes * 1024 * 1024))
+
+  def clearCaseCache(self):
+    self.caseCache.clear()
+
 
   def setupPlusServer(self):
     """
     Creates PLUS server and OpenIGTLink connection if it doesn't exist already.
     """
     parameterNode = self.getParameterNode()
+    if self.isPlusServerLinked(parameterNode):
+      return
+    startTime = time.perf_counter()
 
     moduleDir = os.path.dirname(slicer.modules.trackedtrussim.path)
     configFullpath = os.path.join(moduleDir, "Resources", "plus", self.CONFIG_FILE)
@@ -1256,9 +2540,24 @@ class TrackedTRUSSimLogic(ScriptedLoadableModuleLogic):
     if not plusServerLauncherNode:
       plusServerLauncherNode = slicer.mrmlScene.AddNewNodeByClass("vtkMRMLPlusServerLauncherNode", self.PLUS_SERVER_LAUNCHER_NODE)
       plusServerLauncherNode.SaveWithSceneOff()
+      parameterNode.SetNodeReferenceID(self.PLUS_SERVER_LAUNCHER_NODE, plusServerLauncherNode.GetID())
 
     if plusServerLauncherNode.GetNodeReferenceID('plusServerRef') != plusServerNode.GetID():
       plusServerLauncherNode.AddAndObserveServerNode(plusServerNode)
+    startupTimer.record("plusServer", time.perf_counter() - startTime)
+
+  def isPlusServerLinked(self, parameterNode):
+    """
+    True if the config text, PLUS server and launcher nodes all exist and are linked to each other.
+    """
+    configTextNode = parameterNode.GetNodeReference(self.CONFIG_TEXT_NODE)
+    plusServerNode = parameterNode.GetNodeReference(self.PLUS_SERVER_NODE)
+    plusServerLauncherNode = parameterNode.GetNodeReference(self.PLUS_SERVER_LAUNCHER_NODE)
+    if configTextNode is None or plusServerNode is None or plusServerLauncherNode is None:
+      return False
+    configNode = plusServerNode.GetConfigNode()
+    return (configNode is not None and configNode.GetID() == configTextNode.GetID() and
+            plusServerLauncherNode.GetNodeReferenceID('plusServerRef') == plusServerNode.GetID())
 
 
 #
@@ -1283,49 +2582,162 @@ class TrackedTRUSSimTest(ScriptedLoadableModuleTest):
     """
     self.setUp()
     self.test_TrackedTRUSSim1()
+    self.setUp()
+    self.test_TrackedTRUSSimJournalRecovery()
+    self.setUp()
+    self.test_TrackedTRUSSimTrackerWireFormat()
+    self.setUp()
+    self.test_TrackedTRUSSimLedgerVersions()
+    self.setUp()
+    self.test_TrackedTRUSSimBenchmarks()
 
   def test_TrackedTRUSSim1(self):
-    """ Ideally you should have several levels of tests.  At the lowest level
-    tests should exercise the functionality of the logic with different inputs
-    (both valid and invalid).  At higher levels your tests should emulate the
-    way the user would interact with your code and confirm that it still works
-    the way you intended.
-    One of the most important features of the tests is that it should alert other
-    developers when their changes will have an impact on the behavior of your
-    module.  For example, if a developer removes a feature that you depend on,
-    your test should break so they know that the feature is needed.
+    """
+    Sets up case 1, fires two cores at a set needle depth, and checks that a saved session brings them back.
     """
 
     self.delayDisplay("Starting the test")
 
-    # Get/create input data
+    logic = TrackedTRUSSimLogic()
+    logic.setupParameterNode()
+    logic.setupCase(1)
+    self.assertTrue(logic.caseLoaded)
+    self.delayDisplay('Loaded case 1')
+
+    logic.moveBiopsy(10)
+    logic.fireBiopsyNeedle()
+    logic.fireBiopsyNeedle()
+    self.assertEqual(len(logic.core.biopsyLedger), 2)
+    self.assertAlmostEqual(logic.core.biopsyLedger.depths[0], 10)
+    self.assertAlmostEqual(logic.core.biopsyLedger.depths[1], 0)
+    firedPoses = logic.core.biopsyLedger.poses.copy()
+
+    with tempfile.TemporaryDirectory() as directory:
+      sessionPath = os.path.join(directory, "Test" + SessionFile.SESSION_EXTENSION)
+      logic.saveSession(sessionPath, "Test")
+      logic.core.biopsyLedger = BiopsyLedger.BiopsyLedger()
+      session = logic.loadSession(sessionPath)
+    self.assertEqual(session.caseNumber, 1)
+    self.assertEqual(len(logic.core.biopsyLedger), 2)
+    np.testing.assert_allclose(logic.core.biopsyLedger.poses, firedPoses)
 
-    import SampleData
-    registerSampleData()
-    inputVolume = SampleData.downloadSample('TrackedTRUSSim1')
-    self.delayDisplay('Loaded test data set')
+    self.delayDisplay('Test passed')
 
-    inputScalarRange = inputVolume.GetImageData().GetScalarRange()
-    self.assertEqual(inputScalarRange[0], 0)
-    self.assertEqual(inputScalarRange[1], 695)
+  def test_TrackedTRUSSimJournalRecovery(self):
+    """
+    Writes a journal, tears its last record and checks that recovery restores exactly the complete records,
+    that a corrupt record ends the replay and that a journal of another version is refused.
+    """
 
-    outputVolume = slicer.mrmlScene.AddNewNodeByClass("vtkMRMLScalarVolumeNode")
-    threshold = 100
+    logic = TrackedTRUSSimLogic()
+    logic.setupParameterNode()
+    poses = [np.eye(4) for index in range(3)]
+    for index, pose in enumerate(poses):
+      pose[:3, 3] = (index, 2 * index, 3 * index)
+    recordSize = SessionJournal.RECORD_DTYPE.itemsize
+
+    with tempfile.TemporaryDirectory() as directory:
+      journalPath = os.path.join(directory, "Test" + SessionJournal.JOURNAL_EXTENSION)
+      writer = SessionJournal.JournalWriter(journalPath, "Test")
+      writer.caseSelected(1)
+      for index, pose in enumerate(poses):
+        writer.biopsyFired(1, pose, depth=index)
+      writer.close()
+
+      #Tear the last core in the middle of its record
+      with open(journalPath, "r+b") as f:
+        f.truncate(SessionJournal.HEADER_SIZE + 3 * recordSize + recordSize // 2)
+      state = logic.recoverJournal(journalPath)
+      self.assertEqual(state.recordCount, 3)
+      self.assertEqual(state.caseNumber, 1)
+      self.assertEqual(len(logic.core.biopsyLedger), 2)
+      np.testing.assert_allclose(logic.core.biopsyLedger.poses, poses[:2])
+      np.testing.assert_allclose(logic.core.biopsyLedger.depths, [0, 1])
+      logic.closeJournal()
+      #The recovered journal continues after the last complete record
+      self.assertEqual(os.path.getsize(journalPath), SessionJournal.HEADER_SIZE + 3 * recordSize)
+
+      #A record that fails its CRC ends the replay
+      with open(journalPath, "r+b") as f:
+        f.seek(SessionJournal.HEADER_SIZE + 2 * recordSize + 8)
+        f.write(b"\xff")
+      self.assertEqual(len(SessionJournal.replayJournal(journalPath).ledger), 1)
+
+      with open(journalPath, "r+b") as f:
+        header = f.read(SessionJournal.HEADER_SIZE)
+        f.seek(0)
+        f.write(header.replace(b'"version": 1', b'"version": 9'))
+      with self.assertRaises(ValueError):
+        SessionJournal.replayJournal(journalPath)
 
-    # Test the module logic
+    self.delayDisplay('Test passed')
 
-    logic = TrackedTRUSSimLogic()
+  def test_TrackedTRUSSimTrackerWireFormat(self):
+    """
+    Checks the OpenIGTLink TRANSFORM messages of the synthetic tracker: the ECMA-182 CRC-64, the 58 byte header
+    and a pack / unpack round trip of the column major 12 float body.
+    """
+
+    self.assertEqual(SyntheticTracker.crc64(b"123456789"), 0x6C40DF5F0B497347)
+    self.assertEqual(SyntheticTracker.HEADER_SIZE, 58)
+
+    matrix = np.eye(4)
+    matrix[:3, :3] = [[0, -1, 0], [1, 0, 0], [0, 0, 1]]
+    matrix[:3, 3] = (1.5, -2.25, 30.0)
+    message = SyntheticTracker.packTransform(SyntheticTracker.PROBE_TO_PHANTOM, matrix, 1234.5)
+    self.assertEqual(len(message), SyntheticTracker.HEADER_SIZE + SyntheticTracker.TRANSFORM_BODY_SIZE)
+    header, body = message[:SyntheticTracker.HEADER_SIZE], message[SyntheticTracker.HEADER_SIZE:]
+    messageType, deviceName, timestamp, bodySize, crc = SyntheticTracker.unpackHeader(header)
+    self.assertEqual((messageType, deviceName, bodySize), ("TRANSFORM", SyntheticTracker.PROBE_TO_PHANTOM, len(body)))
+    self.assertAlmostEqual(timestamp, 1234.5)
+    self.assertEqual(crc, SyntheticTracker.crc64(body))
+    #The body starts with the first column of the rotation
+    np.testing.assert_allclose(np.frombuffer(body[:12], dtype=">f4"), matrix[:3, 0])
+    np.testing.assert_allclose(SyntheticTracker.unpackTransform(body), matrix)
+
+    self.delayDisplay('Test passed')
+
+  def test_TrackedTRUSSimLedgerVersions(self):
+    """
+    Checks that a version 1 biopsy ledger (no zones) still loads, with NaN zone fractions, and that a version 2
+    ledger round trips its zone fractions.
+    """
+
+    poses = np.tile(np.eye(4), (2, 1, 1))
+    poses[:, :3, 3] = [[1, 2, 3], [4, 5, 6]]
+    timestamps, depths = np.array([10.0, 20.0]), np.array([0.0, 12.5])
+
+    def encode(array):
+      return base64.b64encode(np.ascontiguousarray(array, dtype="<f8").tobytes()).decode("ascii")
+    versionOne = json.dumps({"version": 1, "count": 2, "poses": encode(poses), "timestamps": encode(timestamps),
+                             "depths": encode(depths)})
+    ledger = BiopsyLedger.BiopsyLedger.fromString(versionOne)
+    self.assertEqual(len(ledger), 2)
+    np.testing.assert_allclose(ledger.poses, poses)
+    np.testing.assert_allclose(ledger.depths, depths)
+    self.assertEqual(ledger.zoneFractions.shape, (2, len(ZoneIndex.ZONES)))
+    self.assertTrue(np.isnan(ledger.zoneFractions).all())
+
+    zoneFractions = np.linspace(0.0, 1.0, 2 * len(ZoneIndex.ZONES)).reshape(2, -1)
+    ledger = BiopsyLedger.BiopsyLedger.fromArrays(poses, timestamps, depths, zoneFractions)
+    text = ledger.toString()
+    self.assertEqual(json.loads(text)["version"], BiopsyLedger.LEDGER_VERSION)
+    restored = BiopsyLedger.BiopsyLedger.fromString(text)
+    np.testing.assert_allclose(restored.poses, poses)
+    np.testing.assert_allclose(restored.timestamps, timestamps)
+    np.testing.assert_allclose(restored.zoneFractions, zoneFractions)
+
+    self.delayDisplay('Test passed')
+
+  def test_TrackedTRUSSimBenchmarks(self):
+    """
+    Runs every headless benchmark once, so a hot path that breaks fails here rather than in the next benchmark run.
+    """
 
-    # Test algorithm with non-inverted threshold
-    logic.process(inputVolume, outputVolume, threshold, True)
-    outputScalarRange = outputVolume.GetImageData().GetScalarRange()
-    self.assertEqual(outputScalarRange[0], inputScalarRange[0])
-    self.assertEqual(outputScalarRange[1], threshold)
-
-    # Test algorithm with inverted threshold
-    logic.process(inputVolume, outputVolume, threshold, False)
-    outputScalarRange = outputVolume.GetImageData().GetScalarRange()
-    self.assertEqual(outputScalarRange[0], inputScalarRange[0])
-    self.assertEqual(outputScalarRange[1], inputScalarRange[1])
+    suite = BenchmarkSuite.headlessSuite(coreCounts=(10,))
+    results = suite.run(log=None, repeats=1)
+    suite.close()
+    errors = {name: result["error"] for name, result in results.items() if "error" in result}
+    self.assertEqual(errors, {})
 
     self.delayDisplay('Test passed')